@@ -0,0 +1,246 @@
+"""BayArt - Bay Area Art Connection Project: date-range artist availability
+
+Artists list the date ranges they can't work as Unavailability rows. Each
+range covers whole days, from start_range_date to end_range_date inclusive.
+An artist is available for a gig when none of their ranges overlap the gig's
+days.
+
+Stored ranges are read from midnight of their first day to midnight of
+their last, whatever time of day older rows were saved with, so a range
+blocks every day it touches. A range with no end is the single day of its
+start, and one with no start blocks nothing; both backends read rows that
+way.
+
+On PostgreSQL the ranges are compared as tsrange values. A partial GiST index
+on tsrange(date_trunc('day', start_range_date),
+date_trunc('day', coalesce(end_range_date, start_range_date))) (see model.py)
+turns "is this artist free?" into one indexed NOT EXISTS inside the artist
+query.
+Other databases, such as SQLite in tests, use an in-memory interval tree of
+every range instead. It is built on first use and rebuilt after any
+Unavailability changes.
+"""
+
+import bisect
+import threading
+from datetime import datetime, time
+
+from sqlalchemy import event, literal, true
+from sqlalchemy.orm import Session, object_session
+
+from model import db, User, Unavailability
+from search import artist_search_query
+
+
+def midnight(value):
+    """Returns the start of the day of a date or datetime."""
+
+    if isinstance(value, datetime):
+        value = value.date()
+
+    return datetime.combine(value, time())
+
+
+def day_range(start, end=None):
+    """Returns (first day, last day) as midnight datetimes. A missing end
+    means the range is the single day of start; a missing start means there
+    is no range, and returns None."""
+
+    if start == None:
+        return None
+
+    if end == None:
+        end = start
+
+    return midnight(start), midnight(end)
+
+
+class IntervalTree(object):
+    """A centered interval tree of closed intervals (start, end, value).
+    overlapping(start, end) finds the values of every stored interval that
+    shares at least one point with [start, end], in O(log n + matches)."""
+
+    def __init__(self, intervals):
+        intervals = list(intervals)
+
+        self.center = None
+        self.left = None
+        self.right = None
+
+        if not intervals:
+            return
+
+        points = sorted(point for interval in intervals for point in interval[:2])
+        self.center = points[len(points) // 2]
+
+        here = []
+        left = []
+        right = []
+        for interval in intervals:
+            if interval[1] < self.center:
+                left.append(interval)
+            elif interval[0] > self.center:
+                right.append(interval)
+            else:
+                here.append(interval)
+
+        # The intervals containing center, once by start and once by end
+        self.by_start = sorted(here, key=lambda interval: interval[0])
+        self.starts = [interval[0] for interval in self.by_start]
+        self.by_end = sorted(here, key=lambda interval: interval[1])
+        self.ends = [interval[1] for interval in self.by_end]
+
+        if left:
+            self.left = IntervalTree(left)
+        if right:
+            self.right = IntervalTree(right)
+
+    def overlapping(self, start, end):
+        found = set()
+        self._collect(start, end, found)
+        return found
+
+    def _collect(self, start, end, found):
+        if self.center is None:
+            return
+
+        if end < self.center:
+            # Only intervals here that start by end can reach the query
+            for interval in self.by_start[: bisect.bisect_right(self.starts, end)]:
+                found.add(interval[2])
+            if self.left is not None:
+                self.left._collect(start, end, found)
+        elif start > self.center:
+            # Only intervals here that end at or after start can reach it
+            for interval in self.by_end[bisect.bisect_left(self.ends, start) :]:
+                found.add(interval[2])
+            if self.right is not None:
+                self.right._collect(start, end, found)
+        else:
+            # The query contains center, and so overlaps everything here
+            for interval in self.by_start:
+                found.add(interval[2])
+            if self.left is not None:
+                self.left._collect(start, end, found)
+            if self.right is not None:
+                self.right._collect(start, end, found)
+
+
+class PostgresAvailability(object):
+    """Compares tsranges, using the GiST index on unavailability."""
+
+    def available(self, start, end):
+        # The same expression and predicate as ix_unavailability_during
+        during = db.func.tsrange(
+            db.func.date_trunc("day", Unavailability.start_range_date),
+            db.func.date_trunc(
+                "day",
+                db.func.coalesce(
+                    Unavailability.end_range_date, Unavailability.start_range_date
+                ),
+            ),
+            literal("[]"),
+        )
+        wanted = db.func.tsrange(start, end, literal("[]"))
+
+        busy = (
+            db.session.query(Unavailability.un_id)
+            .filter(
+                Unavailability.user_id == User.id,
+                Unavailability.start_range_date != None,
+                during.op("&&")(wanted),
+            )
+            .exists()
+        )
+
+        return ~busy
+
+
+class InMemoryAvailability(object):
+    """Looks ranges up in an IntervalTree of every Unavailability row."""
+
+    def __init__(self):
+        self.tree = None
+        self.lock = threading.Lock()
+
+    def get_tree(self):
+        with self.lock:
+            if self.tree is None:
+                ranges = (
+                    (day_range(start, end), user_id)
+                    for user_id, start, end in db.session.query(
+                        Unavailability.user_id,
+                        Unavailability.start_range_date,
+                        Unavailability.end_range_date,
+                    )
+                )
+                self.tree = IntervalTree(
+                    days + (user_id,) for days, user_id in ranges if days != None
+                )
+            return self.tree
+
+    def available(self, start, end):
+        busy_user_ids = self.get_tree().overlapping(start, end)
+
+        if not busy_user_ids:
+            return true()
+
+        return ~User.id.in_(sorted(busy_user_ids))
+
+    def invalidate(self):
+        with self.lock:
+            self.tree = None
+
+
+_in_memory_availability = InMemoryAvailability()
+
+
+def get_availability_backend():
+    """Returns the backend for the database the app is connected to."""
+
+    if db.engine.dialect.name == "postgresql":
+        return PostgresAvailability()
+
+    return _in_memory_availability
+
+
+def available_artists_query(start, end=None, **search):
+    """Returns artist_search_query(**search) narrowed to artists with no
+    unavailability between the days of start and end."""
+
+    start, end = day_range(start, end)
+
+    return artist_search_query(**search).filter(
+        get_availability_backend().available(start, end)
+    )
+
+
+def gig_artists_query(gig, **search):
+    """Artists free for all of a gig's days. A gig without dates leaves
+    every artist in."""
+
+    if gig.gig_date_start == None:
+        return artist_search_query(**search)
+
+    return available_artists_query(gig.gig_date_start, gig.gig_date_end, **search)
+
+
+@event.listens_for(Unavailability, "after_insert")
+@event.listens_for(Unavailability, "after_update")
+@event.listens_for(Unavailability, "after_delete")
+def _unavailability_changed(mapper, connection, target):
+    _in_memory_availability.invalidate()
+    # And again once committed, in case another thread rebuilt it meanwhile
+    object_session(target).info["unavailability_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    if session.info.pop("unavailability_changed", False):
+        _in_memory_availability.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_changes(session):
+    if session.info.pop("unavailability_changed", False):
+        _in_memory_availability.invalidate()
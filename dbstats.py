@@ -0,0 +1,79 @@
+"""BayArt - Bay Area Art Connection Project: SQL statements per request
+
+Every statement sent to the database during a request is counted and timed on
+flask.g, along with the ORM objects loaded. requeststats.py reports them.
+When QUERY_BUDGET is set (tests set it), a request that runs more statements
+than that fails with QueryBudgetExceeded, which catches N+1 loading in
+listing templates.
+"""
+
+import time
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+
+class QueryBudgetExceeded(Exception):
+    """A request ran more SQL statements than QUERY_BUDGET allows."""
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        g.query_count = g.get("query_count", 0) + 1
+        context.query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _time_statement(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "query_started", None)
+    if started is not None and has_app_context():
+        g.query_time = g.get("query_time", 0.0) + time.perf_counter() - started
+
+
+@event.listens_for(Mapper, "load")
+def _count_loaded(target, context):
+    if has_app_context():
+        g.rows_loaded = g.get("rows_loaded", 0) + 1
+
+
+def request_query_count():
+    """Returns the number of statements run so far in this request."""
+
+    return g.get("query_count", 0)
+
+
+def request_query_time():
+    """Returns the seconds spent running statements so far in this request."""
+
+    return g.get("query_time", 0.0)
+
+
+def request_rows_loaded():
+    """Returns the number of ORM objects loaded so far in this request."""
+
+    return g.get("rows_loaded", 0)
+
+
+def init_query_budget(app):
+    """Starts each request's count at zero and enforces QUERY_BUDGET."""
+
+    app.config.setdefault("QUERY_BUDGET", None)
+
+    @app.before_request
+    def reset_query_count():
+        g.query_count = 0
+        g.query_time = 0.0
+        g.rows_loaded = 0
+
+    @app.after_request
+    def check_query_budget(response):
+        budget = app.config["QUERY_BUDGET"]
+        if budget is not None and request_query_count() > budget:
+            raise QueryBudgetExceeded(
+                f"{request.endpoint} ran {request_query_count()} SQL statements, "
+                f"over the budget of {budget}"
+            )
+        return response
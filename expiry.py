@@ -0,0 +1,121 @@
+"""BayArt - Bay Area Art Connection Project: gig expiry job
+
+Gigs are deactivated two days after they end (or start, if they have no end
+date). This runs as one UPDATE, either from the command line:
+
+    FLASK_APP=server.py flask expire-gigs
+
+or every GIG_EXPIRY_INTERVAL seconds on a background thread. Every server
+worker runs that thread, so on PostgreSQL each run first takes a
+transaction-level advisory lock; a worker that finds it taken skips its turn
+instead of repeating the work.
+
+The same transaction takes the gigs out of the search facet counts and
+drops their suggested artists.
+"""
+
+import threading
+from datetime import datetime, timedelta
+
+from model import db, Post, ArtistMatch
+from facets import add_facet_counts, post_facet_counts, rebuild_facet_counts
+
+EXPIRE_AFTER = timedelta(days=2)
+
+# pg_try_advisory_xact_lock key; any number no other job in this database uses
+EXPIRY_LOCK_ID = 7301
+
+
+def expired_post_ids(cutoff):
+    """Returns a query for the ids of active gigs that ended before cutoff.
+    Each branch is a range scan on its own partial index
+    (ix_posts_active_gig_date_end, ix_posts_active_gig_date_start)."""
+
+    ended = db.session.query(Post.post_id).filter(
+        Post.active == True, Post.gig_date_end < cutoff
+    )
+    started = db.session.query(Post.post_id).filter(
+        Post.active == True, Post.gig_date_end == None, Post.gig_date_start < cutoff
+    )
+
+    return ended.union_all(started)
+
+
+def _take_expiry_lock():
+    """Returns False if another process is expiring gigs right now. The lock
+    is held until the transaction ends."""
+
+    if db.engine.dialect.name != "postgresql":
+        return True
+
+    return db.session.execute(
+        db.select([db.func.pg_try_advisory_xact_lock(EXPIRY_LOCK_ID)])
+    ).scalar()
+
+
+def expire_gigs(now=None):
+    """Marks every active gig that is over as inactive, in one UPDATE, takes
+    them out of the search facet counts and drops their suggested artists.
+    Returns the number of gigs deactivated, which is 0 when another process
+    is already doing it."""
+
+    if now is None:
+        now = datetime.now()
+
+    if not _take_expiry_lock():
+        db.session.rollback()
+        return 0
+
+    post_ids = [post_id for post_id, in expired_post_ids(now - EXPIRE_AFTER)]
+    if not post_ids:
+        db.session.commit()
+        return 0
+
+    # The UPDATE skips the ORM, and so the flush hooks in facets.py and
+    # matching.py
+    removed = post_facet_counts(post_ids)
+
+    expired = Post.query.filter(
+        Post.post_id.in_(post_ids), Post.active == True
+    ).update({Post.active: False}, synchronize_session=False)
+
+    # Every one of post_ids is inactive now, whoever changed it
+    ArtistMatch.query.filter(ArtistMatch.post_id.in_(post_ids)).delete(
+        synchronize_session=False
+    )
+
+    # Short only if a gig was edited or deleted between the select and the UPDATE
+    if expired == len(post_ids):
+        add_facet_counts(
+            db.session.connection(), {key: -count for key, count in removed.items()}
+        )
+        db.session.commit()
+    else:
+        # Which of them were still counted is unclear, so count again
+        db.session.commit()
+        rebuild_facet_counts()
+
+    return expired
+
+
+def start_expiry_timer(app, interval):
+    """Runs expire_gigs every interval seconds on a daemon thread.
+    Returns the threading.Event that stops it when set."""
+
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            with app.app_context():
+                try:
+                    expire_gigs()
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error("Gig expiry failed: %s", e)
+                finally:
+                    db.session.remove()
+
+    thread = threading.Thread(target=run, name="gig-expiry", daemon=True)
+    thread.start()
+
+    return stopped
@@ -0,0 +1,178 @@
+"""BayArt - Bay Area Art Connection Project: query plan check
+
+Runs EXPLAIN on the listing, search and expiry queries and checks that each
+one uses the index added for it (see the Indexes section of model.py).
+Sequential scans are switched off first, so small development databases
+plan the way a full one would.
+
+    python3 explain_check.py
+"""
+
+import sys
+from datetime import datetime
+
+from model import connect_to_db, db, User, Post
+from search import gig_search_query, artist_search_query
+from pagination import keyset_query
+from expiry import EXPIRE_AFTER, expired_post_ids
+from matching import MATCHES_PER_POST, suggested_artists_query
+
+PAGE_SIZE = 50
+
+
+def listing_checks():
+    """Returns (name, query, index names any of which may serve it)."""
+
+    cutoff = datetime.now() - EXPIRE_AFTER
+
+    return [
+        (
+            "/gigs, paid only",
+            keyset_query(
+                gig_search_query(show_unpaid=False),
+                Post.creation_date,
+                Post.post_id,
+                None,
+                PAGE_SIZE,
+            ),
+            ["ix_posts_active_paid_listing", "ix_posts_active_listing"],
+        ),
+        (
+            "/gigs, with unpaid",
+            keyset_query(
+                gig_search_query(show_unpaid=True),
+                Post.creation_date,
+                Post.post_id,
+                None,
+                PAGE_SIZE,
+            ),
+            ["ix_posts_active_listing"],
+        ),
+        (
+            "/seeownposts",
+            keyset_query(
+                gig_search_query(user_id=1),
+                Post.creation_date,
+                Post.post_id,
+                None,
+                PAGE_SIZE,
+            ),
+            ["ix_posts_user_id", "ix_posts_active_listing"],
+        ),
+        (
+            "/artists",
+            keyset_query(
+                artist_search_query(), User.last_active, User.id, None, PAGE_SIZE
+            ),
+            ["ix_users_artist_listing"],
+        ),
+        (
+            "gig search by tag",
+            gig_search_query(tag_ids=[1]).limit(PAGE_SIZE),
+            ["posts_tags_pkey", "sqlite_autoindex_posts_tags_1"],
+        ),
+        (
+            "artist search by tag",
+            artist_search_query(tag_ids=[1]).limit(PAGE_SIZE),
+            ["users_tags_pkey", "sqlite_autoindex_users_tags_1"],
+        ),
+        (
+            "artist search by weekday",
+            artist_search_query(days_all=[0, 6]).limit(PAGE_SIZE),
+            ["ix_users_artist_days_mask", "ix_users_artist_listing"],
+        ),
+        (
+            "suggested artists for a gig",
+            suggested_artists_query(1).limit(MATCHES_PER_POST),
+            [
+                "ix_artist_matches_post_score",
+                "artist_matches_pkey",
+                "sqlite_autoindex_artist_matches_1",
+            ],
+        ),
+        (
+            "gig search by distance",
+            gig_search_query(
+                zipcodes={94608: 0.0, 94609: 1.2}, nearest_first=True
+            ).limit(PAGE_SIZE),
+            ["ix_posts_zipcode"],
+        ),
+        (
+            "artist search by distance",
+            artist_search_query(
+                zipcodes={94608: 0.0, 94609: 1.2}, nearest_first=True
+            ).limit(PAGE_SIZE),
+            ["ix_users_zipcode"],
+        ),
+        (
+            "gig search by region",
+            gig_search_query(region="East Bay").limit(PAGE_SIZE),
+            ["ix_zipcodes_region"],
+        ),
+        (
+            "gig expiry",
+            expired_post_ids(cutoff),
+            ["ix_posts_active_gig_date_end"],
+        ),
+    ]
+
+
+def explain(query):
+    """Returns the database's query plan for a Query, as text."""
+
+    dialect = db.engine.dialect
+    compiled = query.statement.compile(dialect=dialect)
+    cursor = db.session.connection().connection.cursor()
+
+    if dialect.name == "sqlite":
+        cursor.execute(
+            "EXPLAIN QUERY PLAN " + str(compiled),
+            tuple(compiled.params[name] for name in compiled.positiontup),
+        )
+    else:
+        cursor.execute("EXPLAIN " + str(compiled), compiled.params)
+
+    plan = "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
+    cursor.close()
+
+    return plan
+
+
+def run_checks(verbose=False):
+    """EXPLAINs every listing query. Returns the names of those whose plan
+    uses none of their indexes."""
+
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute("SET LOCAL enable_seqscan = off")
+
+    failures = []
+
+    for name, query, index_names in listing_checks():
+        plan = explain(query)
+        uses_index = any(index_name in plan for index_name in index_names)
+
+        if not uses_index:
+            failures.append(name)
+
+        if verbose or not uses_index:
+            print(f"{'ok  ' if uses_index else 'FAIL'} {name}")
+            print("     " + plan.replace("\n", "\n     "))
+
+    db.session.rollback()
+
+    return failures
+
+
+if __name__ == "__main__":
+    from server import app
+
+    connect_to_db(app)
+
+    with app.app_context():
+        failures = run_checks(verbose="-v" in sys.argv)
+
+    if failures:
+        print(f"{len(failures)} queries do not use their index.")
+        sys.exit(1)
+
+    print("All listing queries use their indexes.")
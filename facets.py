@@ -0,0 +1,314 @@
+"""BayArt - Bay Area Art Connection Project: search facet counts
+
+The advanced search pages show how many active gigs and verified artists
+each choice would match:
+
+    gigs     by tag, by region, and paid or unpaid
+    artists  by tag
+
+Artists are searched by distance rather than by region, so they have no
+region counts.
+
+The counts live in the search_facets table, one row per (kind, facet,
+value). Pages read them with a single select and never aggregate.
+
+Every flush that adds, changes or removes a Post or User works out the
+facets it had before and after, and adds the difference to the stored
+counts in the same transaction. The counts commit or roll back along with
+the change. Bulk UPDATEs skip the ORM, so they adjust the counts
+themselves (see expiry.py) or rebuild them. The rebuild runs one grouped
+query per facet:
+
+    FLASK_APP=server.py flask refresh-facets
+"""
+
+from collections import Counter
+
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from model import db, User, Post, Zipcode, SearchFacet, posts_tags, users_tags
+
+GIGS = "gigs"
+ARTISTS = "artists"
+
+# Changes to these attributes can move a post or user between facets
+POST_FIELDS = ("active", "unpaid", "zipcode", "tags")
+USER_FIELDS = ("is_artist", "verified", "tags")
+
+
+def _pay_value(unpaid):
+    # Column default, for posts that never set it
+    if unpaid == None:
+        unpaid = True
+
+    return "unpaid" if unpaid else "paid"
+
+
+def _post_facets(values, regions):
+    active, unpaid, zipcode, tags = values
+
+    if active == False:
+        return []
+
+    facets = [(GIGS, "tag", str(tag.tag_id)) for tag in tags]
+    if zipcode in regions:
+        facets.append((GIGS, "region", regions[zipcode]))
+    facets.append((GIGS, "pay", _pay_value(unpaid)))
+
+    return facets
+
+
+def _user_facets(values, regions):
+    is_artist, verified, tags = values
+
+    if not (is_artist and verified):
+        return []
+
+    return [(ARTISTS, "tag", str(tag.tag_id)) for tag in tags]
+
+
+def _before_and_after(instance, fields):
+    """Returns each field's value before and after the flush, as two lists."""
+
+    state = inspect(instance)
+    before = []
+    after = []
+
+    for field in fields:
+        if field not in state.dict:
+            # Never loaded, so unchanged
+            value = getattr(instance, field)
+            before.append(value)
+            after.append(value)
+            continue
+
+        history = state.attrs[field].history
+
+        if state.mapper.relationships.get(field) is not None:
+            before.append(list(history.unchanged) + list(history.deleted))
+            after.append(list(history.unchanged) + list(history.added))
+        else:
+            unchanged = history.unchanged[0] if history.unchanged else None
+            before.append(history.deleted[0] if history.deleted else unchanged)
+            after.append(history.added[0] if history.added else unchanged)
+
+    return before, after
+
+
+def _changed(instance, fields):
+    state = inspect(instance)
+    return any(state.attrs[field].history.has_changes() for field in fields)
+
+
+def _regions(connection, zipcodes):
+    zipcodes = set(zipcode for zipcode in zipcodes if zipcode != None)
+    if not zipcodes:
+        return {}
+
+    rows = connection.execute(
+        db.select([Zipcode.valid_zipcode, Zipcode.region]).where(
+            Zipcode.valid_zipcode.in_(zipcodes)
+        )
+    )
+    return dict(rows.fetchall())
+
+
+def add_facet_counts(connection, deltas):
+    """Adds deltas, a {(kind, facet, value): change} dict, to the stored
+    counts. Rows are written in key order, so concurrent writers can't
+    deadlock on them."""
+
+    table = SearchFacet.__table__
+
+    for (kind, facet, value), delta in sorted(deltas.items()):
+        if delta == 0:
+            continue
+
+        if connection.dialect.name == "postgresql":
+            connection.execute(
+                pg_insert(table)
+                .values(kind=kind, facet=facet, value=value, count=delta)
+                .on_conflict_do_update(
+                    index_elements=[table.c.kind, table.c.facet, table.c.value],
+                    set_={"count": table.c.count + delta},
+                )
+            )
+            continue
+
+        updated = connection.execute(
+            table.update()
+            .where(
+                (table.c.kind == kind)
+                & (table.c.facet == facet)
+                & (table.c.value == value)
+            )
+            .values(count=table.c.count + delta)
+        )
+        if updated.rowcount == 0:
+            connection.execute(
+                table.insert().values(kind=kind, facet=facet, value=value, count=delta)
+            )
+
+
+@event.listens_for(Session, "after_flush")
+def _count_flushed_changes(session, flush_context):
+    # new, dirty and deleted still hold what was just flushed, along with
+    # each attribute's history
+    changes = []
+
+    for instance in session.new:
+        if isinstance(instance, (Post, User)):
+            changes.append((instance, False, True))
+
+    for instance in session.dirty:
+        if isinstance(instance, Post) and _changed(instance, POST_FIELDS):
+            changes.append((instance, True, True))
+        elif isinstance(instance, User) and _changed(instance, USER_FIELDS):
+            changes.append((instance, True, True))
+
+    for instance in session.deleted:
+        if isinstance(instance, (Post, User)):
+            changes.append((instance, True, False))
+
+    if not changes:
+        return
+
+    # (facets function, values before or None, values after or None)
+    values = []
+    zipcodes = set()
+
+    for instance, existed, exists in changes:
+        if isinstance(instance, Post):
+            fields, facets_of = POST_FIELDS, _post_facets
+        else:
+            fields, facets_of = USER_FIELDS, _user_facets
+
+        before, after = _before_and_after(instance, fields)
+        if not existed:
+            before = None
+        if not exists:
+            after = None
+
+        values.append((facets_of, before, after))
+        if "zipcode" in fields:
+            for state in (before, after):
+                if state is not None:
+                    zipcodes.add(state[fields.index("zipcode")])
+
+    connection = session.connection()
+    regions = _regions(connection, zipcodes)
+
+    deltas = Counter()
+    for facets_of, before, after in values:
+        if before is not None:
+            deltas.subtract(facets_of(before, regions))
+        if after is not None:
+            deltas.update(facets_of(after, regions))
+
+    add_facet_counts(connection, deltas)
+
+
+def _load_old_value(target, value, oldvalue, initiator):
+    pass
+
+
+# Without active history, setting an attribute that was never loaded leaves
+# its old value unknown, and the facet it was counted in would keep it
+for _attribute in (
+    Post.active,
+    Post.unpaid,
+    Post.zipcode,
+    User.is_artist,
+    User.verified,
+):
+    event.listen(_attribute, "set", _load_old_value, active_history=True)
+
+
+def post_facet_counts(post_ids=None):
+    """Returns the facet Counter of every active post, or of the active
+    ones among post_ids."""
+
+    counts = Counter()
+
+    active = Post.active == True
+    if post_ids is not None:
+        if not post_ids:
+            return counts
+        active = active & Post.post_id.in_(post_ids)
+
+    for tag_id, count in (
+        db.session.query(posts_tags.c.tag_id, db.func.count())
+        .join(Post, Post.post_id == posts_tags.c.post_id)
+        .filter(active)
+        .group_by(posts_tags.c.tag_id)
+    ):
+        counts[(GIGS, "tag", str(tag_id))] += count
+
+    for region, count in (
+        db.session.query(Zipcode.region, db.func.count())
+        .join(Post, Post.zipcode == Zipcode.valid_zipcode)
+        .filter(active)
+        .group_by(Zipcode.region)
+    ):
+        counts[(GIGS, "region", region)] += count
+
+    for unpaid, count in (
+        db.session.query(Post.unpaid, db.func.count()).filter(active).group_by(Post.unpaid)
+    ):
+        counts[(GIGS, "pay", _pay_value(unpaid))] += count
+
+    return counts
+
+
+def _all_facet_counts():
+    counts = post_facet_counts()
+
+    artist = (User.is_artist == True) & (User.verified == True)
+
+    for tag_id, count in (
+        db.session.query(users_tags.c.tag_id, db.func.count())
+        .join(User, User.id == users_tags.c.user_id)
+        .filter(artist)
+        .group_by(users_tags.c.tag_id)
+    ):
+        counts[(ARTISTS, "tag", str(tag_id))] += count
+
+    return counts
+
+
+def rebuild_facet_counts():
+    """Recounts every facet from scratch, in one transaction. Returns the
+    number of facets counted."""
+
+    try:
+        counts = _all_facet_counts()
+
+        db.session.query(SearchFacet).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(
+            SearchFacet,
+            [
+                {"kind": kind, "facet": facet, "value": value, "count": count}
+                for (kind, facet, value), count in sorted(counts.items())
+                if count
+            ],
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return len(counts)
+
+
+def get_facet_counts(kind):
+    """Returns {facet: {value: count}} for "gigs" or "artists"."""
+
+    facets = {}
+    for facet, value, count in db.session.query(
+        SearchFacet.facet, SearchFacet.value, SearchFacet.count
+    ).filter(SearchFacet.kind == kind):
+        facets.setdefault(facet, {})[value] = count
+
+    return facets
@@ -0,0 +1,234 @@
+"""BayArt - Bay Area Art Connection Project: full-text search for gigs and artists
+
+On PostgreSQL, posts and users carry a search_vector tsvector column with a
+GIN index. Triggers keep it current, and queries are ranked with ts_rank.
+Other databases, such as SQLite in tests, use an in-memory inverted index
+instead. It is built on first use and kept current by mapper events, whose
+changes are held back until the session commits.
+"""
+
+import math
+import re
+import threading
+
+from sqlalchemy import case, event, false
+from sqlalchemy.orm import Session, object_session
+
+from model import db, User, Post
+
+SEARCH_CONFIG = "english"
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in",
+    "is", "it", "of", "on", "or", "that", "the", "to", "with",
+}
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Splits text into lowercase words, without stop words."""
+
+    return [
+        word for word in WORD_RE.findall((text or "").lower()) if word not in STOP_WORDS
+    ]
+
+
+class InvertedIndex(object):
+    """Maps each word to the ids of the rows containing it, with counts."""
+
+    def __init__(self):
+        self.postings = {}
+        self.row_words = {}
+        self.lock = threading.Lock()
+
+    def add(self, row_id, text):
+        """Indexes a row, replacing whatever was indexed for it before."""
+
+        counts = {}
+        for word in tokenize(text):
+            counts[word] = counts.get(word, 0) + 1
+
+        with self.lock:
+            self._remove(row_id)
+            for word, count in counts.items():
+                self.postings.setdefault(word, {})[row_id] = count
+            self.row_words[row_id] = list(counts)
+
+    def remove(self, row_id):
+        with self.lock:
+            self._remove(row_id)
+
+    def _remove(self, row_id):
+        for word in self.row_words.pop(row_id, []):
+            postings = self.postings[word]
+            postings.pop(row_id, None)
+            if not postings:
+                del self.postings[word]
+
+    def search(self, text):
+        """Returns {row_id: score} for rows containing every word of text,
+        scored by tf-idf."""
+
+        words = tokenize(text)
+        if words == []:
+            return {}
+
+        with self.lock:
+            row_count = len(self.row_words) or 1
+            scores = None
+
+            for word in set(words):
+                postings = self.postings.get(word, {})
+                idf = math.log(1 + row_count / (1 + len(postings)))
+                word_scores = {
+                    row_id: count * idf for row_id, count in postings.items()
+                }
+
+                if scores is None:
+                    scores = word_scores
+                else:
+                    scores = {
+                        row_id: score + word_scores[row_id]
+                        for row_id, score in scores.items()
+                        if row_id in word_scores
+                    }
+
+        return scores or {}
+
+
+def post_search_text(post):
+    return " ".join([post.post_title or "", post.description or ""])
+
+
+def user_search_text(user):
+    return " ".join([user.user_name or "", user.bio or ""])
+
+
+class PostgresSearch(object):
+    """Matches and ranks on the search_vector columns."""
+
+    def filter(self, query, column, id_column, text):
+        tsquery = db.func.plainto_tsquery(SEARCH_CONFIG, text)
+        return query.filter(column.op("@@")(tsquery)), db.func.ts_rank(
+            column, tsquery
+        ).desc()
+
+
+class InMemorySearch(object):
+    """Matches and ranks with an InvertedIndex per table."""
+
+    def __init__(self):
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def index_for(self, model):
+        """Returns the index for Post or User, loading it on first use."""
+
+        if model not in self.indexes:
+            with self.lock:
+                if model not in self.indexes:
+                    index = InvertedIndex()
+                    if model is Post:
+                        for post in db.session.query(
+                            Post.post_id, Post.post_title, Post.description
+                        ):
+                            index.add(post.post_id, post_search_text(post))
+                    else:
+                        for user in db.session.query(User.id, User.user_name, User.bio):
+                            index.add(user.id, user_search_text(user))
+                    self.indexes[model] = index
+
+        return self.indexes[model]
+
+    def filter(self, query, column, id_column, text):
+        model = Post if column is Post.search_vector else User
+        scores = self.index_for(model).search(text)
+
+        if scores == {}:
+            return query.filter(false()), id_column.desc()
+
+        return (
+            query.filter(id_column.in_(list(scores))),
+            case(
+                [(id_column == row_id, score) for row_id, score in scores.items()],
+                else_=0,
+            ).desc(),
+        )
+
+    def update(self, model, row_id, text):
+        if model in self.indexes:
+            self.indexes[model].add(row_id, text)
+
+    def remove(self, model, row_id):
+        if model in self.indexes:
+            self.indexes[model].remove(row_id)
+
+
+_in_memory_search = InMemorySearch()
+
+
+def get_search_backend():
+    """Returns the backend for the database the app is connected to."""
+
+    if db.engine.dialect.name == "postgresql":
+        return PostgresSearch()
+
+    return _in_memory_search
+
+
+def search_posts(query, text):
+    """Narrows a Post query to posts matching text.
+    Returns the query and a relevance ordering to put first."""
+
+    return get_search_backend().filter(query, Post.search_vector, Post.post_id, text)
+
+
+def search_users(query, text):
+    """Narrows a User query to users matching text.
+    Returns the query and a relevance ordering to put first."""
+
+    return get_search_backend().filter(query, User.search_vector, User.id, text)
+
+
+def _stage(target, model, row_id, text):
+    # Applied once committed, so rolled-back edits never become searchable.
+    # None means the row was deleted.
+    changes = object_session(target).info.setdefault("search_index_changes", {})
+    changes[(model, row_id)] = text
+
+
+@event.listens_for(Post, "after_insert")
+@event.listens_for(Post, "after_update")
+def _index_post(mapper, connection, post):
+    _stage(post, Post, post.post_id, post_search_text(post))
+
+
+@event.listens_for(Post, "after_delete")
+def _unindex_post(mapper, connection, post):
+    _stage(post, Post, post.post_id, None)
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+def _index_user(mapper, connection, user):
+    _stage(user, User, user.id, user_search_text(user))
+
+
+@event.listens_for(User, "after_delete")
+def _unindex_user(mapper, connection, user):
+    _stage(user, User, user.id, None)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_after_commit(session):
+    for (model, row_id), text in session.info.pop("search_index_changes", {}).items():
+        if text is None:
+            _in_memory_search.remove(model, row_id)
+        else:
+            _in_memory_search.update(model, row_id, text)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_changes(session):
+    session.info.pop("search_index_changes", None)
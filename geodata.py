@@ -0,0 +1,357 @@
+"""BayArt - Bay Area Art Connection Project: zipcode geometry for gig maps
+
+The two geojson files in static/ are read once, the first time a map needs
+them, and every zipcode polygon is indexed with its area, zoom and center.
+Zipcodes without a polygon fall back to a FeatureCollection for their whole
+city or region, which is also merged once and then kept.
+
+Pages don't inline these shapes; /geometry/<kind>/<name> serves them as
+simplified, rounded JSON that browsers and nginx can cache.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+GEOJSON_SOURCES = [
+    # (file name, property holding the zipcode)
+    ("baysuburbs.geojson", "zip"),
+    ("sanjosesuburbs.geojson", "ZCTA"),
+]
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+DEFAULT_MAPZOOM = 8
+DEFAULT_MAPCENTER = [-122.241026, 37.767857]
+
+_zip_index = None
+_area_collections = None
+_geometry_json = {}
+_index_lock = threading.RLock()
+
+
+def zoom_for_area(square_meters):
+    """Returns the mapbox zoom level that fits a polygon of the given area."""
+
+    if square_meters > 50000000:
+        # Area is Large. Greater than fifty million (X2, 345, 678)
+        return 8
+    elif square_meters > 10000000:
+        # Area is Medium. Greater than ten million (X2, 345, 678)
+        return 9
+    elif square_meters > 1500000:
+        # Area is Small. Greater than one million, 500 thousand (X, 234, 567)
+        return 10
+    else:
+        # Area is Tiny. Less than one million, 500 thousand (X, 234, 567)
+        return 11
+
+
+def first_point(geometry):
+    """Returns the first [lng, lat] pair of a Polygon or MultiPolygon.
+    The gig map has always centered on this point."""
+
+    coordinates = geometry["coordinates"][0][0]
+
+    if type(coordinates[0]) is list:
+        # MultiPolygon: one more level of nesting
+        coordinates = coordinates[0]
+
+    return coordinates
+
+
+def _ring_centroid(ring):
+    """Returns (signed area, lng, lat) of a closed ring of [lng, lat]
+    points, treated as flat. Bay Area zipcodes are small enough for that."""
+
+    twice_area = 0.0
+    lng_sum = 0.0
+    lat_sum = 0.0
+
+    for (lng1, lat1), (lng2, lat2) in zip(ring, ring[1:]):
+        cross = lng1 * lat2 - lng2 * lat1
+        twice_area += cross
+        lng_sum += (lng1 + lng2) * cross
+        lat_sum += (lat1 + lat2) * cross
+
+    if twice_area == 0:
+        return 0.0, ring[0][0], ring[0][1]
+
+    return twice_area / 2, lng_sum / (3 * twice_area), lat_sum / (3 * twice_area)
+
+
+def polygon_centroid(geometry):
+    """Returns the (latitude, longitude) center of a Polygon or MultiPolygon,
+    weighting each part's outer ring by its area."""
+
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    else:
+        polygons = geometry["coordinates"]
+
+    total = 0.0
+    lng_total = 0.0
+    lat_total = 0.0
+
+    for polygon in polygons:
+        ring_area, lng, lat = _ring_centroid(polygon[0])
+        ring_area = abs(ring_area)
+        total += ring_area
+        lng_total += lng * ring_area
+        lat_total += lat * ring_area
+
+    if total == 0:
+        lng, lat = first_point(geometry)[:2]
+        return lat, lng
+
+    return lat_total / total, lng_total / total
+
+
+def zipcode_centroids():
+    """Returns {zipcode string: (latitude, longitude)} for every zipcode
+    with a polygon. The San Jose file gives its own LATITUDE/LONGITUDE;
+    the rest are worked out from the polygon."""
+
+    centroids = {}
+
+    for zipcode, zip_geometry in get_zip_index().items():
+        feature = zip_geometry["feature"]
+        properties = feature["properties"]
+
+        if properties.get("LATITUDE") != None and properties.get("LONGITUDE") != None:
+            centroids[zipcode] = (properties["LATITUDE"], properties["LONGITUDE"])
+        else:
+            centroids[zipcode] = polygon_centroid(feature["geometry"])
+
+    return centroids
+
+
+def _build_zip_index():
+    """Reads both geojson files and indexes their features by zipcode."""
+
+    # Only needed while building the index
+    from area import area
+
+    index = {}
+
+    for file_name, zip_property in GEOJSON_SOURCES:
+        with open(os.path.join(STATIC_DIR, file_name)) as json_file:
+            data = json.load(json_file)
+
+        for feature in data["features"]:
+            geometry = feature["geometry"]
+            feature_area = area(geometry)
+            # Later files win, same as the old per-request scan.
+            index[str(feature["properties"][zip_property])] = {
+                "feature": feature,
+                "area": feature_area,
+                "mapzoom": zoom_for_area(feature_area),
+                "mapcenter": first_point(geometry),
+            }
+
+    return index
+
+
+def get_zip_index():
+    """Returns the zipcode -> geometry index, building it on first use."""
+
+    global _zip_index
+
+    if _zip_index is None:
+        with _index_lock:
+            if _zip_index is None:
+                _zip_index = _build_zip_index()
+
+    return _zip_index
+
+
+def get_zip_geometry(zipcode):
+    """Returns the indexed entry for one zipcode, or None if it has no polygon.
+    Entries hold "feature", "area", "mapzoom" and "mapcenter"."""
+
+    return get_zip_index().get(str(zipcode))
+
+
+def _build_area_collections():
+    """Merges the zipcode polygons into one FeatureCollection per
+    Zipcode.location_name and one per Zipcode.region."""
+
+    from model import db, Zipcode
+
+    zip_index = get_zip_index()
+    collections = {"location": {}, "region": {}}
+
+    zip_rows = (
+        db.session.query(Zipcode.valid_zipcode, Zipcode.location_name, Zipcode.region)
+        .order_by(Zipcode.valid_zipcode)
+        .all()
+    )
+
+    for valid_zipcode, location_name, region in zip_rows:
+        zip_geometry = zip_index.get(str(valid_zipcode))
+        if zip_geometry == None:
+            continue
+
+        for kind, name in [("location", location_name), ("region", region)]:
+            if name not in collections[kind]:
+                collections[kind][name] = {
+                    "zipdata": {"type": "FeatureCollection", "features": []},
+                    "mapzoom": DEFAULT_MAPZOOM,
+                    # Centered on the first zipcode, like a single zip map
+                    "mapcenter": zip_geometry["mapcenter"],
+                }
+            collections[kind][name]["zipdata"]["features"].append(
+                zip_geometry["feature"]
+            )
+
+    return collections
+
+
+def get_area_geometry(kind, name):
+    """Returns the merged geometry for a city ("location") or a region,
+    or None if none of its zipcodes has a polygon.
+    Entries hold "zipdata", "mapzoom" and "mapcenter".
+    Needs an app context the first time, to read the zipcodes table."""
+
+    global _area_collections
+
+    if _area_collections is None:
+        with _index_lock:
+            if _area_collections is None:
+                _area_collections = _build_area_collections()
+
+    return _area_collections[kind].get(name)
+
+
+def load_geometry():
+    """Builds the zipcode index and the city/region collections up front,
+    so the first gig page doesn't pay for it."""
+
+    get_zip_index()
+    get_area_geometry("region", None)
+
+
+def reset_area_collections():
+    """Drops the merged city and region geometry, e.g. after reseeding zipcodes."""
+
+    global _area_collections
+
+    with _index_lock:
+        _area_collections = None
+        _geometry_json.clear()
+
+
+def _perpendicular_distance(point, start, end):
+    """Distance from point to the line through start and end, in degrees."""
+
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+
+    if dx == 0 and dy == 0:
+        return ((point[0] - start[0]) ** 2 + (point[1] - start[1]) ** 2) ** 0.5
+
+    return abs(dy * point[0] - dx * point[1] + end[0] * start[1] - end[1] * start[0]) / (
+        (dx ** 2 + dy ** 2) ** 0.5
+    )
+
+
+def simplify_ring(ring, tolerance):
+    """Douglas-Peucker simplification of one closed ring.
+    Rings are never reduced below four points, so they stay valid polygons."""
+
+    if tolerance <= 0 or len(ring) <= 4:
+        return ring
+
+    keep = [False] * len(ring)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(ring) - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        max_distance = 0
+        max_index = first
+
+        for i in range(first + 1, last):
+            distance = _perpendicular_distance(ring[i], ring[first], ring[last])
+            if distance > max_distance:
+                max_distance = distance
+                max_index = i
+
+        if max_distance > tolerance:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+
+    simplified = [point for point, kept in zip(ring, keep) if kept]
+
+    if len(simplified) < 4:
+        return ring
+
+    return simplified
+
+
+def simplify_geometry(geometry, tolerance, precision):
+    """Returns a copy of a Polygon or MultiPolygon with every ring simplified
+    and every coordinate rounded to the given number of decimals."""
+
+    def simplify_polygon(polygon):
+        return [
+            [
+                [round(lng, precision), round(lat, precision)]
+                for lng, lat in simplify_ring(ring, tolerance)
+            ]
+            for ring in polygon
+        ]
+
+    if geometry["type"] == "MultiPolygon":
+        coordinates = [simplify_polygon(polygon) for polygon in geometry["coordinates"]]
+    else:
+        coordinates = simplify_polygon(geometry["coordinates"])
+
+    return {"type": geometry["type"], "coordinates": coordinates}
+
+
+def _simplify_feature(feature, tolerance, precision):
+    return {
+        "type": "Feature",
+        "properties": feature["properties"],
+        "geometry": simplify_geometry(feature["geometry"], tolerance, precision),
+    }
+
+
+def get_geometry_json(kind, name, tolerance, precision):
+    """Returns (body, etag) for the simplified geometry of a "zip", "location"
+    or "region", or None if it has no polygons. Results are kept per
+    tolerance and precision, so each shape is only simplified once."""
+
+    key = (kind, str(name), tolerance, precision)
+
+    if key in _geometry_json:
+        return _geometry_json[key]
+
+    if kind == "zip":
+        zip_geometry = get_zip_geometry(name)
+        features = [zip_geometry["feature"]] if zip_geometry != None else []
+    elif kind in ("location", "region"):
+        area_geometry = get_area_geometry(kind, name)
+        features = area_geometry["zipdata"]["features"] if area_geometry != None else []
+    else:
+        features = []
+
+    if features == []:
+        return None
+
+    collection = {
+        "type": "FeatureCollection",
+        "features": [
+            _simplify_feature(feature, tolerance, precision) for feature in features
+        ],
+    }
+
+    body = json.dumps(collection, separators=(",", ":"))
+    etag = hashlib.md5(body.encode("utf-8")).hexdigest()
+
+    _geometry_json[key] = (body, etag)
+
+    return _geometry_json[key]
@@ -0,0 +1,48 @@
+"""BayArt - Bay Area Art Connection Project: gunicorn settings
+
+Several worker processes, each with a few threads, so one slow page (a gig
+map, a big search) no longer holds up everyone else. Threads help here
+because most of a request is spent waiting on PostgreSQL and S3.
+
+Worker count: start from 2 x CPU cores + 1 and check it with loadtest.py.
+Raise WEB_CONCURRENCY while requests per second keep climbing and p95
+latency stays flat; stop at the first step that adds latency without adding
+throughput. Keep workers x threads under PostgreSQL's max_connections
+divided by the SQLAlchemy pool size.
+
+Reload code and settings without dropping requests:
+
+    sudo systemctl reload flask    (sends HUP to the gunicorn master)
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "127.0.0.1:5000")
+
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+
+# A request taking longer than this is killed and its worker replaced
+timeout = 30
+# How long a worker gets to finish its requests on reload or shutdown
+graceful_timeout = 30
+keepalive = 5
+
+# Replace workers now and then, so a slow leak can't build up
+max_requests = 2000
+max_requests_jitter = 200
+
+# Each worker connects to the database and starts its threads after forking
+preload_app = False
+
+accesslog = "-"
+errorlog = "-"
+
+
+def post_worker_init(worker):
+    # The gig expiry timer and email dispatcher, once per worker
+    from server import start_background_jobs
+
+    start_background_jobs(worker.wsgi)
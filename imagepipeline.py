@@ -0,0 +1,200 @@
+"""BayArt - Bay Area Art Connection Project: background image processing
+
+/uploadimg hands the raw upload to an ImagePipeline and returns right away.
+A small thread pool resizes the image to every VARIANT_SIZES width, in WebP
+and JPEG. It uploads the variants to the image store, then points the user's
+image slot (img_route or an img_port_* column) at them.
+
+Variant keys are derived from the slot's base key, e.g.
+"bode_profilepic_12345678_240.webp", and User.img_variants records which
+sizes and formats exist. Pages call image_keys to pick the smallest variant
+that covers the width they display.
+
+The store is S3 in production. LocalStore writes to a directory instead,
+for tests and development.
+"""
+
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from model import db, User
+
+IMAGE_SLOTS = ("img_route", "img_port_one", "img_port_two", "img_port_three")
+
+# Avatars are 48px, profile pictures and portfolio thumbnails 230px
+VARIANT_SIZES = (64, 240, 800)
+
+# (format, file extension, content type, save options)
+VARIANT_FORMATS = [
+    ("WEBP", "webp", "image/webp", {"quality": 80, "method": 4}),
+    ("JPEG", "jpeg", "image/jpeg", {"quality": 85, "optimize": True, "progressive": True}),
+]
+
+log = logging.getLogger(__name__)
+
+
+class S3Store(object):
+    """Stores images as objects in an S3 bucket."""
+
+    def __init__(self, s3_resource, bucket):
+        self.s3_resource = s3_resource
+        self.bucket = bucket
+
+    def put(self, key, body, content_type):
+        self.s3_resource.Bucket(self.bucket).put_object(
+            Key=key, Body=body, ContentType=content_type
+        )
+
+
+class LocalStore(object):
+    """Stores images as files in a directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def put(self, key, body, content_type):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, key), "wb") as image_file:
+            image_file.write(body)
+
+
+def is_image(raw):
+    """Checks that PIL recognizes the upload. Only the header is read,
+    so this is cheap enough to do in the request."""
+
+    # PIL is imported on the first upload, not when the server starts
+    from PIL import Image
+
+    try:
+        Image.open(io.BytesIO(raw))
+        return True
+    except (IOError, SyntaxError):
+        return False
+
+
+def variant_key(base_key, size, extension):
+    return f"{base_key}_{size}.{extension}"
+
+
+def image_variants(raw):
+    """Yields (size, extension, content type, bytes) for every variant of
+    the upload. Images are only ever shrunk, never enlarged."""
+
+    from PIL import Image, features
+
+    variant_formats = VARIANT_FORMATS
+    if not features.check("webp"):
+        # Pillow built without libwebp: JPEG only
+        variant_formats = [
+            variant_format for variant_format in VARIANT_FORMATS if variant_format[1] != "webp"
+        ]
+
+    image = Image.open(io.BytesIO(raw))
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    # Largest first, so each resize starts from the previous, smaller image
+    for size in sorted(VARIANT_SIZES, reverse=True):
+        image.thumbnail((size, size), Image.LANCZOS)
+
+        for image_format, extension, content_type, options in variant_formats:
+            out = io.BytesIO()
+            image.save(out, format=image_format, **options)
+            yield size, extension, content_type, out.getvalue()
+
+
+def image_keys(user, slot, width):
+    """Returns {"webp": key or None, "jpeg": key} for the smallest variant
+    of a user's image at least width pixels wide (or the largest there is).
+    Images uploaded before variants existed are a single JPEG at the slot's key."""
+
+    base_key = getattr(user, slot)
+    recorded = (user.img_variants or {}).get(slot)
+
+    if not recorded:
+        return {"webp": None, "jpeg": base_key}
+
+    sizes = sorted(recorded["sizes"])
+    size = next((size for size in sizes if size >= width), sizes[-1])
+
+    return {
+        extension: (
+            variant_key(base_key, size, extension)
+            if extension in recorded["formats"]
+            else None
+        )
+        for extension in ("webp", "jpeg")
+    }
+
+
+class ImagePipeline(object):
+    """Processes profile picture uploads on a pool of worker threads."""
+
+    def __init__(self, app, store, workers=2):
+        self.app = app
+        self.store = store
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def _get_executor(self):
+        # Started on first use, so forked server workers each get their own
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="image-pipeline"
+                )
+            return self.executor
+
+    def submit(self, user_id, raw, key, slot="img_route"):
+        """Queues an upload for one of user_id's IMAGE_SLOTS, to be stored
+        under variants of key. Returns a Future that resolves to key."""
+
+        if slot not in IMAGE_SLOTS:
+            raise ValueError(f"Unknown image slot {slot}")
+
+        return self._get_executor().submit(self.process, user_id, raw, key, slot)
+
+    def process(self, user_id, raw, key, slot="img_route"):
+        """Resizes and stores one upload, then records it on the user."""
+
+        try:
+            sizes = set()
+            extensions = set()
+
+            for size, extension, content_type, body in image_variants(raw):
+                self.store.put(variant_key(key, size, extension), body, content_type)
+                sizes.add(size)
+                extensions.add(extension)
+
+            # The app context's teardown removes the thread's session
+            with self.app.app_context():
+                # Locked, so two uploads finishing together both keep their variants
+                user = User.query.with_for_update().get(user_id)
+                setattr(user, slot, key)
+                img_variants = dict(user.img_variants or {})
+                img_variants[slot] = {
+                    "sizes": sorted(sizes),
+                    "formats": sorted(extensions),
+                }
+                # A new dict, so SQLAlchemy sees the change
+                user.img_variants = img_variants
+                db.session.commit()
+
+            return key
+        except Exception:
+            log.exception("Processing image %s for user %s failed", key, user_id)
+            raise
+
+    def shutdown(self, wait=True):
+        """Waits for queued uploads to finish and stops the workers."""
+
+        with self.lock:
+            executor, self.executor = self.executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=wait)
@@ -0,0 +1,95 @@
+"""BayArt - Bay Area Art Connection Project: load test
+
+Sends requests to a running server from many threads at once and reports
+throughput and latency. Run it against gunicorn at a few WEB_CONCURRENCY
+settings to choose the worker count (see gunicorn.conf.py):
+
+    WEB_CONCURRENCY=3 gunicorn -c gunicorn.conf.py wsgi:app
+    python3 loadtest.py --url http://127.0.0.1:5000 --concurrency 32 --duration 30
+
+By default it mixes the listing, search and gig map pages.
+"""
+
+import argparse
+import threading
+import time
+import urllib.error
+import urllib.request
+
+DEFAULT_PATHS = [
+    "/",
+    "/gigs",
+    "/artists",
+    "/gig/1",
+    "/searchgigs?search=music",
+    "/gigs.json",
+]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def run(base_url, paths, concurrency, duration, timeout=30):
+    """Requests paths in turn from concurrency threads for duration seconds.
+    Returns (latencies in seconds, number of errors)."""
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def worker(offset):
+        i = offset
+        while time.time() < deadline:
+            url = base_url + paths[i % len(paths)]
+            i += 1
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(url, timeout=timeout) as response:
+                    response.read()
+                failed = False
+            except (urllib.error.URLError, OSError):
+                failed = True
+            elapsed = time.perf_counter() - started
+
+            with lock:
+                if failed:
+                    errors[0] += 1
+                else:
+                    latencies.append(elapsed)
+
+    threads = [
+        threading.Thread(target=worker, args=(n,), daemon=True)
+        for n in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a running BayArt server.")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("paths", nargs="*", default=DEFAULT_PATHS)
+    args = parser.parse_args()
+
+    latencies, errors = run(args.url, args.paths, args.concurrency, args.duration)
+    latencies.sort()
+
+    print(f"{len(latencies)} requests, {errors} errors in {args.duration:g}s")
+    print(f"{len(latencies) / args.duration:.1f} requests/second")
+    for label, fraction in [("p50", 0.5), ("p95", 0.95), ("p99", 0.99)]:
+        print(f"{label} {percentile(latencies, fraction) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
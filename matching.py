@@ -0,0 +1,666 @@
+"""BayArt - Bay Area Art Connection Project: suggested artists for gigs
+
+Every active post keeps a short list of the verified artists who fit it
+best, in the artist_matches table. A gig page reads its list best first,
+through one indexed query, and never scores anything itself.
+
+An artist's score for a post is a weighted sum (see WEIGHTS) of parts that
+each run from 0 to 1:
+
+    tags    the share of the post's tags the artist also has
+    region  1 for the same place or a remote gig, less for the same region
+    days    the share of the gig's weekdays in the artist's days_mask
+    pay     the pay against the artist's hourly_rate
+
+Lists are rebuilt when what they depend on changes. A committed change to
+one of the POST_FIELDS of a post rescores that post against every artist.
+A change to one of the ARTIST_FIELDS of a user rescores just that user and
+merges them into the stored lists. Only the posts whose lists they could
+enter or leave are scored (see _candidate_post_ids): those sharing a tag
+or a region with them, those already listing them, and those whose lists
+would take a score without either. Both run on MatchRefresher's thread,
+after the commit and a short delay that gathers changes into one batch, so
+the request that made the change doesn't wait. To rebuild everything, for
+example after a restart dropped pending work:
+
+    FLASK_APP=server.py flask refresh-matches
+"""
+
+import heapq
+import threading
+from collections import namedtuple
+from datetime import timedelta
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from model import db, User, Post, Zipcode, ArtistMatch, posts_tags, users_tags
+from weekdays import DAYS
+from zipcodes import REMOTE_ZIPCODE
+
+MATCHES_PER_POST = 12
+
+WEIGHTS = {"tags": 0.4, "region": 0.25, "days": 0.2, "pay": 0.15}
+
+# Same region, different place
+NEARBY_REGION_SCORE = 0.6
+# Flat pay is compared with this many hours at the artist's rate
+ASSUMED_GIG_HOURS = 4
+# Paid gigs with no amount given
+UNKNOWN_PAY_SCORE = 0.5
+
+# The best score possible without a shared tag or region
+UNRELATED_BEST_SCORE = WEIGHTS["days"] + WEIGHTS["pay"]
+
+# Changes to these attributes call for new scores
+POST_FIELDS = (
+    "tags",
+    "zipcode",
+    "pay",
+    "ishourly",
+    "unpaid",
+    "gig_date_start",
+    "gig_date_end",
+    "active",
+    "user_id",
+)
+ARTIST_FIELDS = (
+    "tags",
+    "zipcode",
+    "days_mask",
+    "hourly_rate",
+    "show_unpaid",
+    "is_artist",
+    "verified",
+)
+
+GigProfile = namedtuple(
+    "GigProfile",
+    [
+        "post_id",
+        "user_id",
+        "tag_ids",
+        "zipcode",
+        "location_name",
+        "region",
+        # weekdays the gig falls on, or None for a gig without dates
+        "days_mask",
+        "pay",
+        "ishourly",
+        "unpaid",
+    ],
+)
+
+ArtistProfile = namedtuple(
+    "ArtistProfile",
+    [
+        "user_id",
+        "tag_ids",
+        "zipcode",
+        "location_name",
+        "region",
+        "days_mask",
+        "hourly_rate",
+        "show_unpaid",
+    ],
+)
+
+
+def gig_days_mask(start, end=None):
+    """Returns the days_mask bits of the weekdays from start to end, or
+    None when there is no start date."""
+
+    if start == None:
+        return None
+
+    if end == None or end < start:
+        end = start
+
+    mask = 0
+    day = start.date()
+    # A week or more covers every day
+    for _ in range(min((end.date() - day).days + 1, DAYS)):
+        # date.weekday() counts from Monday; days_mask from Sunday
+        mask |= 1 << ((day.weekday() + 1) % DAYS)
+        day += timedelta(days=1)
+
+    return mask
+
+
+def _tag_ids_by(table_column, owner_column, owner_ids):
+    query = db.session.query(owner_column, table_column)
+    if owner_ids is not None:
+        query = query.filter(owner_column.in_(owner_ids))
+
+    tag_ids = {}
+    for owner_id, tag_id in query:
+        tag_ids.setdefault(owner_id, set()).add(tag_id)
+    return tag_ids
+
+
+def load_gigs(post_ids=None):
+    """Returns a GigProfile for each active post, or each active one of post_ids."""
+
+    if post_ids is not None and not post_ids:
+        return []
+
+    query = (
+        db.session.query(
+            Post.post_id,
+            Post.user_id,
+            Post.zipcode,
+            Zipcode.location_name,
+            Zipcode.region,
+            Post.gig_date_start,
+            Post.gig_date_end,
+            Post.pay,
+            Post.ishourly,
+            Post.unpaid,
+        )
+        .outerjoin(Zipcode, Post.zipcode == Zipcode.valid_zipcode)
+        .filter(Post.active == True)
+    )
+    if post_ids is not None:
+        query = query.filter(Post.post_id.in_(post_ids))
+
+    rows = query.all()
+    tag_ids = _tag_ids_by(
+        posts_tags.c.tag_id,
+        posts_tags.c.post_id,
+        None if post_ids is None else [row.post_id for row in rows],
+    )
+
+    return [
+        GigProfile(
+            post_id=row.post_id,
+            user_id=row.user_id,
+            tag_ids=frozenset(tag_ids.get(row.post_id, ())),
+            zipcode=row.zipcode,
+            location_name=row.location_name,
+            region=row.region,
+            days_mask=gig_days_mask(row.gig_date_start, row.gig_date_end),
+            pay=row.pay,
+            ishourly=row.ishourly,
+            unpaid=row.unpaid,
+        )
+        for row in rows
+    ]
+
+
+def load_artists(user_ids=None):
+    """Returns an ArtistProfile for each verified artist, or each one of user_ids."""
+
+    if user_ids is not None and not user_ids:
+        return []
+
+    query = (
+        db.session.query(
+            User.id,
+            User.zipcode,
+            Zipcode.location_name,
+            Zipcode.region,
+            User.days_mask,
+            User.hourly_rate,
+            User.show_unpaid,
+        )
+        .outerjoin(Zipcode, User.zipcode == Zipcode.valid_zipcode)
+        .filter(User.is_artist == True, User.verified == True)
+    )
+    if user_ids is not None:
+        query = query.filter(User.id.in_(user_ids))
+
+    rows = query.all()
+    tag_ids = _tag_ids_by(
+        users_tags.c.tag_id,
+        users_tags.c.user_id,
+        None if user_ids is None else [row.id for row in rows],
+    )
+
+    return [
+        ArtistProfile(
+            user_id=row.id,
+            tag_ids=frozenset(tag_ids.get(row.id, ())),
+            zipcode=row.zipcode,
+            location_name=row.location_name,
+            region=row.region,
+            days_mask=row.days_mask,
+            hourly_rate=row.hourly_rate,
+            show_unpaid=row.show_unpaid,
+        )
+        for row in rows
+    ]
+
+
+def _tags_score(gig, artist):
+    if not gig.tag_ids:
+        return 0.0
+    return len(gig.tag_ids & artist.tag_ids) / len(gig.tag_ids)
+
+
+def _region_score(gig, artist):
+    if gig.zipcode == REMOTE_ZIPCODE:
+        return 1.0
+    if artist.zipcode == None:
+        return 0.0
+    # Places missing from zipcodes match nothing, not each other
+    if artist.location_name != None and artist.location_name == gig.location_name:
+        return 1.0
+    if artist.region != None and artist.region == gig.region:
+        return NEARBY_REGION_SCORE
+    return 0.0
+
+
+def _days_score(gig, artist):
+    if gig.days_mask == None:
+        return 1.0
+    wanted = bin(gig.days_mask).count("1")
+    return bin(gig.days_mask & artist.days_mask).count("1") / wanted
+
+
+def _pay_score(gig, artist):
+    if gig.unpaid:
+        return 1.0 if artist.show_unpaid else 0.0
+    if not artist.hourly_rate:
+        return 1.0
+    if gig.pay == None:
+        return UNKNOWN_PAY_SCORE
+
+    if gig.ishourly:
+        asking = artist.hourly_rate
+    else:
+        asking = artist.hourly_rate * ASSUMED_GIG_HOURS
+
+    return min(gig.pay / asking, 1.0)
+
+
+def match_score(gig, artist):
+    """Scores how well an ArtistProfile fits a GigProfile, from 0 to 1.
+    Returns None for the post's own author, who is never suggested."""
+
+    if gig.user_id == artist.user_id:
+        return None
+
+    return (
+        WEIGHTS["tags"] * _tags_score(gig, artist)
+        + WEIGHTS["region"] * _region_score(gig, artist)
+        + WEIGHTS["days"] * _days_score(gig, artist)
+        + WEIGHTS["pay"] * _pay_score(gig, artist)
+    )
+
+
+def _best(scores):
+    """The MATCHES_PER_POST best of (score, user_id) pairs. Ties go to the
+    lower user id, so a list comes out the same however it was built."""
+
+    return heapq.nsmallest(
+        MATCHES_PER_POST, scores, key=lambda scored: (-scored[0], scored[1])
+    )
+
+
+def _lock_posts(post_ids):
+    """Locks the posts' rows until the transaction ends. Taken in id order,
+    so refreshes in other processes wait their turn rather than deadlock."""
+
+    db.session.query(Post.post_id).filter(Post.post_id.in_(post_ids)).order_by(
+        Post.post_id
+    ).with_for_update().all()
+
+
+def _rewrite_matches(best_by_post):
+    """Replaces the stored lists of the posts in best_by_post, which maps
+    post_id to its (score, user_id) pairs. Doesn't commit."""
+
+    post_ids = sorted(best_by_post)
+    if not post_ids:
+        return
+
+    _lock_posts(post_ids)
+
+    db.session.query(ArtistMatch).filter(ArtistMatch.post_id.in_(post_ids)).delete(
+        synchronize_session=False
+    )
+    db.session.bulk_insert_mappings(
+        ArtistMatch,
+        [
+            {"post_id": post_id, "user_id": user_id, "score": score}
+            for post_id in post_ids
+            for score, user_id in best_by_post[post_id]
+        ],
+    )
+
+
+def refresh_post_matches(post_ids, artists=None):
+    """Rescores post_ids against every verified artist (or artists, a list
+    of ArtistProfiles) and stores their new lists. Posts that are gone or
+    inactive lose theirs. Commits."""
+
+    post_ids = set(post_ids)
+    if not post_ids:
+        return
+
+    if artists is None:
+        artists = load_artists()
+
+    best_by_post = dict.fromkeys(post_ids, [])
+
+    for gig in load_gigs(post_ids):
+        scores = []
+        for artist in artists:
+            score = match_score(gig, artist)
+            if score:
+                scores.append((score, artist.user_id))
+        best_by_post[gig.post_id] = _best(scores)
+
+    try:
+        _rewrite_matches(best_by_post)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _candidate_post_ids(artists, user_ids):
+    """Returns the ids of the posts whose lists artists (ArtistProfiles of
+    user_ids) could enter or leave.
+
+    Without a shared tag or region an artist scores at most
+    UNRELATED_BEST_SCORE, so the other posts they can enter are those whose
+    lists have room or end at or below that."""
+
+    post_ids = set(
+        post_id
+        for post_id, in db.session.query(ArtistMatch.post_id).filter(
+            ArtistMatch.user_id.in_(user_ids)
+        )
+    )
+
+    tag_ids = set()
+    for artist in artists:
+        tag_ids.update(artist.tag_ids)
+    if tag_ids:
+        post_ids.update(
+            post_id
+            for post_id, in db.session.query(posts_tags.c.post_id).filter(
+                posts_tags.c.tag_id.in_(tag_ids)
+            )
+        )
+
+    # Unknown places and regions match nothing (see _region_score)
+    places = set()
+    regions = set()
+    for artist in artists:
+        if artist.zipcode == None:
+            continue
+        if artist.location_name != None:
+            places.add(artist.location_name)
+        if artist.region != None:
+            regions.add(artist.region)
+
+    nearby = Post.zipcode == REMOTE_ZIPCODE
+    if places or regions:
+        nearby = nearby | Post.zipcode.in_(
+            db.session.query(Zipcode.valid_zipcode).filter(
+                Zipcode.location_name.in_(places) | Zipcode.region.in_(regions)
+            )
+        )
+    post_ids.update(
+        post_id
+        for post_id, in db.session.query(Post.post_id).filter(
+            Post.active == True, nearby
+        )
+    )
+
+    open_lists = (
+        db.session.query(Post.post_id)
+        .outerjoin(ArtistMatch, ArtistMatch.post_id == Post.post_id)
+        .filter(Post.active == True)
+        .group_by(Post.post_id)
+        .having(
+            (db.func.count(ArtistMatch.user_id) < MATCHES_PER_POST)
+            | (db.func.min(ArtistMatch.score) <= UNRELATED_BEST_SCORE)
+        )
+    )
+    post_ids.update(post_id for post_id, in open_lists)
+
+    return post_ids
+
+
+def _merge_artist_matches(user_ids):
+    """Merges user_ids' new scores into the candidate posts' lists. Returns
+    the ids of the posts that need a full rescore instead. Doesn't commit."""
+
+    artists = load_artists(user_ids)
+    post_ids = _candidate_post_ids(artists, user_ids)
+
+    # Before reading the lists, so a refresh in another process can't
+    # rewrite one between our read and our write
+    _lock_posts(sorted(post_ids))
+
+    gigs = load_gigs(post_ids)
+
+    stored = {}
+    for post_id, user_id, score in (
+        db.session.query(ArtistMatch.post_id, ArtistMatch.user_id, ArtistMatch.score)
+        .join(Post, Post.post_id == ArtistMatch.post_id)
+        .filter(Post.active == True, ArtistMatch.post_id.in_(post_ids))
+    ):
+        stored.setdefault(post_id, []).append((score, user_id))
+
+    best_by_post = {}
+    # Posts whose lists can't be merged into, see below
+    rescore_post_ids = set()
+
+    for gig in gigs:
+        current = stored.get(gig.post_id, [])
+        old_scores = {
+            user_id: score for score, user_id in current if user_id in user_ids
+        }
+
+        new_scores = {}
+        for artist in artists:
+            score = match_score(gig, artist)
+            if score:
+                new_scores[artist.user_id] = score
+
+        if not old_scores and not new_scores:
+            continue
+
+        # A full list doesn't say who came next. If one of these users
+        # falls, the runner-up may be someone not stored.
+        if len(current) >= MATCHES_PER_POST and any(
+            new_scores.get(user_id, 0) < score for user_id, score in old_scores.items()
+        ):
+            rescore_post_ids.add(gig.post_id)
+            continue
+
+        merged = [scored for scored in current if scored[1] not in user_ids]
+        merged.extend((score, user_id) for user_id, score in new_scores.items())
+        best = _best(merged)
+
+        if sorted(best) != sorted(current):
+            best_by_post[gig.post_id] = best
+
+    # Their old entries on inactive posts go too
+    for post_id, in (
+        db.session.query(ArtistMatch.post_id)
+        .filter(ArtistMatch.user_id.in_(user_ids))
+        .distinct()
+    ):
+        if post_id not in stored and post_id not in rescore_post_ids:
+            best_by_post[post_id] = []
+
+    _rewrite_matches(best_by_post)
+
+    return rescore_post_ids
+
+
+def refresh_artist_matches(user_ids):
+    """Rescores user_ids against the active posts whose lists they could
+    enter or leave, merging them into the stored lists. Users who are no
+    longer verified artists drop out. Commits."""
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    try:
+        rescore_post_ids = _merge_artist_matches(user_ids)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if rescore_post_ids:
+        refresh_post_matches(rescore_post_ids)
+
+
+def refresh_all_matches():
+    """Rebuilds every stored list. Returns how many posts were scored."""
+
+    db.session.query(ArtistMatch).delete(synchronize_session=False)
+    db.session.commit()
+
+    post_ids = [
+        post_id for post_id, in db.session.query(Post.post_id).filter(Post.active == True)
+    ]
+    refresh_post_matches(post_ids, load_artists())
+
+    return len(post_ids)
+
+
+def suggested_artists_query(post_id):
+    """(User, score) pairs from a post's stored list, best first."""
+
+    return (
+        db.session.query(User, ArtistMatch.score)
+        .join(ArtistMatch, ArtistMatch.user_id == User.id)
+        .filter(ArtistMatch.post_id == post_id)
+        .order_by(ArtistMatch.score.desc(), User.id)
+    )
+
+
+def suggested_artists(post_id, limit=MATCHES_PER_POST):
+    """Returns up to limit (User, score) pairs for a post, best first."""
+
+    return suggested_artists_query(post_id).limit(limit).all()
+
+
+class MatchRefresher(object):
+    """Rebuilds the lists that committed changes affect, on a background
+    thread. Changes made within MATCH_REFRESH_DELAY seconds of each other,
+    or that pile up while it works, are handled in one batch."""
+
+    def __init__(self, app):
+        self.app = app
+        app.config.setdefault("MATCH_REFRESH_DELAY", 1.0)
+        self.post_ids = set()
+        self.user_ids = set()
+        self.thread = None
+        self.woken = threading.Event()
+        self.stopped = threading.Event()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.lock = threading.Lock()
+
+        event.listen(Session, "after_commit", self._after_commit)
+
+    def _after_commit(self, session):
+        post_ids = session.info.pop("match_post_ids", None)
+        user_ids = session.info.pop("match_user_ids", None)
+
+        if post_ids or user_ids:
+            self.submit(post_ids or (), user_ids or ())
+
+    def submit(self, post_ids=(), user_ids=()):
+        """Asks for post_ids' and user_ids' matches to be refreshed soon."""
+
+        with self.lock:
+            self.post_ids.update(post_ids)
+            self.user_ids.update(user_ids)
+            self.idle.clear()
+
+            # Started on first use, so forked server workers each get their own
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="match-refresher", daemon=True
+                )
+                self.thread.start()
+
+        self.woken.set()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.woken.wait()
+            # Changes tend to come in bursts, such as a profile form saving
+            # several fields, so give the rest a moment to arrive
+            if self.stopped.wait(self.app.config["MATCH_REFRESH_DELAY"]):
+                break
+            self.woken.clear()
+
+            with self.lock:
+                post_ids, self.post_ids = self.post_ids, set()
+                user_ids, self.user_ids = self.user_ids, set()
+
+            if post_ids or user_ids:
+                with self.app.app_context():
+                    try:
+                        # Rescoring a post covers every artist's change to it
+                        refresh_post_matches(post_ids)
+                        refresh_artist_matches(user_ids)
+                    except Exception as e:
+                        db.session.rollback()
+                        self.app.logger.error("Refreshing matches failed: %s", e)
+                    finally:
+                        db.session.remove()
+
+            with self.lock:
+                if not self.post_ids and not self.user_ids:
+                    self.idle.set()
+
+    def wait(self, timeout=None):
+        """Blocks until everything submitted so far is done. For tests."""
+
+        return self.idle.wait(timeout)
+
+    def stop(self):
+        self.stopped.set()
+        self.woken.set()
+
+        if self.thread is not None:
+            self.thread.join()
+
+
+def _changed(instance, fields):
+    state = inspect(instance)
+    return any(state.attrs[field].history.has_changes() for field in fields)
+
+
+@event.listens_for(Session, "after_flush")
+def _note_match_changes(session, flush_context):
+    # new, dirty and deleted still hold what was just flushed, now with ids
+    post_ids = session.info.setdefault("match_post_ids", set())
+    user_ids = session.info.setdefault("match_user_ids", set())
+
+    for instance in session.new:
+        if isinstance(instance, Post):
+            post_ids.add(instance.post_id)
+        elif isinstance(instance, User) and instance.is_artist and instance.verified:
+            user_ids.add(instance.id)
+
+    for instance in session.dirty:
+        if isinstance(instance, Post) and _changed(instance, POST_FIELDS):
+            post_ids.add(instance.post_id)
+        elif isinstance(instance, User) and _changed(instance, ARTIST_FIELDS):
+            user_ids.add(instance.id)
+
+    for instance in session.deleted:
+        if isinstance(instance, Post):
+            post_ids.add(instance.post_id)
+        elif isinstance(instance, User):
+            user_ids.add(instance.id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_match_changes(session):
+    session.info.pop("match_post_ids", None)
+    session.info.pop("match_user_ids", None)
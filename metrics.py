@@ -0,0 +1,209 @@
+"""BayArt - Bay Area Art Connection Project: buffered metrics and events
+
+Pages record counters, events and service checks in a MetricsBuffer, which
+only touches memory. A background thread flushes the buffer to a sink every
+flush_interval seconds, in one batch:
+
+    DatadogSink  the Datadog HTTP API
+    NullSink     nowhere, when Datadog isn't configured
+    StatsdSink   DogStatsD datagrams over UDP, to a local agent, or to a
+                 listening socket in tests
+
+Repeats are aggregated rather than queued: counters add up, identical events
+are sent once with a count, and only a service check's latest status is
+kept. The buffer holds at most max_keys distinct names of each kind. Past
+that, new names are dropped and counted in the "metrics.dropped" counter,
+so a flood of errors costs the same memory as one.
+"""
+
+import logging
+import socket
+import threading
+import time
+
+from services import init_datadog
+
+log = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 10
+MAX_KEYS = 1000
+# Keeps each datagram inside one Ethernet frame
+MAX_DATAGRAM = 1432
+
+
+def _tag_key(tags):
+    return tuple(sorted(tags or ()))
+
+
+def _utf8_len(text):
+    # DogStatsD lengths and datagram sizes are in bytes, not characters
+    return len(text.encode("utf-8"))
+
+
+class DatadogSink(object):
+    """Sends a flushed batch through the Datadog HTTP API. Counters go out
+    in one request; events and service checks take one request each."""
+
+    def send(self, timestamp, counters, events, checks):
+        init_datadog()
+
+        from datadog import api
+
+        if counters:
+            api.Metric.send(
+                metrics=[
+                    {
+                        "metric": name,
+                        "points": [(timestamp, value)],
+                        "tags": list(tags),
+                        "type": "count",
+                    }
+                    for (name, tags), value in counters.items()
+                ]
+            )
+
+        for (title, text, tags), count in events.items():
+            if count > 1:
+                text = f"{text} ({count} times)"
+            api.Event.create(title=title, text=text, tags=list(tags))
+
+        for (check, host, tags), (status, message) in checks.items():
+            api.ServiceCheck.check(
+                check=check,
+                host_name=host,
+                status=status,
+                message=message,
+                tags=list(tags),
+            )
+
+
+class NullSink(object):
+    """Drops every batch, for when Datadog isn't configured."""
+
+    def send(self, timestamp, counters, events, checks):
+        pass
+
+
+class StatsdSink(object):
+    """Sends a flushed batch as DogStatsD datagrams, several lines per packet."""
+
+    def __init__(self, host="127.0.0.1", port=8125):
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, timestamp, counters, events, checks):
+        lines = []
+
+        for (name, tags), value in counters.items():
+            lines.append(f"{name}:{value}|c" + self._tags(tags))
+
+        for (title, text, tags), count in events.items():
+            if count > 1:
+                text = f"{text} ({count} times)"
+            lines.append(
+                f"_e{{{_utf8_len(title)},{_utf8_len(text)}}}:{title}|{text}"
+                + self._tags(tags)
+            )
+
+        for (check, host, tags), (status, message) in checks.items():
+            line = f"_sc|{check}|{status}|h:{host}" + self._tags(tags)
+            if message:
+                line += f"|m:{message}"
+            lines.append(line)
+
+        for datagram in self._pack(lines):
+            self.socket.sendto(datagram, self.address)
+
+    def _tags(self, tags):
+        return "|#" + ",".join(tags) if tags else ""
+
+    def _pack(self, lines):
+        packet = b""
+        for line in lines:
+            line = line.encode("utf-8")
+            if packet and len(packet) + 1 + len(line) > MAX_DATAGRAM:
+                yield packet
+                packet = b""
+            packet = packet + b"\n" + line if packet else line
+        if packet:
+            yield packet
+
+
+class MetricsBuffer(object):
+    """Collects counters, events and service checks in memory and flushes
+    them to a sink on a background thread."""
+
+    def __init__(self, sink, flush_interval=FLUSH_INTERVAL, max_keys=MAX_KEYS):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self.counters = {}
+        self.events = {}
+        self.checks = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def _start(self):
+        # Started on first use, so forked server workers each get their own.
+        # Only called with self.lock held.
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name="metrics-flush", daemon=True
+            )
+            self.thread.start()
+
+    def _add(self, bucket, key, update):
+        with self.lock:
+            self._start()
+            if key not in bucket and len(bucket) >= self.max_keys:
+                self.dropped += 1
+                return
+            bucket[key] = update(bucket.get(key))
+
+    def increment(self, name, value=1, tags=None):
+        self._add(
+            self.counters, (name, _tag_key(tags)), lambda total: (total or 0) + value
+        )
+
+    def event(self, title, text, tags=None):
+        self._add(
+            self.events, (title, text, _tag_key(tags)), lambda count: (count or 0) + 1
+        )
+
+    def service_check(self, check, status, host=None, tags=None, message=None):
+        self._add(
+            self.checks, (check, host, _tag_key(tags)), lambda latest: (status, message)
+        )
+
+    def flush(self):
+        """Hands everything buffered so far to the sink, in one batch."""
+
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            events, self.events = self.events, {}
+            checks, self.checks = self.checks, {}
+            dropped, self.dropped = self.dropped, 0
+
+        if dropped:
+            counters[("metrics.dropped", ())] = dropped
+
+        if counters or events or checks:
+            self.sink.send(int(time.time()), counters, events, checks)
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                # The batch is lost; the next one starts empty
+                log.exception("Flushing metrics failed")
+
+    def stop(self):
+        """Stops the flush thread after one last flush."""
+
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
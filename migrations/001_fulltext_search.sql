@@ -0,0 +1,27 @@
+-- BayArt - Bay Area Art Connection Project: full-text search columns
+-- Run once against an existing database:  psql bayart -f migrations/001_fulltext_search.sql
+
+BEGIN;
+
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+UPDATE posts SET search_vector = to_tsvector('pg_catalog.english',
+    coalesce(post_title, '') || ' ' || coalesce(description, ''));
+UPDATE users SET search_vector = to_tsvector('pg_catalog.english',
+    coalesce(user_name, '') || ' ' || coalesce(bio, ''));
+
+CREATE INDEX IF NOT EXISTS ix_posts_search_vector ON posts USING gin (search_vector);
+CREATE INDEX IF NOT EXISTS ix_users_search_vector ON users USING gin (search_vector);
+
+DROP TRIGGER IF EXISTS posts_search_vector_update ON posts;
+CREATE TRIGGER posts_search_vector_update BEFORE INSERT OR UPDATE
+    ON posts FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(
+    search_vector, 'pg_catalog.english', post_title, description);
+
+DROP TRIGGER IF EXISTS users_search_vector_update ON users;
+CREATE TRIGGER users_search_vector_update BEFORE INSERT OR UPDATE
+    ON users FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(
+    search_vector, 'pg_catalog.english', user_name, bio);
+
+COMMIT;
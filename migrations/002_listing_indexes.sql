@@ -0,0 +1,52 @@
+-- BayArt - Bay Area Art Connection Project: indexes for listings, search and expiry
+-- Run once against an existing database:  psql bayart -f migrations/002_listing_indexes.sql
+-- The indexes are built CONCURRENTLY so the site stays up; that can't happen
+-- inside a transaction, so only the primary key changes are wrapped in one.
+-- Afterwards, run python3 explain_check.py to confirm the queries use them.
+
+BEGIN;
+
+-- Composite primary keys on the association tables.
+-- Drop incomplete and duplicate rows first, so the keys can be added.
+DELETE FROM posts_tags WHERE tag_id IS NULL OR post_id IS NULL;
+DELETE FROM posts_tags a USING posts_tags b
+    WHERE a.ctid < b.ctid AND a.tag_id = b.tag_id AND a.post_id = b.post_id;
+ALTER TABLE posts_tags ADD PRIMARY KEY (tag_id, post_id);
+
+DELETE FROM users_tags WHERE tag_id IS NULL OR user_id IS NULL;
+DELETE FROM users_tags a USING users_tags b
+    WHERE a.ctid < b.ctid AND a.tag_id = b.tag_id AND a.user_id = b.user_id;
+ALTER TABLE users_tags ADD PRIMARY KEY (tag_id, user_id);
+
+COMMIT;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_tags_post_id ON posts_tags (post_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_tags_user_id ON users_tags (user_id);
+
+-- /gigs, /seeownposts and gig search, with and without unpaid gigs
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_active_listing
+    ON posts (creation_date DESC NULLS LAST, post_id DESC) WHERE active = true;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_active_paid_listing
+    ON posts (creation_date DESC NULLS LAST, post_id DESC) WHERE active = true AND unpaid = false;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_user_id ON posts (user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_zipcode ON posts (zipcode);
+
+-- expiry.expire_gigs
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_active_gig_date_end
+    ON posts (gig_date_end) WHERE active = true;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_active_gig_date_start
+    ON posts (gig_date_start) WHERE active = true AND gig_date_end IS NULL;
+
+-- /artists and artist search
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_artist_listing
+    ON users (last_active DESC NULLS LAST, id DESC) WHERE is_artist = true AND verified = true;
+
+-- region and city lookups
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_zipcodes_region ON zipcodes (region);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_zipcodes_location_name ON zipcodes (location_name);
+
+ANALYZE posts;
+ANALYZE users;
+ANALYZE posts_tags;
+ANALYZE users_tags;
+ANALYZE zipcodes;
@@ -0,0 +1,5 @@
+-- BayArt - Bay Area Art Connection Project: resized image variants
+-- Run once against an existing database:  psql bayart -f migrations/003_image_variants.sql
+-- Existing pictures keep working as single JPEGs until they are uploaded again.
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS img_variants json;
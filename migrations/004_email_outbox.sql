@@ -0,0 +1,22 @@
+-- BayArt - Bay Area Art Connection Project: transactional email outbox
+-- Run once against an existing database:  psql bayart -f migrations/004_email_outbox.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS email_outbox (
+    email_id SERIAL PRIMARY KEY,
+    from_email VARCHAR(100) NOT NULL,
+    to_email VARCHAR(100) NOT NULL,
+    subject VARCHAR(200) NOT NULL,
+    body TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    send_after TIMESTAMP NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    sent_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS ix_email_outbox_pending
+    ON email_outbox (send_after) WHERE sent_at IS NULL;
+
+COMMIT;
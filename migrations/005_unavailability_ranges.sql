@@ -0,0 +1,31 @@
+-- BayArt - Bay Area Art Connection Project: indexed artist unavailability
+-- Run once against an existing database:  psql bayart -f migrations/005_unavailability_ranges.sql
+
+-- A range missing either end can't be compared; treat it as a single day
+UPDATE unavailability SET end_range_date = start_range_date
+    WHERE end_range_date IS NULL AND start_range_date IS NOT NULL;
+UPDATE unavailability SET start_range_date = end_range_date
+    WHERE start_range_date IS NULL AND end_range_date IS NOT NULL;
+DELETE FROM unavailability WHERE start_range_date IS NULL;
+
+-- Ranges cover whole days; older rows kept the time of day they were saved at
+UPDATE unavailability
+    SET start_range_date = date_trunc('day', start_range_date),
+        end_range_date = date_trunc('day', end_range_date)
+    WHERE start_range_date <> date_trunc('day', start_range_date)
+        OR end_range_date <> date_trunc('day', end_range_date);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_unavailability_user_id
+    ON unavailability (user_id);
+
+-- Built on the same expression availability.py queries
+DROP INDEX CONCURRENTLY IF EXISTS ix_unavailability_during;
+CREATE INDEX CONCURRENTLY ix_unavailability_during
+    ON unavailability USING gist (
+        tsrange(
+            date_trunc('day', start_range_date),
+            date_trunc('day', coalesce(end_range_date, start_range_date)),
+            '[]'
+        )
+    )
+    WHERE start_range_date IS NOT NULL;
@@ -0,0 +1,22 @@
+-- BayArt - Bay Area Art Connection Project: weekly availability as a bitmask
+-- Run once against an existing database:  psql bayart -f migrations/006_days_mask.sql
+-- Bit 0 is Sunday through bit 6 for Saturday, matching the daysweek string.
+
+BEGIN;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS days_mask smallint NOT NULL DEFAULT 127;
+
+UPDATE users SET days_mask =
+      (CASE WHEN substr(daysweek, 1, 1) = 't' THEN 1 ELSE 0 END)
+    | (CASE WHEN substr(daysweek, 2, 1) = 't' THEN 2 ELSE 0 END)
+    | (CASE WHEN substr(daysweek, 3, 1) = 't' THEN 4 ELSE 0 END)
+    | (CASE WHEN substr(daysweek, 4, 1) = 't' THEN 8 ELSE 0 END)
+    | (CASE WHEN substr(daysweek, 5, 1) = 't' THEN 16 ELSE 0 END)
+    | (CASE WHEN substr(daysweek, 6, 1) = 't' THEN 32 ELSE 0 END)
+    | (CASE WHEN substr(daysweek, 7, 1) = 't' THEN 64 ELSE 0 END)
+    WHERE daysweek IS NOT NULL;
+
+COMMIT;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_artist_days_mask
+    ON users (days_mask) WHERE is_artist = true AND verified = true;
@@ -0,0 +1,24 @@
+-- BayArt - Bay Area Art Connection Project: suggested artists for gigs
+-- Run once against an existing database:  psql bayart -f migrations/007_artist_matches.sql
+-- Then fill the new table:  FLASK_APP=server.py flask refresh-matches
+
+BEGIN;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS zipcode integer
+    REFERENCES zipcodes (valid_zipcode);
+
+CREATE TABLE IF NOT EXISTS artist_matches (
+    post_id integer NOT NULL REFERENCES posts (post_id) ON DELETE CASCADE,
+    user_id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    score double precision NOT NULL,
+    PRIMARY KEY (post_id, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_artist_matches_post_score
+    ON artist_matches (post_id, score);
+CREATE INDEX IF NOT EXISTS ix_artist_matches_user_id
+    ON artist_matches (user_id);
+
+COMMIT;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_zipcode ON users (zipcode);
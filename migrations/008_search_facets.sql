@@ -0,0 +1,11 @@
+-- BayArt - Bay Area Art Connection Project: search facet counts
+-- Run once against an existing database:  psql bayart -f migrations/008_search_facets.sql
+-- Then count what's there:  FLASK_APP=server.py flask refresh-facets
+
+CREATE TABLE IF NOT EXISTS search_facets (
+    kind varchar(20) NOT NULL,
+    facet varchar(20) NOT NULL,
+    value varchar(100) NOT NULL,
+    count integer NOT NULL DEFAULT 0,
+    PRIMARY KEY (kind, facet, value)
+);
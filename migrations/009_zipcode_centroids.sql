@@ -0,0 +1,6 @@
+-- BayArt - Bay Area Art Connection Project: zipcode centers for distance search
+-- Run once against an existing database:  psql bayart -f migrations/009_zipcode_centroids.sql
+-- Then fill them in from the map polygons:  FLASK_APP=server.py flask load-zipcodes
+
+ALTER TABLE zipcodes ADD COLUMN IF NOT EXISTS latitude double precision;
+ALTER TABLE zipcodes ADD COLUMN IF NOT EXISTS longitude double precision;
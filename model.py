@@ -2,6 +2,9 @@
 
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin
+from sqlalchemy import event, DDL
+from sqlalchemy.orm import validates
+from sqlalchemy.dialects.postgresql import TSVECTOR
 
 db = SQLAlchemy()
 
@@ -11,9 +14,23 @@ from random import randint
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from faker import Faker
+from weekdays import ALL_DAYS, daysweek_to_mask
 
-fake = Faker()
+_fake = None
+
+
+def get_fake():
+    """Returns the Faker the seed functions use. Faker is slow to import,
+    so that only happens when seeding."""
+
+    global _fake
+
+    if _fake is None:
+        from faker import Faker
+
+        _fake = Faker()
+
+    return _fake
 
 
 class User(UserMixin, db.Model):
@@ -34,23 +51,52 @@ class User(UserMixin, db.Model):
     link_to_website = db.Column(db.String(50), nullable=True)
     bio = db.Column(db.String(500), nullable=True)
     daysweek = db.Column(db.String(7), default="ttttttt")
+    # daysweek as bits, Sunday = 1 (see weekdays.py); set along with daysweek
+    days_mask = db.Column(
+        db.SmallInteger, nullable=False, default=ALL_DAYS, server_default=str(ALL_DAYS)
+    )
     paid_confirm = db.Column(db.Integer, default=0)
     verified = db.Column(db.Boolean, unique=False, default=False)
     img_route = db.Column(db.String(200), default="default_user_icon.png")
+    # Where the artist is based, for matching them to gigs (see matching.py)
+    zipcode = db.Column(
+        db.Integer, db.ForeignKey("zipcodes.valid_zipcode"), nullable=True
+    )
     veri_code = db.Column(db.String(50), default="A123456")
     img_port_one = db.Column(db.String(200), default="default_user_icon.png")
     img_port_two = db.Column(db.String(200), default="default_user_icon.png")
     img_port_three = db.Column(db.String(200), default="default_user_icon.png")
+    # Resized copies of the images above, by column:
+    # {"img_route": {"sizes": [64, 240, 800], "formats": ["jpeg", "webp"]}}
+    img_variants = db.Column(db.JSON, nullable=True)
+    # Full-text search on user_name and bio, kept current by a trigger (see fulltext.py)
+    search_vector = db.deferred(
+        db.Column(TSVECTOR().with_variant(db.Text(), "sqlite"))
+    )
+
+    __table_args__ = (
+        db.Index("ix_users_search_vector", "search_vector", postgresql_using="gin"),
+    )
 
     def __repr__(self):
         """Provides the representaion of a User instance when printed"""
 
         return f"<User id={self.id} user_name={self.user_name}>"
 
+    @validates("daysweek")
+    def _set_days_mask(self, key, daysweek):
+        if daysweek == None:
+            self.days_mask = ALL_DAYS
+        else:
+            self.days_mask = daysweek_to_mask(daysweek)
+        return daysweek
+
     posts = db.relationship("Post", backref=db.backref("users"))
 
     tags = db.relationship("Tag", secondary="users_tags", backref="users")
 
+    zipcodes = db.relationship("Zipcode", backref=db.backref("users"))
+
 
 class Post(db.Model):
     """Post class, to create a new post ("listing") on the website."""
@@ -68,11 +114,19 @@ class Post(db.Model):
     unpaid = db.Column(db.Boolean, default=True)
     pay = db.Column(db.Integer, nullable=True)
     active = db.Column(db.Boolean, default=True)
+    # Full-text search on post_title and description, kept current by a trigger
+    search_vector = db.deferred(
+        db.Column(TSVECTOR().with_variant(db.Text(), "sqlite"))
+    )
 
     zipcode = db.Column(
         db.Integer, db.ForeignKey("zipcodes.valid_zipcode"), nullable=False
     )
 
+    __table_args__ = (
+        db.Index("ix_posts_search_vector", "search_vector", postgresql_using="gin"),
+    )
+
     def __repr__(self):
         """Provides the representaion of a Post instance when printed"""
 
@@ -98,7 +152,8 @@ class Tag(db.Model):
 
 
 class Unavailability(db.Model):
-    """Takes a user id and dates objects for unavailable"""
+    """Takes a user id and dates objects for unavailable.
+    The range covers whole days, both ends included (see availability.py)."""
 
     __tablename__ = "unavailability"
 
@@ -110,7 +165,7 @@ class Unavailability(db.Model):
     def __repr__(self):
         """Provides the representaion of an Unavailability instance when printed"""
 
-        return f"<Unvailabilty tag_id={self.user_id} tag_name={self.date_ranges}>"
+        return f"<Unvailabilty user_id={self.user_id} start_range_date={self.start_range_date} end_range_date={self.end_range_date}>"
 
     users = db.relationship("User", backref=db.backref("unavailabilty"))
 
@@ -123,6 +178,9 @@ class Zipcode(db.Model):
     valid_zipcode = db.Column(db.Integer, primary_key=True)
     location_name = db.Column(db.String(100))
     region = db.Column(db.String(100))
+    # The zipcode's center, for distance searches (see spatial.py)
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
 
     def __repr__(self):
         """Provides the representaion of a Zipcode instance when printed"""
@@ -130,28 +188,224 @@ class Zipcode(db.Model):
         return f"<Zipcode valid_zipcode={self.valid_zipcode} region={self.region}>"
 
 
+class OutboxEmail(db.Model):
+    """An email waiting to be sent, or already sent, by the dispatcher in outbox.py."""
+
+    __tablename__ = "email_outbox"
+
+    email_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    from_email = db.Column(db.String(100), nullable=False)
+    to_email = db.Column(db.String(100), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    # Not tried again before this; pushed back after each failed attempt
+    send_after = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        """Provides the representaion of an OutboxEmail instance when printed"""
+
+        return f"<OutboxEmail email_id={self.email_id} to_email={self.to_email}>"
+
+
+class ArtistMatch(db.Model):
+    """A verified artist suggested for an active post, and how well they fit.
+    Kept current by matching.py; only each post's best matches are stored."""
+
+    __tablename__ = "artist_matches"
+
+    post_id = db.Column(
+        db.Integer, db.ForeignKey("posts.post_id", ondelete="CASCADE"), primary_key=True
+    )
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+    score = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        """Provides the representaion of an ArtistMatch instance when printed"""
+
+        return f"<ArtistMatch post_id={self.post_id} user_id={self.user_id} score={self.score}>"
+
+    users = db.relationship("User")
+
+
+class SearchFacet(db.Model):
+    """How many active gigs or verified artists have a tag, region or kind
+    of pay. Kept current by facets.py for the advanced search pages."""
+
+    __tablename__ = "search_facets"
+
+    # "gigs" or "artists"
+    kind = db.Column(db.String(20), primary_key=True)
+    # "tag", "region" or "pay"
+    facet = db.Column(db.String(20), primary_key=True)
+    # a tag_id, region name, or "paid"/"unpaid"
+    value = db.Column(db.String(100), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        """Provides the representaion of a SearchFacet instance when printed"""
+
+        return f"<SearchFacet kind={self.kind} facet={self.facet} value={self.value} count={self.count}>"
+
+
 posts_tags = db.Table(
     "posts_tags",
     db.metadata,
-    db.Column("tag_id", db.Integer, db.ForeignKey("tags.tag_id")),
-    db.Column("post_id", db.Integer, db.ForeignKey("posts.post_id")),
+    db.Column("tag_id", db.Integer, db.ForeignKey("tags.tag_id"), primary_key=True),
+    db.Column("post_id", db.Integer, db.ForeignKey("posts.post_id"), primary_key=True),
 )
 
 users_tags = db.Table(
     "users_tags",
     db.metadata,
-    db.Column("tag_id", db.Integer, db.ForeignKey("tags.tag_id")),
-    db.Column("user_id", db.Integer, db.ForeignKey("users.id")),
+    db.Column("tag_id", db.Integer, db.ForeignKey("tags.tag_id"), primary_key=True),
+    db.Column("user_id", db.Integer, db.ForeignKey("users.id"), primary_key=True),
+)
+
+#####################################################################
+# Indexes for the listing, search and expiry queries.
+# migrations/002_listing_indexes.sql adds them to an existing database,
+# and explain_check.py confirms the queries use them.
+#
+# The listings order by (timestamp DESC NULLS LAST, id DESC). PostgreSQL gets
+# that order in the index itself; SQLite can't declare it, but walks the
+# ascending index backwards to the same effect.
+
+LISTING_ORDER_OPS = {
+    "creation_date": "DESC NULLS LAST",
+    "post_id": "DESC",
+    "last_active": "DESC NULLS LAST",
+    "id": "DESC",
+}
+
+db.Index(
+    "ix_posts_active_listing",
+    Post.creation_date,
+    Post.post_id,
+    postgresql_ops=LISTING_ORDER_OPS,
+    postgresql_where=(Post.active == True),
+    sqlite_where=(Post.active == True),
+)
+
+db.Index(
+    "ix_posts_active_paid_listing",
+    Post.creation_date,
+    Post.post_id,
+    postgresql_ops=LISTING_ORDER_OPS,
+    postgresql_where=((Post.active == True) & (Post.unpaid == False)),
+    sqlite_where=((Post.active == True) & (Post.unpaid == False)),
+)
+
+db.Index("ix_posts_user_id", Post.user_id)
+
+db.Index("ix_posts_zipcode", Post.zipcode)
+
+db.Index(
+    "ix_posts_active_gig_date_end",
+    Post.gig_date_end,
+    postgresql_where=(Post.active == True),
+    sqlite_where=(Post.active == True),
+)
+
+db.Index(
+    "ix_posts_active_gig_date_start",
+    Post.gig_date_start,
+    postgresql_where=((Post.active == True) & (Post.gig_date_end == None)),
+    sqlite_where=((Post.active == True) & (Post.gig_date_end == None)),
+)
+
+db.Index(
+    "ix_users_artist_listing",
+    User.last_active,
+    User.id,
+    postgresql_ops=LISTING_ORDER_OPS,
+    postgresql_where=((User.is_artist == True) & (User.verified == True)),
+    sqlite_where=((User.is_artist == True) & (User.verified == True)),
+)
+
+# Weekday filters: days_mask IN (every mask with the wanted days)
+db.Index(
+    "ix_users_artist_days_mask",
+    User.days_mask,
+    postgresql_where=((User.is_artist == True) & (User.verified == True)),
+    sqlite_where=((User.is_artist == True) & (User.verified == True)),
+)
+
+# The primary keys lead with tag_id, for tag filters; these serve tag loading
+db.Index("ix_posts_tags_post_id", posts_tags.c.post_id)
+
+db.Index("ix_users_tags_user_id", users_tags.c.user_id)
+
+db.Index("ix_zipcodes_region", Zipcode.region)
+
+db.Index("ix_zipcodes_location_name", Zipcode.location_name)
+
+# The dispatcher's queue: unsent emails, oldest due first
+db.Index(
+    "ix_email_outbox_pending",
+    OutboxEmail.send_after,
+    postgresql_where=(OutboxEmail.sent_at == None),
+    sqlite_where=(OutboxEmail.sent_at == None),
+)
+
+db.Index("ix_unavailability_user_id", Unavailability.user_id)
+
+db.Index("ix_users_zipcode", User.zipcode)
+
+# A gig page reads its suggestions best first; a user change finds theirs
+db.Index("ix_artist_matches_post_score", ArtistMatch.post_id, ArtistMatch.score)
+
+db.Index("ix_artist_matches_user_id", ArtistMatch.user_id)
+
+# Artist availability compares tsranges of whole days; GiST indexes them for
+# overlap (&&).
+# migrations/005_unavailability_ranges.sql adds it to an existing database.
+event.listen(
+    Unavailability.__table__,
+    "after_create",
+    DDL(
+        "CREATE INDEX ix_unavailability_during ON unavailability USING gist "
+        "(tsrange(date_trunc('day', start_range_date), "
+        "date_trunc('day', coalesce(end_range_date, start_range_date)), '[]')) "
+        "WHERE start_range_date IS NOT NULL"
+    ).execute_if(dialect="postgresql"),
+)
+
+# PostgreSQL fills search_vector on every insert and update.
+# migrations/001_fulltext_search.sql adds the same to an existing database.
+event.listen(
+    Post.__table__,
+    "after_create",
+    DDL(
+        "CREATE TRIGGER posts_search_vector_update BEFORE INSERT OR UPDATE "
+        "ON posts FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger("
+        "search_vector, 'pg_catalog.english', post_title, description)"
+    ).execute_if(dialect="postgresql"),
+)
+
+event.listen(
+    User.__table__,
+    "after_create",
+    DDL(
+        "CREATE TRIGGER users_search_vector_update BEFORE INSERT OR UPDATE "
+        "ON users FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger("
+        "search_vector, 'pg_catalog.english', user_name, bio)"
+    ).execute_if(dialect="postgresql"),
 )
 
 #####################################################################
 # Database Seed Functions
 
 
-def connect_to_db(app):
+def connect_to_db(app, db_uri="postgresql:///bayart"):
     """Connect the database to our Flask app."""
 
-    app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql:///bayart"
+    app.config["SQLALCHEMY_DATABASE_URI"] = db_uri
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     # app.config['SQLALCHEMY_ECHO'] = True
     db.app = app
@@ -257,6 +511,7 @@ def seed_posts():
 
 #     for i in range(1, 80):
 #         fuser_id = randint(1, 50)
+    fake = get_fake()
     fpost_date = fake.date_between(start_date="-3y", end_date="today")
     is_pay = randint(0, 1)
 
@@ -349,53 +604,12 @@ def seed_tags():
 
 
 def seed_zipcodes():
-    """Strips zipcodes from raw html txt file and adds to database.
-    Must seed BEFORE posts."""
-    file = open("non_server_files/raw_zipcodes.txt")
-    text = file.read()
-    file.close()
-    words = text.split(">")
-    shorter_list = []
-    final_list = set()
-
-    for word in words:
-        try:
-            to_add = word[0].isdigit()
-        except:
-            to_add = False
-        if to_add:
-            shorter_list.append(word[:5])
-
-    for code in shorter_list:
-        if code.isdigit():
-            final_list.add(code)
-
-    names_file = open("non_server_files/zip_code_database_placenames.csv")
-    names_text = names_file.readlines()
-    names_file.close()
-    zip_dict = {}
-
-    for names_line in names_text:
-        names_line_split = names_line.split(",")
-        zip_dict[names_line_split[0]] = names_line_split[3]
-
-    zip_list = list(final_list)
-
-    final_dict = {}
-
-    for k, v in zip_dict.items():
-        if k in zip_list:
-            final_dict[k] = v
-
-    for k, v in final_dict.items():
-        nv = v.replace('"', "")
-        new_zcode = Zipcode(valid_zipcode=k, location_name=nv)
-        db.session.add(new_zcode)
-
-    remote = Zipcode(valid_zipcode=00000, location_name="Remote")
-    db.session.add(remote)
+    """Loads zipcodes, with their place names and regions, from the files in
+    non_server_files (see zipcodes.py). Must seed BEFORE posts."""
 
-    db.session.commit()
+    from zipcodes import load_zipcodes
+
+    load_zipcodes()
 
 
 def seed_all():
@@ -405,260 +619,6 @@ def seed_all():
     seed_users()
     # seed_posts()
 
-    zips = Zipcode.query.all()
-
-    san_francisco = {"San Francisco"}
-    peninsula = {
-        "Belmont",
-        "Brisbane",
-        "Burlingame",
-        "El Granada",
-        "Half Moon Bay",
-        "La Honda",
-        "Loma Mar",
-        "Los Altos",
-        "Daly City",
-        "Menlo Park",
-        "Atherton",
-        "Portola Valley",
-        "Millbrae",
-        "Montara",
-        "Moss Beach",
-        "Mountain View",
-        "Pacifica",
-        "Pescadero",
-        "Redwood City",
-        "San Bruno",
-        "San Carlos",
-        "San Gregorio",
-        "South San Francisco",
-        "Sunnyvale",
-        "Palo Alto",
-        "Stanford",
-        "San Mateo",
-    }
-    north_bay_and_northland = {
-        "American Canyon",
-        "Angwin",
-        "Calistoga",
-        "Fairfield",
-        "Napa",
-        "Oakville",
-        "Pope Valley",
-        "Deer Park",
-        "Rio Vista",
-        "Rutherford",
-        "Saint Helena",
-        "Suisun City",
-        "Suisun City",
-        "Vallejo",
-        "Yountville",
-        "San Rafael",
-        "Greenbrae",
-        "Belvedere Tiburon",
-        "Bodega",
-        "Bodega Bay",
-        "Bolinas",
-        "Corte Madera",
-        "Rohnert Park",
-        "Dillon Beach",
-        "Fairfax",
-        "Cotati",
-        "Forest Knolls",
-        "Inverness",
-        "Lagunitas",
-        "Larkspur",
-        "Marshall",
-        "Mill Valley",
-        "Novato",
-        "Nicasio",
-        "Olema",
-        "Penngrove",
-        "Petaluma",
-        "Point Reyes Station",
-        "Ross",
-        "San Anselmo",
-        "San Geronimo",
-        "San Quentin",
-        "Sausalito",
-        "Stinson Beach",
-        "Tomales",
-        "Valley Ford",
-        "Woodacre",
-        "Jenner",
-        "The Sea Ranch",
-        "Windsor",
-        "Villa Grande",
-        "Stewarts Point",
-        "Sonoma",
-        "Sebastopol",
-        "Rio Nido",
-        "Occidental",
-        "Monte Rio",
-        "Middletown",
-        "Kenwood",
-        "Healdsburg",
-        "Guerneville",
-        "Gualala",
-        "Graton",
-        "Glen Ellen",
-        "Geyserville",
-        "Fulton",
-        "Forestville",
-        "El Verano",
-        "Duncans Mills",
-        "Cloverdale",
-        "Clearlake",
-        "Cazadero",
-        "Camp Meeker",
-        "Boyes Hot Springs",
-        "Annapolis",
-        "Santa Rosa",
-    }
-    east_bay = {
-        "Alameda",
-        "Discovery Bay",
-        "Danville",
-        "Alamo",
-        "Antioch",
-        "Benicia",
-        "Bethel Island",
-        "Birds Landing",
-        "Brentwood",
-        "Byron",
-        "Canyon",
-        "Concord",
-        "Pleasant Hill",
-        "Crockett",
-        "Diablo",
-        "El Cerrito",
-        "Fremont",
-        "Hayward",
-        "Castro Valley",
-        "Hercules",
-        "Knightsen",
-        "Lafayette",
-        "Livermore",
-        "Martinez",
-        "Moraga",
-        "Newark",
-        "Oakley",
-        "Orinda",
-        "Pinole",
-        "Pittsburg",
-        "Pleasanton",
-        "Dublin",
-        "Port Costa",
-        "Moraga",
-        "Rodeo",
-        "San Leandro",
-        "San Ramon",
-        "San Lorenzo",
-        "Sunol",
-        "Union City",
-        "Oakland",
-        "Emeryville",
-        "Berkeley",
-        "Albany",
-        "Richmond",
-        "El Sobrante",
-        "Richmond",
-        "San Pablo",
-        "Clayton",
-        "Walnut Creek",
-    }
-    south_bay = {
-        "Alviso",
-        "Aptos",
-        "Ben Lomond",
-        "Boulder Creek",
-        "Brookdale",
-        "Campbell",
-        "Capitola",
-        "Castroville",
-        "Coyote",
-        "Cupertino",
-        "Davenport",
-        "Felton",
-        "Freedom",
-        "Gilroy",
-        "Hollister",
-        "Los Gatos",
-        "Milpitas",
-        "Morgan Hill",
-        "Mount Hermon",
-        "Paicines",
-        "San Juan Bautista",
-        "San Martin",
-        "Santa Clara",
-        "Santa Cruz",
-        "Scotts Valley",
-        "Saratoga",
-        "Soquel",
-        "Tres Pinos",
-        "Watsonville",
-        "San Jose",
-        "Mount Hamilton",
-        "Aromas",
-    }
-    sacramento_stockon = {
-        "Stockton",
-        "Acampo",
-        "Travis Afb",
-        "Clements",
-        "Farmington",
-        "French Camp",
-        "Holt",
-        "Linden",
-        "Lockeford",
-        "Lodi",
-        "Valley Springs",
-        "Victor",
-        "Wallace",
-        "Woodbridge",
-        "Tracy",
-        "Escalon",
-        "Lathrop",
-        "Manteca",
-        "Modesto",
-        "Oakdale",
-        "Ripon",
-        "Sacramento",
-        "Winters",
-        "Walnut Grove",
-        "Thornton",
-        "Pioneer",
-        "Loomis",
-        "Lincoln",
-        "Galt",
-        "Fair Oaks",
-        "Elmira",
-        "Dixon",
-        "Davis",
-        "Auburn",
-        "Vernalis",
-        "Riverbank",
-        "Vacaville",
-    }
-
-    for zipco in zips:
-        if zipco.location_name in san_francisco:
-            zipco.region = "San Francisco"
-        elif zipco.location_name in peninsula:
-            zipco.region = "Peninsula"
-        elif zipco.location_name in north_bay_and_northland:
-            zipco.region = "North Bay and Northland"
-        elif zipco.location_name in east_bay:
-            zipco.region = "East Bay"
-        elif zipco.location_name in south_bay:
-            zipco.region = "South Bay"
-        elif zipco.location_name in sacramento_stockon:
-            zipco.region = "Sacramento and Stockton"
-        else:
-            zipco.region = "Remote"
-
-    db.session.commit()
-
 
 if __name__ == "__main__":
     from server import app
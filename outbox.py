@@ -0,0 +1,263 @@
+"""BayArt - Bay Area Art Connection Project: transactional email outbox
+
+Pages never talk to SendGrid themselves. queue_email adds a row to the
+email_outbox table in the page's own transaction, so the email exists exactly
+when the change it is about (e.g. a new user) does. An EmailDispatcher thread
+then sends pending emails in batches through a transport:
+
+    SendGridTransport  the SendGrid v3 API, over one pooled HTTP session
+    SmtpTransport      any SMTP server, e.g. a local debugging sink:
+                       python3 -m smtpd -n -c DebuggingServer localhost:1025
+    MemoryTransport    keeps sent emails in a list, for tests
+
+Failed sends are retried with exponential backoff, up to MAX_ATTEMPTS times.
+Pending emails can also be sent from the command line:
+
+    FLASK_APP=server.py flask send-emails
+"""
+
+import smtplib
+import threading
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from model import db, OutboxEmail
+
+DEFAULT_FROM_EMAIL = "noreply@bayartconnect.com"
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 6
+# Retries wait 30s, 1m, 2m, 4m, ... up to MAX_BACKOFF
+BASE_BACKOFF = timedelta(seconds=30)
+MAX_BACKOFF = timedelta(hours=1)
+
+
+class SendGridTransport(object):
+    """Sends through the SendGrid v3 mail API. One requests.Session is
+    shared by every send, so connections to SendGrid are reused."""
+
+    API_URL = "https://api.sendgrid.com/v3/mail/send"
+
+    def __init__(self, api_key, timeout=10, pool_size=4):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(
+            {"content-type": "application/json", "Authorization": "Bearer " + api_key}
+        )
+        # Retrying is the outbox's job, not the adapter's
+        self.session.mount(
+            "https://", HTTPAdapter(pool_maxsize=pool_size, max_retries=0)
+        )
+
+    def send(self, email):
+        payload = {
+            "personalizations": [
+                {"to": [{"email": email.to_email}], "subject": email.subject}
+            ],
+            "from": {"email": email.from_email},
+            "content": [{"type": "text/plain", "value": email.body}],
+        }
+
+        response = self.session.post(self.API_URL, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+
+
+class SmtpTransport(object):
+    """Sends through an SMTP server, one connection per batch."""
+
+    def __init__(self, host="localhost", port=1025, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def send(self, email):
+        self.send_batch([email])
+
+    def send_batch(self, emails):
+        """Sends emails over one connection. Returns [(email, error or None)]."""
+
+        results = []
+
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            for email in emails:
+                message = EmailMessage()
+                message["From"] = email.from_email
+                message["To"] = email.to_email
+                message["Subject"] = email.subject
+                message.set_content(email.body)
+
+                try:
+                    smtp.send_message(message)
+                    results.append((email, None))
+                except smtplib.SMTPException as e:
+                    results.append((email, e))
+
+        return results
+
+
+class MemoryTransport(object):
+    """Records emails instead of sending them."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, email):
+        self.sent.append(
+            {
+                "from_email": email.from_email,
+                "to_email": email.to_email,
+                "subject": email.subject,
+                "body": email.body,
+            }
+        )
+
+
+def queue_email(to_email, subject, body, from_email=DEFAULT_FROM_EMAIL):
+    """Adds an email to the outbox. It is only sent once the caller commits."""
+
+    email = OutboxEmail(
+        from_email=from_email, to_email=to_email, subject=subject, body=body
+    )
+    db.session.add(email)
+
+    return email
+
+
+def queue_verification_email(to_email, user_name, veri_code):
+    return queue_email(
+        to_email,
+        "Verification Code From BayArt",
+        f"Hi {user_name}!\nYour verification code is {veri_code}.",
+    )
+
+
+def backoff(attempts):
+    """How long to wait before trying an email again after attempts failures."""
+
+    return min(BASE_BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+
+
+def pending_emails(now, batch_size=BATCH_SIZE):
+    """Returns a query for up to batch_size emails due to be sent at now.
+    On PostgreSQL the rows are locked, and rows another dispatcher has
+    locked are skipped, so several server processes can share the outbox."""
+
+    return (
+        OutboxEmail.query.filter(
+            OutboxEmail.sent_at == None,
+            OutboxEmail.send_after <= now,
+            OutboxEmail.attempts < MAX_ATTEMPTS,
+        )
+        .order_by(OutboxEmail.send_after, OutboxEmail.email_id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+
+
+def _send_each(transport, emails):
+    if hasattr(transport, "send_batch"):
+        return transport.send_batch(emails)
+
+    results = []
+    for email in emails:
+        try:
+            transport.send(email)
+            results.append((email, None))
+        except Exception as e:
+            results.append((email, e))
+
+    return results
+
+
+def dispatch_pending(transport, now=None, batch_size=BATCH_SIZE):
+    """Sends one batch of due emails and commits the outcome.
+    Returns the number of emails sent."""
+
+    if now is None:
+        now = datetime.now()
+
+    emails = pending_emails(now, batch_size).all()
+
+    if not emails:
+        db.session.rollback()
+        return 0
+
+    try:
+        results = _send_each(transport, emails)
+    except Exception as e:
+        # The whole batch failed, e.g. the SMTP server is down
+        results = [(email, e) for email in emails]
+
+    sent = 0
+    for email, error in results:
+        email.attempts += 1
+        if error is None:
+            email.sent_at = now
+            email.last_error = None
+            sent += 1
+        else:
+            email.last_error = str(error)
+            email.send_after = now + backoff(email.attempts)
+
+    db.session.commit()
+
+    return sent
+
+
+class EmailDispatcher(object):
+    """Sends outbox emails on a background thread: every interval seconds,
+    or straight away after wake()."""
+
+    def __init__(self, app, transport, interval=60):
+        self.app = app
+        self.transport = transport
+        self.interval = interval
+        self.thread = None
+        self.woken = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def wake(self):
+        """Asks for pending emails to be sent now. Call after committing
+        queued emails."""
+
+        self.start()
+        self.woken.set()
+
+    def start(self):
+        # Started on first use, so forked server workers each get their own
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="email-dispatcher", daemon=True
+                )
+                self.thread.start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.woken.wait(self.interval)
+            self.woken.clear()
+
+            if self.stopped.is_set():
+                break
+
+            with self.app.app_context():
+                try:
+                    # Keep going while whole batches are due
+                    while dispatch_pending(self.transport) == BATCH_SIZE:
+                        pass
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.error("Email dispatch failed: %s", e)
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self.stopped.set()
+        self.woken.set()
+
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,76 @@
+"""BayArt - Bay Area Art Connection Project: keyset pagination for listings
+
+Listings are ordered newest first by a timestamp column, with the primary key
+breaking ties. Instead of an OFFSET, each page asks for the rows after the last
+one shown, so every page costs the same however deep it is.
+A cursor is the last row's timestamp and id, e.g. "2019-06-01T12:30:00.000000,42";
+rows with no timestamp sort last and their cursors have an empty timestamp.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+CURSOR_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def encode_cursor(sort_value, row_id):
+    if sort_value is None:
+        return f",{row_id}"
+
+    return f"{sort_value.strftime(CURSOR_FORMAT)},{row_id}"
+
+
+def decode_cursor(cursor):
+    """Returns (sort_value, row_id) for a cursor, or None if it is malformed."""
+
+    try:
+        sort_text, row_id = cursor.split(",")
+        if sort_text == "":
+            return None, int(row_id)
+        return datetime.strptime(sort_text, CURSOR_FORMAT), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def keyset_query(query, sort_column, id_column, cursor, page_size):
+    """Returns query narrowed to the page after cursor, plus one extra row
+    that tells whether there is a next page."""
+
+    query = query.order_by(None).order_by(
+        sort_column.desc().nullslast(), id_column.desc()
+    )
+
+    position = decode_cursor(cursor) if cursor else None
+
+    if position is not None:
+        sort_value, row_id = position
+        if sort_value is None:
+            query = query.filter(sort_column == None, id_column < row_id)
+        else:
+            query = query.filter(
+                or_(
+                    sort_column < sort_value,
+                    and_(sort_column == sort_value, id_column < row_id),
+                    sort_column == None,
+                )
+            )
+
+    return query.limit(page_size + 1)
+
+
+def keyset_page(query, sort_column, id_column, cursor, page_size):
+    """Returns (rows, next_cursor) for the page of query after cursor.
+    next_cursor is None on the last page."""
+
+    rows = keyset_query(query, sort_column, id_column, cursor, page_size).all()
+
+    if len(rows) <= page_size:
+        return rows, None
+
+    rows = rows[:page_size]
+    last = rows[-1]
+
+    return rows, encode_cursor(
+        getattr(last, sort_column.key), getattr(last, id_column.key)
+    )
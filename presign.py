@@ -0,0 +1,74 @@
+"""BayArt - Bay Area Art Connection Project: presigned S3 URL cache
+
+Profile and avatar images are private S3 objects shown through presigned
+URLs. A signed URL stays valid for EXPIRES_IN seconds, so it is kept and
+handed out again until it gets within REFRESH_MARGIN of expiring.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+EXPIRES_IN = 30000
+REFRESH_MARGIN = 3000
+MAX_SIZE = 10000
+
+
+class PresignedUrlCache(object):
+    """An LRU cache of presigned get_object URLs, keyed by (bucket, key)."""
+
+    def __init__(
+        self,
+        s3_client,
+        expires_in=EXPIRES_IN,
+        refresh_margin=REFRESH_MARGIN,
+        max_size=MAX_SIZE,
+    ):
+        self.s3_client = s3_client
+        self.expires_in = expires_in
+        self.refresh_margin = refresh_margin
+        self.max_size = max_size
+        self.urls = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _sign(self, bucket, key):
+        return self.s3_client.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=self.expires_in
+        )
+
+    def get(self, bucket, key):
+        """Returns a URL for the object that is valid for at least
+        refresh_margin more seconds."""
+
+        return self.get_many(bucket, [key])[key]
+
+    def get_many(self, bucket, keys):
+        """Returns {key: url} for several objects in one bucket,
+        signing only the ones without a usable cached URL."""
+
+        now = time.time()
+        urls = {}
+        missing = []
+
+        with self.lock:
+            for key in keys:
+                cached = self.urls.get((bucket, key))
+                if cached is not None and cached[1] - now > self.refresh_margin:
+                    self.urls.move_to_end((bucket, key))
+                    urls[key] = cached[0]
+                else:
+                    missing.append(key)
+
+        # Signing is done outside the lock; it is local but not free
+        signed = {key: self._sign(bucket, key) for key in set(missing)}
+
+        with self.lock:
+            for key, url in signed.items():
+                self.urls[(bucket, key)] = (url, now + self.expires_in)
+                self.urls.move_to_end((bucket, key))
+            while len(self.urls) > self.max_size:
+                self.urls.popitem(last=False)
+
+        urls.update(signed)
+
+        return urls
@@ -0,0 +1,120 @@
+"""BayArt - Bay Area Art Connection Project: reference data cache
+
+Tags and zipcodes hardly ever change, but every form page lists them.
+They are loaded once into plain tuples and reused until a commit changes a
+Tag or Zipcode, which bumps the cache version. MAX_AGE bounds how stale
+another worker process's copy can get.
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from model import db, Tag, Zipcode
+
+MAX_AGE = 300
+
+TagRow = namedtuple("TagRow", ["tag_id", "tag_name"])
+
+ReferenceData = namedtuple(
+    "ReferenceData",
+    [
+        # TagRows sorted by name
+        "tags",
+        # distinct Zipcode.location_name, sorted
+        "locations",
+        # distinct Zipcode.region, sorted
+        "regions",
+        # location_name -> lowest zipcode in it, for new and edited posts
+        "location_zipcodes",
+        # every valid zipcode, sorted
+        "zipcodes",
+        # zipcode -> (latitude, longitude), for zipcodes with a known center
+        "centroids",
+    ],
+)
+
+_cache = {"version": 0, "loaded_version": None, "loaded_at": 0, "data": None}
+_cache_lock = threading.Lock()
+
+
+def _load_reference_data():
+    tags = [
+        TagRow(tag_id, tag_name)
+        for tag_id, tag_name in db.session.query(Tag.tag_id, Tag.tag_name)
+    ]
+    tags.sort(key=lambda tag: tag.tag_name)
+
+    zip_rows = db.session.query(
+        Zipcode.valid_zipcode,
+        Zipcode.location_name,
+        Zipcode.region,
+        Zipcode.latitude,
+        Zipcode.longitude,
+    ).all()
+
+    location_zipcodes = {}
+    centroids = {}
+    for valid_zipcode, location_name, region, latitude, longitude in sorted(
+        zip_rows, key=lambda zip_row: zip_row.valid_zipcode
+    ):
+        location_zipcodes.setdefault(location_name, valid_zipcode)
+        if latitude != None and longitude != None:
+            centroids[valid_zipcode] = (latitude, longitude)
+
+    return ReferenceData(
+        tags=tags,
+        locations=sorted(location_zipcodes),
+        regions=sorted(set(zip_row.region for zip_row in zip_rows)),
+        location_zipcodes=location_zipcodes,
+        zipcodes=sorted(zip_row.valid_zipcode for zip_row in zip_rows),
+        centroids=centroids,
+    )
+
+
+def get_reference_data():
+    """Returns the cached ReferenceData, reloading it if it is out of date."""
+
+    with _cache_lock:
+        if (
+            _cache["loaded_version"] != _cache["version"]
+            or time.time() - _cache["loaded_at"] > MAX_AGE
+        ):
+            version = _cache["version"]
+            _cache["data"] = _load_reference_data()
+            _cache["loaded_version"] = version
+            _cache["loaded_at"] = time.time()
+
+        return _cache["data"]
+
+
+def invalidate_reference_data():
+    """Makes the next get_reference_data reload from the database."""
+
+    with _cache_lock:
+        _cache["version"] += 1
+
+
+@event.listens_for(Tag, "after_insert")
+@event.listens_for(Tag, "after_update")
+@event.listens_for(Tag, "after_delete")
+@event.listens_for(Zipcode, "after_insert")
+@event.listens_for(Zipcode, "after_update")
+@event.listens_for(Zipcode, "after_delete")
+def _mark_reference_data_changed(mapper, connection, target):
+    object_session(target).info["reference_data_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    # Only once the change is visible to other sessions
+    if session.info.pop("reference_data_changed", False):
+        invalidate_reference_data()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_changes(session):
+    session.info.pop("reference_data_changed", None)
@@ -0,0 +1,168 @@
+"""BayArt - Bay Area Art Connection Project: per-route request stats
+
+Every request is measured, by endpoint:
+
+    request.latency        wall time, in seconds
+    request.db_time        time spent running SQL, in seconds (see dbstats.py)
+    request.sql_count      SQL statements run
+    request.rows_loaded    ORM objects loaded
+    request.template_time  time spent in render_template, in seconds
+
+The measurements are totalled in the process and served at /metrics in
+the Prometheus text format, for a quick look from the server:
+
+    curl http://127.0.0.1:5000/metrics
+
+/metrics only answers requests from the server itself; nginx.conf keeps
+it private.
+
+When Datadog is configured, each measurement is also sent as a ThreadStats
+histogram tagged endpoint:<name>. Otherwise nothing leaves the process.
+"""
+
+import threading
+import time
+
+from flask import Response, abort, g, request, template_rendered, before_render_template
+
+from dbstats import request_query_count, request_query_time, request_rows_loaded
+from services import NullStats
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (measurement, Prometheus name, help text)
+MEASUREMENTS = [
+    ("latency", "bayart_request_latency_seconds", "Request wall time"),
+    ("db_time", "bayart_request_db_seconds", "Time spent running SQL"),
+    ("sql_count", "bayart_request_sql_statements", "SQL statements run"),
+    ("rows_loaded", "bayart_request_rows_loaded", "ORM objects loaded"),
+    ("template_time", "bayart_request_template_seconds", "Time spent rendering templates"),
+]
+
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+
+
+class RouteStats(object):
+    """Running totals of request measurements, by endpoint."""
+
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, measured):
+        with self.lock:
+            route = self.routes.get(endpoint)
+            if route is None:
+                route = self.routes[endpoint] = {
+                    "count": 0,
+                    "sums": dict.fromkeys(measured, 0),
+                    "latency_buckets": [0] * len(LATENCY_BUCKETS),
+                }
+
+            route["count"] += 1
+            for name, value in measured.items():
+                route["sums"][name] += value
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if measured["latency"] <= bound:
+                    route["latency_buckets"][i] += 1
+
+    def render(self):
+        """Returns the totals in the Prometheus text exposition format."""
+
+        with self.lock:
+            routes = {
+                endpoint: {
+                    "count": route["count"],
+                    "sums": dict(route["sums"]),
+                    "latency_buckets": list(route["latency_buckets"]),
+                }
+                for endpoint, route in self.routes.items()
+            }
+
+        lines = []
+
+        for measurement, metric, help_text in MEASUREMENTS:
+            if measurement == "latency":
+                metric_type = "histogram"
+            else:
+                metric_type = "summary"
+
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {metric_type}")
+
+            for endpoint, route in sorted(routes.items()):
+                label = f'endpoint="{endpoint}"'
+
+                if measurement == "latency":
+                    for bound, count in zip(LATENCY_BUCKETS, route["latency_buckets"]):
+                        lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {count}')
+                    lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {route["count"]}')
+
+                lines.append(f"{metric}_sum{{{label}}} {route['sums'][measurement]}")
+                lines.append(f"{metric}_count{{{label}}} {route['count']}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _template_started(app, template, context, **extra):
+    g.template_started = time.perf_counter()
+
+
+def _template_finished(app, template, context, **extra):
+    started = g.pop("template_started", None)
+    if started is not None:
+        g.template_time = g.get("template_time", 0.0) + time.perf_counter() - started
+
+
+def init_request_stats(app, stats_client=None):
+    """Measures every request made to app and serves their totals at
+    /metrics. The measurements are also sent to stats_client (a datadog
+    ThreadStats) if one is given. Returns the RouteStats holding the totals."""
+
+    if stats_client is None:
+        stats_client = NullStats()
+
+    route_stats = RouteStats()
+
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+
+    @app.before_request
+    def start_request_stats():
+        g.request_started = time.perf_counter()
+        g.template_time = 0.0
+
+    @app.after_request
+    def record_request_stats(response):
+        started = g.get("request_started")
+        if started is None:
+            return response
+
+        endpoint = request.endpoint or "unmatched"
+        measured = {
+            "latency": time.perf_counter() - started,
+            "db_time": request_query_time(),
+            "sql_count": request_query_count(),
+            "rows_loaded": request_rows_loaded(),
+            "template_time": g.get("template_time", 0.0),
+        }
+
+        route_stats.record(endpoint, measured)
+
+        tags = [f"endpoint:{endpoint}"]
+        for name, value in measured.items():
+            stats_client.histogram(f"request.{name}", value, tags=tags)
+
+        return response
+
+    @app.route("/metrics")
+    def request_metrics():
+        """Request totals by endpoint, for the server's own use."""
+
+        if request.remote_addr not in LOCAL_ADDRESSES:
+            abort(404)
+
+        return Response(route_stats.render(), mimetype="text/plain; version=0.0.4")
+
+    return route_stats
@@ -0,0 +1,140 @@
+"""BayArt - Bay Area Art Connection Project: search queries
+
+Each search form is compiled into one SQLAlchemy query, so filtering,
+de-duplication, ordering and paging all happen in the database.
+Keyword matching goes through the full-text index in fulltext.py.
+"""
+
+from sqlalchemy import case
+from sqlalchemy.orm import joinedload, selectinload
+
+from model import db, User, Post, Zipcode, posts_tags, users_tags
+from fulltext import search_posts, search_users
+from weekdays import masks_with_any, masks_with_all
+
+
+def distance_order(zipcode_column, distances):
+    """An ORDER BY expression putting rows from nearer zipcodes first.
+    distances maps zipcodes to miles."""
+
+    return case(distances, value=zipcode_column)
+
+
+def _near(query, ordering, zipcode_column, zipcodes, nearest_first):
+    query = query.filter(zipcode_column.in_(sorted(zipcodes)))
+
+    if nearest_first and zipcodes:
+        ordering.insert(0, distance_order(zipcode_column, zipcodes))
+
+    return query
+
+
+def gig_search_query(
+    search=None,
+    tag_ids=None,
+    region=None,
+    show_unpaid=True,
+    user_id=None,
+    zipcodes=None,
+    nearest_first=False,
+):
+    """Returns a query for active posts matching every given filter.
+    Each post's zipcode and tags are loaded with it, for the listing.
+
+    search: words matched against the title and description,
+        best matches first.
+    tag_ids: posts with at least one of these tags.
+    region: a Zipcode.region name.
+    show_unpaid: when False, unpaid posts are left out.
+    user_id: only this user's posts.
+    zipcodes: {zipcode: miles}, posts in these zipcodes (see spatial.py).
+    nearest_first: order by the zipcodes' miles before anything else."""
+
+    query = Post.query.filter(Post.active == True).options(
+        joinedload(Post.zipcodes), selectinload(Post.tags)
+    )
+    ordering = []
+
+    if user_id is not None:
+        query = query.filter(Post.user_id == user_id)
+
+    if not show_unpaid:
+        query = query.filter(Post.unpaid == False)
+
+    if search:
+        query, relevance = search_posts(query, search)
+        ordering.append(relevance)
+
+    if tag_ids:
+        # A semi-join: a post matching several tags still comes back once
+        query = query.filter(
+            Post.post_id.in_(
+                db.session.query(posts_tags.c.post_id).filter(
+                    posts_tags.c.tag_id.in_([int(tag_id) for tag_id in tag_ids])
+                )
+            )
+        )
+
+    if region:
+        query = query.join(Zipcode, Zipcode.valid_zipcode == Post.zipcode).filter(
+            Zipcode.region == region
+        )
+
+    if zipcodes is not None:
+        query = _near(query, ordering, Post.zipcode, zipcodes, nearest_first)
+
+    return query.order_by(*ordering, Post.creation_date.desc(), Post.post_id.desc())
+
+
+def artist_search_query(
+    search=None,
+    tag_ids=None,
+    weekday=None,
+    days_any=None,
+    days_all=None,
+    zipcodes=None,
+    nearest_first=False,
+):
+    """Returns a query for verified artists matching every given filter.
+    Each artist's tags are loaded with it, for the listing.
+
+    search: words matched against the bio and user name, best matches first.
+    tag_ids: artists with at least one of these tags.
+    weekday: 0 (Sunday) to 6 (Saturday), artists available on that day.
+    days_any: weekdays, artists available on at least one of them.
+    days_all: weekdays, artists available on every one of them.
+    zipcodes: {zipcode: miles}, artists based in these zipcodes.
+    nearest_first: order by the zipcodes' miles before anything else."""
+
+    query = User.query.filter(User.is_artist == True, User.verified == True).options(
+        selectinload(User.tags)
+    )
+    ordering = []
+
+    if search:
+        query, relevance = search_users(query, search)
+        ordering.append(relevance)
+
+    if tag_ids:
+        query = query.filter(
+            User.id.in_(
+                db.session.query(users_tags.c.user_id).filter(
+                    users_tags.c.tag_id.in_([int(tag_id) for tag_id in tag_ids])
+                )
+            )
+        )
+
+    # Each is an IN list over the 128 possible masks (see weekdays.py)
+    if weekday is not None:
+        query = query.filter(User.days_mask.in_(masks_with_any([weekday])))
+
+    if days_any:
+        query = query.filter(User.days_mask.in_(masks_with_any(days_any)))
+
+    if days_all:
+        query = query.filter(User.days_mask.in_(masks_with_all(days_all)))
+
+    if zipcodes is not None:
+        query = _near(query, ordering, User.zipcode, zipcodes, nearest_first)
+
+    return query.order_by(*ordering, User.last_active.desc(), User.id.desc())
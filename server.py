@@ -16,7 +16,7 @@ app = Flask(__name__)
 
 from flask_bootstrap import Bootstrap
 from jinja2 import StrictUndefined
-from datetime import datetime, timedelta
+from datetime import datetime
 from flask_login import (
     LoginManager,
     UserMixin,
@@ -29,52 +29,88 @@ from flask_login import (
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from flask_sqlalchemy import SQLAlchemy
-import json
 import urllib.request
 import os
-import io
-import requests
-from flask_debugtoolbar import DebugToolbarExtension
-from model import connect_to_db, db, User, Post, Zipcode, Tag
+from model import connect_to_db, db, User, Post, Tag, Unavailability
 from random import randint
 
-# Image upload and resizing tools
-import boto3
-from PIL import Image
-from area import area
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-from sendgridpy import send_email, verify_email
-
-from datadog import (
-    initialize,
+# S3, Datadog and SendGrid load on first use (see services.py)
+from services import (
+    s3,
+    s3_client,
+    stats,
     statsd,
-    api,
-    ThreadStats,
+    sendgrid_transport,
+    datadog_configured,
+)
+from search import gig_search_query, artist_search_query
+from availability import available_artists_query, gig_artists_query
+from weekdays import is_daysweek, parse_weekday
+from expiry import expire_gigs, start_expiry_timer
+from zipcodes import load_zipcodes
+from facets import ARTISTS, GIGS, get_facet_counts, rebuild_facet_counts
+from spatial import nearest_gigs, zipcodes_within
+from matching import MatchRefresher, refresh_all_matches, suggested_artists
+from pagination import keyset_page
+from dbstats import init_query_budget
+from requeststats import init_request_stats
+from refdata import get_reference_data, invalidate_reference_data
+from presign import PresignedUrlCache
+from metrics import MetricsBuffer, DatadogSink, NullSink
+from outbox import EmailDispatcher, dispatch_pending, queue_verification_email
+from imagepipeline import ImagePipeline, S3Store, IMAGE_SLOTS, image_keys, is_image
+from geodata import (
+    get_zip_geometry,
+    get_area_geometry,
+    get_geometry_json,
+    load_geometry,
+    DEFAULT_MAPZOOM,
+    DEFAULT_MAPCENTER,
 )
 
-from datadog.api.constants import CheckStatus
+# 404 events and checks are buffered and sent in the background (see metrics.py),
+# to Datadog when it is configured. Tests can swap in StatsdSink pointed at a
+# local UDP socket.
+app.config["METRICS_FLUSH_INTERVAL"] = 10
+if datadog_configured():
+    metrics_sink = DatadogSink()
+else:
+    metrics_sink = NullSink()
+metrics = MetricsBuffer(metrics_sink, flush_interval=app.config["METRICS_FLUSH_INTERVAL"])
 
-dogApiKey = os.environ['DOG_API_KEY']
-dogAppKey = os.environ['DOG_APP_KEY']
+login_manager = LoginManager()
+login_manager.init_app(app)
 
-options = {
-    'api_key':dogApiKey,
-    'app_key':dogAppKey
-}
+# Set QUERY_BUDGET in tests to fail pages that run too many SQL statements
+init_query_budget(app)
 
-initialize(**options)
+# Per-endpoint latency, SQL and template timings, totalled at /metrics and
+# sent to Datadog when it is configured (see requeststats.py)
+route_stats = init_request_stats(app, stats if datadog_configured() else None)
 
-stats = ThreadStats()
-stats.start()
+S3_BUCKET = "bayart"
 
-login_manager = LoginManager()
-login_manager.init_app(app)
+# Signed image URLs are reused until close to expiry (see presign.py)
+presigned_urls = PresignedUrlCache(s3_client)
+
+# Profile pictures are processed off the request thread (see imagepipeline.py).
+# Tests can swap in LocalStore for the S3 store.
+app.config["IMAGE_WORKERS"] = 2
+image_pipeline = ImagePipeline(
+    app, S3Store(s3, S3_BUCKET), workers=app.config["IMAGE_WORKERS"]
+)
 
-s3 = boto3.resource("s3")
-s3_client = boto3.client("s3")
+# Emails are queued in the email_outbox table and sent in the background
+# (see outbox.py). Tests can swap in MemoryTransport for SendGrid.
+app.config["EMAIL_DISPATCH_INTERVAL"] = 60
+email_dispatcher = EmailDispatcher(
+    app, sendgrid_transport, interval=app.config["EMAIL_DISPATCH_INTERVAL"]
+)
 
-app.secret_key = os.environ['FLASK_SECRET_KEY']
+# Each gig's suggested artists are stored, and refreshed in the background
+# after posts or artists change (see matching.py). MATCH_REFRESH_DELAY, in
+# seconds, gathers bursts of changes into one refresh; it is read each time.
+match_refresher = MatchRefresher(app)
 
 app.jinja_env.undefined = StrictUndefined
 
@@ -84,11 +120,202 @@ ALLOWED_EXTENSIONS = set(["png", "jpg", "jpeg", "gif", "webp"])
 
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 
+## gig map shapes served by /geometry
+# Douglas-Peucker tolerance in degrees (0.0005 is about 50 meters)
+app.config["GEOMETRY_TOLERANCE"] = 0.0005
+# Decimal places kept per coordinate (5 is about 1 meter)
+app.config["GEOMETRY_PRECISION"] = 5
+# How long browsers and nginx may reuse a shape, in seconds
+app.config["GEOMETRY_MAX_AGE"] = 86400
+
+## search results
+app.config["SEARCH_PAGE_SIZE"] = 50
+
+## gigs and artists shown per page of /gigs and /artists
+app.config["LISTING_PAGE_SIZE"] = 50
+
+## past gigs are deactivated this often, in seconds (see expiry.py)
+app.config["GIG_EXPIRY_INTERVAL"] = 3600
+
+
+def parse_form_date(value):
+    """Returns a datetime for a YYYY-MM-DD form value, or None."""
+
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_near():
+    """Reads the "near" zipcode and "miles" search fields. Returns
+    {zipcode: miles} for the zipcodes in range, or None if either field is
+    missing or the zipcode's location isn't known. zipcodes_within caps
+    miles at MAX_MILES."""
+
+    near = request.values.get("near", "").strip()
+    miles = request.values.get("miles", "")
+
+    # isdecimal, unlike isdigit, only passes what int() accepts
+    if not near.isdecimal() or not miles.isdecimal():
+        return None
+
+    zipcodes = zipcodes_within(int(near), int(miles))
+
+    if zipcodes == None:
+        flash(f"We don't know where {near} is, so distance was left out.")
+
+    return zipcodes
+
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def render_gig_listing(posts_query, endpoint="display_gigs"):
+    """Renders one page of gigs.html for a Post query, newest first.
+    The page starts after the "after" cursor, and the next page link
+    points at endpoint."""
+
+    posts, next_after = keyset_page(
+        posts_query,
+        Post.creation_date,
+        Post.post_id,
+        request.args.get("after"),
+        app.config["LISTING_PAGE_SIZE"],
+    )
+
+    next_url = None
+    if next_after:
+        next_url = url_for(endpoint, after=next_after)
+
+    # No total: counting every match would cost more the bigger the catalog
+    first_url = None
+    if request.args.get("after"):
+        first_url = url_for(endpoint)
+
+    return render_template(
+        "gigs.html",
+        posts=posts,
+        post_count=None,
+        next_url=next_url,
+        first_url=first_url,
+    )
+
+
+PROFILE_IMAGE_WIDTH = 240
+AVATAR_WIDTH = 64
+
+
+def signed_image_urls(keys_by_name):
+    """Takes {name: {"webp": key or None, "jpeg": key}} and returns the same
+    shape with presigned URLs, signed together rather than one call per image."""
+
+    keys = [
+        key
+        for variants in keys_by_name.values()
+        for key in variants.values()
+        if key != None
+    ]
+    urls = presigned_urls.get_many(S3_BUCKET, keys)
+
+    return {
+        name: {
+            extension: urls[key] if key != None else None
+            for extension, key in variants.items()
+        }
+        for name, variants in keys_by_name.items()
+    }
+
+
+def profile_image_urls(user):
+    """Returns {"webp": url or None, "jpeg": url} for a user's profile picture."""
+
+    return signed_image_urls(
+        {"img_route": image_keys(user, "img_route", PROFILE_IMAGE_WIDTH)}
+    )["img_route"]
+
+
+def portfolio_image_urls(user):
+    """Returns [{"webp": url or None, "jpeg": url}] for the portfolio slots
+    the user has uploaded a picture to."""
+
+    img_variants = user.img_variants or {}
+    slots = [slot for slot in IMAGE_SLOTS[1:] if slot in img_variants]
+    urls = signed_image_urls(
+        {slot: image_keys(user, slot, PROFILE_IMAGE_WIDTH) for slot in slots}
+    )
+
+    return [urls[slot] for slot in slots]
+
+
+def artist_avatar_urls(artists):
+    """Returns {artist id: {"webp": url or None, "jpeg": url}} for the
+    artists' profile pictures, at avatar size."""
+
+    return signed_image_urls(
+        {
+            artist.id: image_keys(artist, "img_route", AVATAR_WIDTH)
+            for artist in artists
+        }
+    )
+
+
+def render_artist_listing(artists_query, endpoint="display_artists", **url_values):
+    """Renders one page of artists.html for a User query, most recently
+    active first. url_values fill in the endpoint's URL."""
+
+    artists, next_after = keyset_page(
+        artists_query,
+        User.last_active,
+        User.id,
+        request.args.get("after"),
+        app.config["LISTING_PAGE_SIZE"],
+    )
+
+    next_url = None
+    if next_after:
+        next_url = url_for(endpoint, after=next_after, **url_values)
+
+    # No total, as in render_gig_listing
+    first_url = None
+    if request.args.get("after"):
+        first_url = url_for(endpoint, **url_values)
+
+    return render_template(
+        "artists.html",
+        artists=artists,
+        artistcount=None,
+        next_url=next_url,
+        first_url=first_url,
+        avatar_urls=artist_avatar_urls(artists),
+    )
+
+
+def gig_json(post):
+    return {
+        "post_id": post.post_id,
+        "post_title": post.post_title,
+        "description": post.description,
+        "creation_date": post.creation_date.isoformat() if post.creation_date else None,
+        "unpaid": post.unpaid,
+        "region": post.zipcodes.region,
+        "location_name": post.zipcodes.location_name,
+        "tags": [tag.tag_name for tag in post.tags],
+        "url": url_for("display_active_gig", post_id=post.post_id),
+    }
+
+
+def artist_json(artist):
+    return {
+        "id": artist.id,
+        "user_name": artist.user_name,
+        "bio": artist.bio,
+        "tags": [tag.tag_name for tag in artist.tags],
+        "url": url_for("display_public_user", id=artist.id),
+    }
+
+
 ###############
 
 
@@ -109,16 +336,15 @@ def unauthorized_callback():
 @app.errorhandler(404)
 def page_not_found(e):
     """This is a custom 404 page.
-    This 404 page also sends a POST request to DataDog
-    to log an event every time a user encounters a 404 error"""
+    This 404 page also logs a DataDog event every time a user encounters
+    a 404 error. It is buffered, and sent in the background."""
 
     check = 'app.ok'
     host = 'app1'
-    status = CheckStatus.OK  # equals 0
+    status = 0  # CheckStatus.OK
     tags = ['env:test']
 
-    chk = api.ServiceCheck.check(check=check, host_name=host, status=status, message='Response: 200 OK', tags=tags)
-
+    metrics.service_check(check, status, host=host, tags=tags, message='Response: 200 OK')
 
     title = "A user encountered an error 404"
 
@@ -129,14 +355,8 @@ def page_not_found(e):
 
     tags = ['Added:2019', 'application:webapp']
 
-    api.Event.create(title=title, text=text, tags=tags)
-
-    url = "https://api.datadoghq.com/api/v1/events?api_key=" + dogApiKey + "&application_key=" + dogAppKey + "&datadog_site=com"
-      
-    # sending post request and saving response as response object 
-    r = requests.post(url = url, data = {'title' : title, 'text' : text, 'tags' : tags }) 
-
-    print(r.status_code, r.reason)
+    metrics.event(title, text, tags=tags)
+    metrics.increment('page.not_found', tags=tags)
 
     flash("Error 404, page not found.")
 
@@ -212,28 +432,32 @@ def about_page():
 
     bode = User.query.filter(User.id == 1).one()
 
-    image = bode.img_route
+    image = profile_image_urls(bode)
 
-    url = s3_client.generate_presigned_url(
-        "get_object", Params={"Bucket": "bayart", "Key": image}, ExpiresIn=30000
-    )
-
-    return render_template("about.html", bode=bode, url=url)
+    return render_template("about.html", bode=bode, image=image)
 
 
 @app.route("/artists")
 def display_artists():
-    """Renders a page with all artists info."""
+    """Renders a page of artists, most recently active first."""
 
-    artists = (
-        User.query.filter(User.is_artist == True, User.verified == True)
-        .order_by(User.last_active.desc())
-        .all()
-    )
+    return render_artist_listing(artist_search_query())
 
-    artistcount = len(artists)
 
-    return render_template("artists.html", artists=artists, artistcount=artistcount)
+@app.route("/artists.json")
+def display_artists_json():
+    """One page of artists as JSON, for infinite scroll.
+    Pass the returned "next" cursor as ?after= to get the following page."""
+
+    artists, next_after = keyset_page(
+        artist_search_query(),
+        User.last_active,
+        User.id,
+        request.args.get("after"),
+        app.config["LISTING_PAGE_SIZE"],
+    )
+
+    return jsonify(artists=[artist_json(artist) for artist in artists], next=next_after)
 
 
 @app.route("/searchartists", methods=["GET", "POST"])
@@ -241,25 +465,19 @@ def display_artists():
 def display_artist_results():
     """Basic string query artist search function"""
 
-    search_string = request.form["search"]
-    search_string = "%" + search_string + "%"
-
-    artists = (
-        User.query.filter(
-            ((User.bio.ilike(search_string)) | (User.user_name.ilike(search_string))),
-            User.is_artist == True,
-            User.verified == True,
-        )
-        .order_by(User.last_active.desc())
-        .all()
-    )
+    artists = artist_search_query(search=request.form["search"]).all()
 
     if artists == []:
         flash("No artists matched your search.")
 
     artistcount = len(artists)
 
-    return render_template("artists.html", artists=artists, artistcount=artistcount)
+    return render_template(
+        "artists.html",
+        artists=artists,
+        artistcount=artistcount,
+        avatar_urls=artist_avatar_urls(artists),
+    )
 
 
 @app.route("/advancedartistsearch", methods=["GET", "POST"])
@@ -267,80 +485,91 @@ def display_artist_results():
 def advanced_artist_search_page():
     """Displays the page for advanced artist search"""
 
-    tags = Tag.query.all()
-
-    def sort_tag_name(val):
-        return val.tag_name
+    tags = get_reference_data().tags
 
-    tags.sort(key=sort_tag_name)
+    facets = get_facet_counts(ARTISTS)
 
-    return render_template("advancedartistssearch.html", tags=tags)
+    return render_template(
+        "advancedartistssearch.html", tags=tags, tag_counts=facets.get("tag", {})
+    )
 
 
 @app.route("/searchartistsadvance", methods=["GET", "POST"])
 @login_required
 def advanced_artist_query():
-    """This route processes an advanced artist search."""
-
-    s_users = (
-        User.query.filter(User.is_artist == True, User.verified == True)
-        .order_by(User.last_active.desc())
-        .all()
-    )
-    t_users = (
-        User.query.filter(User.is_artist == True, User.verified == True)
-        .order_by(User.last_active.desc())
-        .all()
-    )
+    """This route processes an advanced artist search.
+    The form may also arrive as a GET query string, for the next page links."""
 
-    b_users = (
-    User.query.filter(User.is_artist == True, User.verified == True)
-    .order_by(User.last_active.desc())
-    .all()
-    )
+    # "alldays", or anything that isn't a weekday, leaves weekdays out
+    weekday = parse_weekday(request.values.get("availability"))
 
-    if request.form.get("search", False):
-        search_string = "%" + request.form["search"] + "%"
-        s_users = (
-            User.query.filter(
-                (
-                    (User.bio.ilike(search_string))
-                    | (User.user_name.ilike(search_string))
-                ),
-                User.is_artist == True,
-                User.verified == True,
-            )
-            .order_by(User.last_active.desc())
-            .all()
-        )
+    # Optional dates the artist must be free for, as YYYY-MM-DD
+    available_from = parse_form_date(request.values.get("available_from"))
+    available_to = parse_form_date(request.values.get("available_to"))
 
-    if request.form.get("tag", False):
-        tags = request.form.getlist("tag")
-        t_users = []
-        for tag in tags:
+    # Several weekdays, matched on any or all of them
+    days = [
+        parse_weekday(day)
+        for day in request.values.getlist("day")
+        if parse_weekday(day) != None
+    ]
+    days_match = request.values.get("days_match", "any")
 
-            tag_one = Tag.query.filter(Tag.tag_id == tag).one()
+    search = dict(
+        search=request.values.get("search", ""),
+        tag_ids=request.values.getlist("tag"),
+        weekday=weekday,
+    )
+    if days_match == "all":
+        search["days_all"] = days
+    else:
+        search["days_any"] = days
 
-            t_users.extend(tag_one.users)
+    # Nearest first, within miles of a zipcode
+    zipcodes = parse_near()
+    if zipcodes != None:
+        search["zipcodes"] = zipcodes
+        search["nearest_first"] = True
 
-    if request.form.get("availability", "alldays") != "alldays":
-        a_day = request.form["availability"]
-        a_users = []
-        for useb in b_users:
-            days_string = useb.daysweek
+    if available_from != None:
+        artists_query = available_artists_query(available_from, available_to, **search)
+    else:
+        artists_query = artist_search_query(**search)
 
-            if days_string[(int(a_day))] == "t":
-                a_users.append(useb)
+    artists_page = artists_query.paginate(
+        request.args.get("page", 1, type=int), app.config["SEARCH_PAGE_SIZE"], False
+    )
 
-    venn_s_t = [a for a in s_users for b in t_users if a == b]
-    artists = [c for c in venn_s_t for d in a_users if c == d]
+    artists = artists_page.items
 
     if artists == []:
         flash("No posting matched your search criteria.")
 
-    artistcount = len(artists)
+    artistcount = artists_page.total
+
+    next_url = None
+    if artists_page.has_next:
+        next_url = url_for(
+            "advanced_artist_query",
+            page=artists_page.next_num,
+            search=request.values.get("search", ""),
+            tag=request.values.getlist("tag"),
+            availability="alldays" if weekday == None else weekday,
+            day=days,
+            days_match=days_match,
+            available_from=request.values.get("available_from", ""),
+            available_to=request.values.get("available_to", ""),
+            near=request.values.get("near", ""),
+            miles=request.values.get("miles", ""),
+        )
 
-    return render_template("artists.html", artists=artists, artistcount=artistcount)
+    return render_template(
+        "artists.html",
+        artists=artists,
+        artistcount=artistcount,
+        next_url=next_url,
+        avatar_urls=artist_avatar_urls(artists),
+    )
 
 
 @app.route("/users/<int:id>")
@@ -355,13 +584,13 @@ def display_public_user(id):
 
     daysweek = list(page_user.daysweek)
 
-    image = page_user.img_route
+    image = profile_image_urls(page_user)
 
-    url = s3_client.generate_presigned_url(
-        "get_object", Params={"Bucket": "bayart", "Key": image}, ExpiresIn=30000
-    )
+    portfolio = portfolio_image_urls(page_user)
 
-    return render_template("user.html", user=page_user, daysweek=daysweek, url=url)
+    return render_template(
+        "user.html", user=page_user, daysweek=daysweek, image=image, portfolio=portfolio
+    )
 
 
 @app.route("/newpost")
@@ -369,30 +598,15 @@ def display_public_user(id):
 def display_new_post_form():
     """Renders a page with the option to post a new gig."""
 
-    zipcode_instances = Zipcode.query.filter(Zipcode.location_name != "Remote").all()
-
-    zipcodes = []
-
-    for zipcode in zipcode_instances:
-        zipcodes.append(zipcode.valid_zipcode)
-
-    locations = []
-
-    for zipcode in zipcode_instances:
-        locations.append(zipcode.location_name)
+    reference_data = get_reference_data()
 
-    locations = list(set(locations))
+    zipcodes = reference_data.zipcodes
 
-    locations.sort()
-
-    locations.insert(0, "Remote")
-
-    tags = Tag.query.all()
-
-    def sort_tag_name(val):
-        return val.tag_name
+    locations = ["Remote"] + [
+        location for location in reference_data.locations if location != "Remote"
+    ]
 
-    tags.sort(key=sort_tag_name)
+    tags = reference_data.tags
 
     return render_template(
         "new_post.html", zipcodes=zipcodes, locations=locations, tags=tags
@@ -417,14 +631,14 @@ def add_new_gig_to_database():
     else:
         unpaid = True
 
-    zipcode = Zipcode.query.filter_by(location_name=location).first()
+    zipcode = get_reference_data().location_zipcodes[location]
     user_id = current_user.id
     post_date = datetime.now()
 
     new_post = Post(
         post_title=post_title,
         description=description,
-        zipcode=zipcode.valid_zipcode,
+        zipcode=zipcode,
         creation_date=post_date,
         user_id=user_id,
         unpaid=unpaid,
@@ -453,33 +667,26 @@ def display_edit_gig_page(post_id):
     gig = Post.query.filter_by(post_id=post_id).one_or_none()
 
     if gig == None or current_user.id != gig.user_id:
-        if current_user.show_unpaid == True:
-            posts = Post.query.filter(Post.active == True).order_by(
-                Post.creation_date.desc()
-            )
-        else:
-            posts = Post.query.filter(
-                Post.active == True, Post.unpaid == False
-            ).order_by(Post.creation_date.desc())
         flash("You do not have access to edit this gig.")
-        return render_template("gigs.html", posts=posts)
-
-    locations = Zipcode.query.all()
-
-    locations = list(set([i.location_name for i in locations]))
-
-    locations.sort()
+        return render_gig_listing(
+            gig_search_query(show_unpaid=current_user.show_unpaid)
+        )
 
-    locations.insert(0, gig.zipcodes.location_name)
+    reference_data = get_reference_data()
 
-    tags = Tag.query.all()
+    locations = [gig.zipcodes.location_name] + reference_data.locations
 
-    def sort_tag_name(val):
-        return val.tag_name
+    tags = reference_data.tags
 
-    tags.sort(key=sort_tag_name)
+    gig_tag_ids = set(tag.tag_id for tag in gig.tags)
 
-    return render_template("editgig.html", gig=gig, locations=locations, tags=tags)
+    return render_template(
+        "editgig.html",
+        gig=gig,
+        locations=locations,
+        tags=tags,
+        gig_tag_ids=gig_tag_ids,
+    )
 
 
 @app.route("/submitgigedit/<int:post_id>", methods=["POST"])
@@ -490,16 +697,10 @@ def submits_gig_edit(post_id):
     gig = Post.query.filter_by(post_id=post_id).one_or_none()
 
     if gig == None or current_user.id != gig.user_id:
-        if current_user.show_unpaid == True:
-            posts = Post.query.filter(Post.active == True).order_by(
-                Post.creation_date.desc()
-            )
-        else:
-            posts = Post.query.filter(
-                Post.active == True, Post.unpaid == False
-            ).order_by(Post.creation_date.desc())
         flash("You do not have access to edit this gig.")
-        return render_template("gigs.html", posts=posts)
+        return render_gig_listing(
+            gig_search_query(show_unpaid=current_user.show_unpaid)
+        )
 
     new_tags_ids = request.form.getlist("tag")
     new_tags_list = []
@@ -520,8 +721,7 @@ def submits_gig_edit(post_id):
 
     if request.form.get("location", False):
         location = request.form["location"]
-        zipcode = Zipcode.query.filter_by(location_name=location).first()
-        gig.zipcode = zipcode.valid_zipcode
+        gig.zipcode = get_reference_data().location_zipcodes[location]
 
     unpaid = request.form["unpaid"]
 
@@ -538,58 +738,35 @@ def submits_gig_edit(post_id):
 
     db.session.commit()
 
-    if current_user.show_unpaid == True:
-        posts = (
-            Post.query.filter(Post.active == True)
-            .order_by(Post.creation_date.desc())
-            .all()
-        )
-    else:
-        posts = (
-            Post.query.filter(Post.active == True, Post.unpaid == False)
-            .order_by(Post.creation_date.desc())
-            .all()
-        )
-    post_count = len(posts)
-
     flash(f"Your gig edits have been saved.")
-    return render_template("gigs.html", posts=posts, post_count=post_count)
+    return render_gig_listing(gig_search_query(show_unpaid=current_user.show_unpaid))
 
 
 @app.route("/gigs")
 @login_required
 def display_gigs():
     """Displays a list of all posts
-    Sorts by most recent post at the top."""
+    Sorts by most recent post at the top.
+    Past gigs are deactivated by the expiry job, not here (see expiry.py)."""
 
-    posts = Post.query.filter(Post.active == True).all()
+    return render_gig_listing(gig_search_query(show_unpaid=current_user.show_unpaid))
 
-    for post in posts:
-        if post.gig_date_end and post.gig_date_end < ( datetime.now() - timedelta(days=2) ):
-            post.active = False
-        else:
-            if post.gig_date_end == None and post.gig_date_start and post.gig_date_start < (datetime.now() - timedelta(days=2)):
-                post.active = False
-    
-
-    db.session.commit()
-
-    if current_user.show_unpaid == True:
-        posts = (
-            Post.query.filter(Post.active == True)
-            .order_by(Post.creation_date.desc())
-            .all()
-        )
-    else:
-        posts = (
-            Post.query.filter(Post.active == True, Post.unpaid == False)
-            .order_by(Post.creation_date.desc())
-            .all()
-        )
 
-    post_count = len(posts)
+@app.route("/gigs.json")
+@login_required
+def display_gigs_json():
+    """One page of gigs as JSON, for infinite scroll.
+    Pass the returned "next" cursor as ?after= to get the following page."""
+
+    posts, next_after = keyset_page(
+        gig_search_query(show_unpaid=current_user.show_unpaid),
+        Post.creation_date,
+        Post.post_id,
+        request.args.get("after"),
+        app.config["LISTING_PAGE_SIZE"],
+    )
 
-    return render_template("gigs.html", posts=posts, post_count=post_count)
+    return jsonify(gigs=[gig_json(post) for post in posts], next=next_after)
 
 
 @app.route("/searchgigs", methods=["GET", "POST"])
@@ -597,16 +774,7 @@ def display_gigs():
 def display_gig_results():
     """Basic string query gig search function"""
 
-    search_string = request.form["search"]
-    search_string = "%" + search_string + "%"
-
-    posts = Post.query.filter(
-        (
-            (Post.description.ilike(search_string))
-            | (Post.post_title.ilike(search_string))
-        ),
-        Post.active == True,
-    ).all()
+    posts = gig_search_query(search=request.form["search"]).all()
 
     if posts == []:
         flash("No posting matched your search criteria.")
@@ -620,80 +788,73 @@ def display_gig_results():
 @login_required
 def advanced_search_gig_page():
 
-    tags = Tag.query.all()
-
-    def sort_tag_name(val):
-        return val.tag_name
-
-    tags.sort(key=sort_tag_name)
-
-    locations = Zipcode.query.all()
+    reference_data = get_reference_data()
 
-    locations = list(set([i.region for i in locations]))
+    tags = reference_data.tags
 
-    locations.sort()
+    locations = ["Location:"] + reference_data.regions
 
-    locations.insert(0, "Location:")
+    facets = get_facet_counts(GIGS)
 
-    return render_template("advancedgigsearch.html", tags=tags, locations=locations)
+    return render_template(
+        "advancedgigsearch.html",
+        tags=tags,
+        locations=locations,
+        tag_counts=facets.get("tag", {}),
+        region_counts=facets.get("region", {}),
+        pay_counts=facets.get("pay", {}),
+    )
 
 
 @app.route("/searchgigsadvance", methods=["GET", "POST"])
 @login_required
 def advanced_gigs_query():
-    """This route process an advanced gig search."""
+    """This route process an advanced gig search.
+    The form may also arrive as a GET query string, for the next page links."""
 
-    if current_user.show_unpaid == True:
-        s_posts = Post.query.filter(Post.active == True)
-        l_posts = Post.query.filter(Post.active == True)
-        t_posts = Post.query.filter(Post.active == True)
+    location = request.values.get("location", "Location:")
+    if location == "Location:":
+        region = None
     else:
-        s_posts = Post.query.filter(Post.active == True, Post.unpaid == False)
-        l_posts = Post.query.filter(Post.active == True, Post.unpaid == False)
-        t_posts = Post.query.filter(Post.active == True, Post.unpaid == False)
-
-    if request.form.get("search", False):
-        search_string = "%" + request.form["search"] + "%"
-        s_posts = Post.query.filter(
-            (
-                (Post.description.ilike(search_string))
-                | (Post.post_title.ilike(search_string))
-            ),
-            Post.active == True,
-        ).all()
-
-    if request.form.get("tag", False):
-
-        tags = request.form.getlist("tag")
-
-        t_posts = []
-        for tag in tags:
-
-            tag_one = Tag.query.filter(Tag.tag_id == tag).one()
-
-            t_posts.extend(tag_one.posts)
-
-    if request.form["location"] != "Location:":
-        location = request.form["location"]
-        list_of_tuples = (
-            db.session.query(Zipcode, Post)
-            .join(Post)
-            .filter(Zipcode.region == location)
-            .all()
-        )
-        l_posts = []
-        for i in list_of_tuples:
-            l_posts.append(i[1])
+        region = location
+
+    # Nearest first, within miles of a zipcode
+    zipcodes = parse_near()
+
+    posts_page = gig_search_query(
+        search=request.values.get("search", ""),
+        tag_ids=request.values.getlist("tag"),
+        region=region,
+        show_unpaid=current_user.show_unpaid,
+        zipcodes=zipcodes,
+        nearest_first=True,
+    ).paginate(
+        request.args.get("page", 1, type=int), app.config["SEARCH_PAGE_SIZE"], False
+    )
 
-    venn_s_t = [a for a in s_posts for b in t_posts if a == b]
-    posts = [c for c in venn_s_t for d in l_posts if c == d]
+    posts = posts_page.items
 
     if posts == []:
         flash("No posting matched your search criteria.")
 
-    post_count = len(posts)
+    post_count = posts_page.total
+
+    next_url = None
+    if posts_page.has_next:
+        next_url = url_for(
+            "advanced_gigs_query",
+            page=posts_page.next_num,
+            search=request.values.get("search", ""),
+            tag=request.values.getlist("tag"),
+            location=location,
+            near=request.values.get("near", ""),
+            miles=request.values.get("miles", ""),
+        )
+
+    return render_template(
+        "gigs.html", posts=posts, post_count=post_count, next_url=next_url
+    )
 
-    return render_template("gigs.html", posts=posts, post_count=post_count)
 
 @app.route("/admin")
 @login_required
@@ -702,7 +863,7 @@ def admin_page():
 
     if current_user.id == 1:
 
-        tags = Tag.query.all()
+        tags = get_reference_data().tags
 
         return render_template("admin.html", tags=tags)
     else:
@@ -735,6 +896,9 @@ def add_or_rm_tags():
 
         db.session.commit()
 
+        # The bulk delete above skips the mapper events refdata listens for
+        invalidate_reference_data()
+
     return render_template("homepage.html")
 
 
@@ -743,11 +907,29 @@ def add_or_rm_tags():
 def display_own_posts():
     """Displays a user's own posts"""
 
-    posts = Post.query.filter(Post.active == True, Post.user_id == current_user.id)
+    return render_gig_listing(
+        gig_search_query(user_id=current_user.id), endpoint="display_own_posts"
+    )
 
-    post_count = len(posts)
 
-    return render_template("gigs.html", posts=posts, post_count=post_count)
+@app.route("/gig/<int:post_id>/artists")
+@login_required
+def display_gig_artists(post_id):
+    """Renders the artists free on all of a gig's dates."""
+
+    gig = Post.query.filter_by(post_id=post_id).one_or_none()
+
+    if gig == None:
+        flash("This gig does not exist.")
+        return redirect("/gigs")
+
+    return render_artist_listing(
+        gig_artists_query(gig), endpoint="display_gig_artists", post_id=post_id
+    )
+
+
+# Other gigs listed on a gig's page, nearest first, within NEARBY_MILES
+NEARBY_GIGS = 4
 
 
 @app.route("/gig/<int:post_id>")
@@ -757,16 +939,10 @@ def display_active_gig(post_id):
     gig = Post.query.filter_by(post_id=post_id).one_or_none()
 
     if gig == None:
-        if current_user.show_unpaid == True:
-            posts = Post.query.filter(Post.active == True).order_by(
-                Post.creation_date.desc()
-            )
-        else:
-            posts = Post.query.filter(
-                Post.active == True, Post.unpaid == False
-            ).order_by(Post.creation_date.desc())
         flash("This gig does not exist.")
-        return render_template("gigs.html", posts=posts)
+        return render_gig_listing(
+            gig_search_query(show_unpaid=current_user.show_unpaid)
+        )
 
     if gig.gig_date_start == None and gig.gig_date_end == None:
         gig_date_start = None
@@ -778,272 +954,98 @@ def display_active_gig(post_id):
         gig_date_start = datetime.strftime(gig.gig_date_start, "%b %d, %Y")
         gig_date_end = datetime.strftime(gig.gig_date_end, "%b %d, %Y")
 
-    zipdata = None
-    mapzoom = 8
-    mapcenter = [-122.241026, 37.767857]
+    zipdata_url = None
+    mapzoom = DEFAULT_MAPZOOM
+    mapcenter = DEFAULT_MAPCENTER
+
+    suggested = [artist for artist, score in suggested_artists(gig.post_id)]
+    suggested_avatar_urls = artist_avatar_urls(suggested)
+
+    nearby = [
+        (post, miles)
+        for post, miles in nearest_gigs(gig.zipcode, NEARBY_GIGS + 1)
+        if post.post_id != gig.post_id
+    ][:NEARBY_GIGS]
 
     if gig.zipcodes.location_name == "Remote":
         return render_template(
             "gig.html",
-            zipdata=zipdata,
+            zipdata_url=zipdata_url,
             mapcenter=mapcenter,
             mapzoom=mapzoom,
             gig=gig,
             gig_date_start=gig_date_start,
             gig_date_end=gig_date_end,
+            suggested=suggested,
+            avatar_urls=suggested_avatar_urls,
+            nearby=nearby,
         )
 
-    with open("static/baysuburbs.geojson") as json_file:
-        data_one = json.load(json_file)
-    with open("static/sanjosesuburbs.geojson") as json_file:
-        data_two = json.load(json_file)
-
-    for locations in data_one["features"]:
-        if (locations["properties"])["zip"] == str(gig.zipcode):
-            zipdata = locations
-
-    for locations in data_two["features"]:
-        if (locations["properties"])["ZCTA"] == str(gig.zipcode):
-            zipdata = locations
-
-    if zipdata != None:
-
-        areabox = zipdata["geometry"]
-        if area(areabox) > 50000000:
-            # Area is Large. Greater than fifty million (X2, 345, 678)
-            mapzoom = 8
-        elif (area(areabox) <= 50000000) & (area(areabox) > 10000000):
-            # Area is Medium. Greater than ten million (X2, 345, 678)
-            mapzoom = 9
-        elif (area(areabox) <= 10000000) & (area(areabox) > 1500000):
-            # Area is Small. Greater than one million, 500 thousand (X, 234, 567)
-            mapzoom = 10
-        else:
-            # Area is Tiny. Less than one million, 500 thousand (X, 234, 567)
-            mapzoom = 11
-        if (
-            type(((areabox["coordinates"])[0])[0]) is list
-            and type((((areabox["coordinates"])[0])[0])[0]) is float
-        ):
-            mapcenter = ((areabox["coordinates"])[0])[0]
-        else:
-            mapcenter = (((areabox["coordinates"])[0])[0])[0]
+    zip_geometry = get_zip_geometry(gig.zipcode)
+
+    if zip_geometry != None:
+        zipdata_url = url_for("display_geometry", kind="zip", name=gig.zipcode)
+        mapzoom = zip_geometry["mapzoom"]
+        mapcenter = zip_geometry["mapcenter"]
 
     # Regions: Remote (0) | Peninsula | San Francisco
     # East Bay | North Bay and Northland | South Bay
     # Sacramento and Stockton
 
-    if zipdata == None:
+    if zipdata_url == None:
+        mapzoom = DEFAULT_MAPZOOM
         mapcenter = None
-        zipdata = {"type": "FeatureCollection", "features": []}
-
-        for my_zip in Zipcode.query.filter_by(
-            location_name=gig.zipcodes.location_name
-        ).all():
-
-            for location in data_one["features"]:
-                if (location["properties"])["zip"] == str(my_zip.valid_zipcode):
-                    zipdata["features"].append(location)
-                    if mapcenter == None:
-                        if (
-                            type(
-                                (
-                                    (
-                                        (((zipdata["features"])[0])["geometry"])[
-                                            "coordinates"
-                                        ]
-                                    )[0]
-                                )[0]
-                            )
-                            is list
-                            and type(
-                                (
-                                    (
-                                        (
-                                            (((zipdata["features"])[0])["geometry"])[
-                                                "coordinates"
-                                            ]
-                                        )[0]
-                                    )[0]
-                                )[0]
-                            )
-                            is float
-                        ):
-                            mapcenter = (
-                                (
-                                    (((zipdata["features"])[0])["geometry"])[
-                                        "coordinates"
-                                    ]
-                                )[0]
-                            )[0]
-                        else:
-                            mapcenter = (
-                                (
-                                    (
-                                        (((zipdata["features"])[0])["geometry"])[
-                                            "coordinates"
-                                        ]
-                                    )[0]
-                                )[0]
-                            )[0]
-
-            for location in data_two["features"]:
-                if (location["properties"])["ZCTA"] == str(my_zip.valid_zipcode):
-                    zipdata["features"].append(location)
-                    if mapcenter == None:
-                        if (
-                            type(
-                                (
-                                    (
-                                        (((zipdata["features"])[0])["geometry"])[
-                                            "coordinates"
-                                        ]
-                                    )[0]
-                                )[0]
-                            )
-                            is list
-                            and type(
-                                (
-                                    (
-                                        (
-                                            (((zipdata["features"])[0])["geometry"])[
-                                                "coordinates"
-                                            ]
-                                        )[0]
-                                    )[0]
-                                )[0]
-                            )
-                            is float
-                        ):
-                            mapcenter = (
-                                (
-                                    (((zipdata["features"])[0])["geometry"])[
-                                        "coordinates"
-                                    ]
-                                )[0]
-                            )[0]
-                        else:
-                            mapcenter = (
-                                (
-                                    (
-                                        (((zipdata["features"])[0])["geometry"])[
-                                            "coordinates"
-                                        ]
-                                    )[0]
-                                )[0]
-                            )[0]
-
-        mapzoom = 8
-
-    if zipdata == {"type": "FeatureCollection", "features": []}:
-
-        for my_zip in Zipcode.query.filter_by(region=gig.zipcodes.region).all():
-
-            for location in data_one["features"]:
-                if (location["properties"])["zip"] == str(my_zip.valid_zipcode):
-                    zipdata["features"].append(location)
-                    if mapcenter == None:
-                        if (
-                            type(
-                                (
-                                    (
-                                        (((zipdata["features"])[0])["geometry"])[
-                                            "coordinates"
-                                        ]
-                                    )[0]
-                                )[0]
-                            )
-                            is list
-                            and type(
-                                (
-                                    (
-                                        (
-                                            (((zipdata["features"])[0])["geometry"])[
-                                                "coordinates"
-                                            ]
-                                        )[0]
-                                    )[0]
-                                )[0]
-                            )
-                            is float
-                        ):
-                            mapcenter = (
-                                (
-                                    (((zipdata["features"])[0])["geometry"])[
-                                        "coordinates"
-                                    ]
-                                )[0]
-                            )[0]
-                        else:
-                            mapcenter = (
-                                (
-                                    (
-                                        (((zipdata["features"])[0])["geometry"])[
-                                            "coordinates"
-                                        ]
-                                    )[0]
-                                )[0]
-                            )[0]
-
-            for location in data_two["features"]:
-                if (location["properties"])["ZCTA"] == str(my_zip.valid_zipcode):
-                    zipdata["features"].append(location)
-                    if mapcenter == None:
-                        if (
-                            type(
-                                (
-                                    (
-                                        (((zipdata["features"])[0])["geometry"])[
-                                            "coordinates"
-                                        ]
-                                    )[0]
-                                )[0]
-                            )
-                            is list
-                            and type(
-                                (
-                                    (
-                                        (
-                                            (((zipdata["features"])[0])["geometry"])[
-                                                "coordinates"
-                                            ]
-                                        )[0]
-                                    )[0]
-                                )[0]
-                            )
-                            is float
-                        ):
-                            mapcenter = (
-                                (
-                                    (((zipdata["features"])[0])["geometry"])[
-                                        "coordinates"
-                                    ]
-                                )[0]
-                            )[0]
-                        else:
-                            mapcenter = (
-                                (
-                                    (
-                                        (((zipdata["features"])[0])["geometry"])[
-                                            "coordinates"
-                                        ]
-                                    )[0]
-                                )[0]
-                            )[0]
-
-        mapzoom = 8
+
+        for kind, name in [
+            ("location", gig.zipcodes.location_name),
+            ("region", gig.zipcodes.region),
+        ]:
+            area_geometry = get_area_geometry(kind, name)
+            if area_geometry != None:
+                zipdata_url = url_for("display_geometry", kind=kind, name=name)
+                mapzoom = area_geometry["mapzoom"]
+                mapcenter = area_geometry["mapcenter"]
+                break
 
     return render_template(
         "gig.html",
-        zipdata=zipdata,
+        zipdata_url=zipdata_url,
         mapcenter=mapcenter,
         mapzoom=mapzoom,
         gig=gig,
         gig_date_start=gig_date_start,
         gig_date_end=gig_date_end,
+        suggested=suggested,
+        avatar_urls=suggested_avatar_urls,
+        nearby=nearby,
     )
 
 
+@app.route("/geometry/<kind>/<name>")
+def display_geometry(kind, name):
+    """Serves the simplified map shape of a zipcode, city ("location")
+    or region as GeoJSON. Shapes rarely change, so responses carry an
+    ETag and may be cached by browsers and nginx."""
+
+    geometry_json = get_geometry_json(
+        kind,
+        name,
+        app.config["GEOMETRY_TOLERANCE"],
+        app.config["GEOMETRY_PRECISION"],
+    )
+
+    if geometry_json == None:
+        abort(404)
+
+    body, etag = geometry_json
+
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config["GEOMETRY_MAX_AGE"]
+
+    return response.make_conditional(request)
+
 
 @app.route("/availability", methods=["GET"])
 @login_required
@@ -1052,7 +1054,55 @@ def display_availability_page():
 
     daysweek = list(current_user.daysweek)
 
-    return render_template("availability.html", daysweek=daysweek)
+    unavailable = (
+        Unavailability.query.filter_by(user_id=current_user.id)
+        .order_by(Unavailability.start_range_date)
+        .all()
+    )
+
+    return render_template(
+        "availability.html", daysweek=daysweek, unavailable=unavailable
+    )
+
+
+@app.route("/unavailability", methods=["POST"])
+@login_required
+def add_unavailability():
+    """Adds a range of days the artist can't work."""
+
+    start = parse_form_date(request.form.get("start_range_date"))
+    end = parse_form_date(request.form.get("end_range_date")) or start
+
+    if start == None or end < start:
+        flash("Please choose a start date, and an end date on or after it.")
+        return redirect("/availability")
+
+    unavailable = Unavailability(
+        user_id=current_user.id, start_range_date=start, end_range_date=end
+    )
+    db.session.add(unavailable)
+    db.session.commit()
+
+    flash("You have successfully updated your availability.")
+
+    return redirect("/availability")
+
+
+@app.route("/unavailability/<int:un_id>/delete", methods=["POST"])
+@login_required
+def delete_unavailability(un_id):
+    """Removes one of the artist's unavailable ranges."""
+
+    unavailable = Unavailability.query.filter_by(
+        un_id=un_id, user_id=current_user.id
+    ).one_or_none()
+
+    if unavailable != None:
+        db.session.delete(unavailable)
+        db.session.commit()
+        flash("You have successfully updated your availability.")
+
+    return redirect("/availability")
 
 
 @app.route("/changeavailability", methods=["GET", "POST"])
@@ -1061,12 +1111,15 @@ def change_availability():
 
     new_avail = request.form.get("dates")
 
+    if not is_daysweek(new_avail):
+        flash("Please choose available or unavailable for every day.")
+        return redirect("/availability")
+
+    # Also sets days_mask, for weekday searches
     current_user.daysweek = new_avail
 
     db.session.commit()
 
-    daysweek = list(new_avail)
-
     flash("You have successfully updated your availability.")
 
     return redirect("/availability")
@@ -1128,10 +1181,6 @@ def register_process():
         )
         return redirect("/")
 
-    from_email = "noreply@bayartconnect.com"
-    # verify_email()
-    send_email(from_email, display_email, user_name, veri_code)
-
     new_user = User(
         user_name=user_name,
         password=password,
@@ -1141,8 +1190,13 @@ def register_process():
         veri_code=veri_code,
     )
     db.session.add(new_user)
+    # verify_email()
+    queue_verification_email(display_email, user_name, veri_code)
     db.session.commit()
 
+    # Sent by the dispatcher thread, not while the user waits
+    email_dispatcher.wake()
+
     if new_user.is_authenticated:
         login_user(new_user)
 
@@ -1163,21 +1217,10 @@ def verify_user():
         current_user.verified = True
         db.session.commit()
 
-        if current_user.show_unpaid == True:
-            posts = (
-                Post.query.filter(Post.active == True)
-                .order_by(Post.creation_date.desc())
-                .all()
-            )
-        else:
-            posts = (
-                Post.query.filter(Post.active == True, Post.unpaid == False)
-                .order_by(Post.creation_date.desc())
-                .all()
-            )
-        post_count = len(posts)
         flash("Thank you for verification.")
-        return render_template("gigs.html", posts=posts, post_count=post_count)
+        return render_gig_listing(
+            gig_search_query(show_unpaid=current_user.show_unpaid)
+        )
 
     flash("Your code does not match the verification code. Please try again.")
     return render_template("homepage.html")
@@ -1186,7 +1229,7 @@ def verify_user():
 @app.route("/changepic")
 @login_required
 def display_change_profile_picture():
-    """Displays a form with a single option to upload a file"""
+    """Displays a form to upload a profile or portfolio picture"""
 
     return render_template("changepic.html")
 
@@ -1197,39 +1240,37 @@ def upload_image():
     """Handles uploading an image"""
 
     file = request.files["file"]
-    user = User.query.get(current_user.id)
+
+    slot = request.form.get("slot", "img_route")
+
+    if slot not in IMAGE_SLOTS:
+        flash("Unknown picture slot.")
+        return redirect("/changepic")
 
     if file.filename == "":
         flash("No selected file")
         return redirect("/changepic")
 
-    if allowed_file(file.filename):
+    if not allowed_file(file.filename):
+        flash("Incorrent image format.")
+        return redirect("/changepic")
 
-        num = randint(10000000, 99999999)
+    num = randint(10000000, 99999999)
+    if slot == "img_route":
         file_name = f"{current_user.email[0:4]}_profilepic_{num}"
+    else:
+        file_name = f"{current_user.email[0:4]}_portfolio_{num}"
 
-        user.img_route = file_name
-
-        image = Image.open(file)
-
-        image.thumbnail([400, 400])
-
-        in_mem_file = io.BytesIO()
-
-        image.save(in_mem_file, format="JPEG", quality=95)
-
-        file = in_mem_file.getvalue()
+    raw = file.read()
 
-        db.session.commit()
-
-    else:
+    if not is_image(raw):
         flash("Incorrent image format.")
         return redirect("/changepic")
-    # s3.Bucket(os.environ.get('S3_BUCKET')).put_object(Key=file.filename, Body=file)
 
-    s3.Bucket("bayart").put_object(Key=file_name, Body=file)
+    # Resized and uploaded in the background; the slot changes when it's done
+    image_pipeline.submit(current_user.id, raw, file_name, slot)
 
-    flash("Image successfully uploaded.")
+    flash("Image successfully uploaded. Your new picture will appear in a moment.")
     flashstyle = "alert-success"
     return redirect("/profile")
 
@@ -1263,21 +1304,27 @@ def user_profile():
 
         email = "".join(elist)
 
-    tags = Tag.query.all()
+    tags = get_reference_data().tags
+    locations = get_reference_data().locations
 
-    def sort_tag_name(value):
-        return value.tag_name
+    user_tag_ids = set(tag.tag_id for tag in current_user.tags)
 
-    tags.sort(key=sort_tag_name)
+    user_location = None
+    if current_user.zipcode != None:
+        user_location = current_user.zipcodes.location_name
 
-    image = current_user.img_route
+    image = profile_image_urls(current_user)
 
-    url = s3_client.generate_presigned_url(
-        "get_object", Params={"Bucket": "bayart", "Key": image}, ExpiresIn=30000
+    return render_template(
+        "profile.html",
+        email=email,
+        tags=tags,
+        user_tag_ids=user_tag_ids,
+        locations=locations,
+        user_location=user_location,
+        image=image,
     )
 
-    return render_template("profile.html", email=email, tags=tags, url=url)
-
 
 @app.route("/update_info", methods=["POST"])
 def update_user_info():
@@ -1334,24 +1381,128 @@ def update_user_info():
     if request.form.get("phone", False):
         current_user.phone = request.form["phone"]
 
+    location = request.form.get("location")
+    if location == "":
+        current_user.zipcode = None
+    elif location != None:
+        location_zipcodes = get_reference_data().location_zipcodes
+        if location in location_zipcodes:
+            current_user.zipcode = location_zipcodes[location]
+
     db.session.commit()
 
     flash(f"Your information has been updated.")
     return redirect("/profile")
 
 
+@app.cli.command("expire-gigs")
+def expire_gigs_command():
+    """Deactivates gigs that ended more than two days ago."""
+
+    connect_to_db(app)
+
+    print(f"Deactivated {expire_gigs()} past gigs.")
+
+
+@app.cli.command("refresh-matches")
+def refresh_matches_command():
+    """Rebuilds every gig's suggested artists."""
+
+    connect_to_db(app)
+
+    print(f"Matched artists to {refresh_all_matches()} active gigs.")
+
+
+@app.cli.command("refresh-facets")
+def refresh_facets_command():
+    """Recounts the gigs and artists behind each search facet."""
+
+    connect_to_db(app)
+
+    print(f"Counted {rebuild_facet_counts()} search facets.")
+
+
+@app.cli.command("load-zipcodes")
+def load_zipcodes_command():
+    """Adds new zipcodes and updates changed ones from non_server_files."""
+
+    connect_to_db(app)
+
+    inserted, updated, unchanged = load_zipcodes()
+
+    print(f"Zipcodes: {inserted} added, {updated} updated, {unchanged} unchanged.")
+
+
+@app.cli.command("send-emails")
+def send_emails_command():
+    """Sends every email in the outbox that is due."""
+
+    connect_to_db(app)
+
+    sent = 0
+    while True:
+        batch_sent = dispatch_pending(email_dispatcher.transport)
+        sent += batch_sent
+        if batch_sent == 0:
+            break
+
+    print(f"Sent {sent} emails.")
+
+
 ###############################################################
 
 
+def create_app(db_uri=None):
+    """Reads the app's secrets, connects it to the database and loads what
+    pages need up front. S3, Datadog and SendGrid wait until first use.
+    Safe to call more than once; only the first call does anything.
+    wsgi.py calls this in every server worker."""
+
+    if app.config.get("BAYART_READY"):
+        return app
+
+    app.secret_key = os.environ["FLASK_SECRET_KEY"]
+
+    if db_uri == None:
+        db_uri = os.environ.get("DATABASE_URL", "postgresql:///bayart")
+
+    connect_to_db(app, db_uri)
+
+    # Load the zipcode polygons before the first gig page asks for them
+    with app.app_context():
+        load_geometry()
+
+    app.config["BAYART_READY"] = True
+
+    return app
+
+
+def start_background_jobs(app):
+    """Starts the threads that run outside of requests. Call once per process,
+    after it has forked (gunicorn.conf.py does this for each worker)."""
+
+    # Every worker runs the timer, but an advisory lock lets only one of them
+    # expire gigs at a time; the others skip that turn (see expiry.py)
+    start_expiry_timer(app, app.config["GIG_EXPIRY_INTERVAL"])
+
+    # Picks up emails left unsent by an earlier run
+    email_dispatcher.start()
+
+
 if __name__ == "__main__":
+    # Development server only; production runs gunicorn (see gunicorn.conf.py)
+
     # We have to set debug=True here, since it has to be True at the point
     # that we invoke the DebugToolbarExtension
 
     # Do not debug for demo
 
-    connect_to_db(app)
+    create_app()
+
+    start_background_jobs(app)
 
     # Use the DebugToolbar
+    # from flask_debugtoolbar import DebugToolbarExtension
     # DebugToolbarExtension(app)
 
     app.run(host="0.0.0.0")
@@ -0,0 +1,131 @@
+"""BayArt - Bay Area Art Connection Project: lazily created services
+
+boto3, Datadog and SendGrid are slow to import, and need credentials from
+the environment. Each service here is a Lazy stand-in that imports and
+builds the real object the first time an attribute is used, so importing
+server.py (a worker booting, a test starting) pays for none of them, and a
+page that never touches S3 never loads boto3.
+
+Metrics are optional. Without DOG_API_KEY and DOG_APP_KEY, or without the
+datadog package, stats and statsd become a NullStats that drops everything.
+"""
+
+import importlib.util
+import os
+import threading
+
+
+class Lazy(object):
+    """Stands in for the object factory() returns, building it on first use."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class NullStats(object):
+    """Stands in for a Datadog client when Datadog isn't configured. Every
+    method (increment, histogram, gauge, event, flush...) does nothing."""
+
+    def _ignore(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return self._ignore
+
+
+def datadog_installed():
+    return importlib.util.find_spec("datadog") is not None
+
+
+def datadog_configured():
+    """Whether metrics can go to Datadog: the package is installed and
+    DOG_API_KEY and DOG_APP_KEY are set. Checked without importing datadog."""
+
+    return (
+        bool(os.environ.get("DOG_API_KEY"))
+        and bool(os.environ.get("DOG_APP_KEY"))
+        and datadog_installed()
+    )
+
+
+_datadog_lock = threading.Lock()
+_datadog_ready = []
+
+
+def init_datadog():
+    """Gives the datadog package its API keys. Safe to call repeatedly."""
+
+    with _datadog_lock:
+        if not _datadog_ready:
+            from datadog import initialize
+
+            initialize(
+                api_key=os.environ["DOG_API_KEY"], app_key=os.environ["DOG_APP_KEY"]
+            )
+            _datadog_ready.append(True)
+
+
+def _s3_resource():
+    import boto3
+
+    return boto3.resource("s3")
+
+
+def _s3_client():
+    import boto3
+
+    return boto3.client("s3")
+
+
+def _thread_stats():
+    if not datadog_configured():
+        return NullStats()
+
+    init_datadog()
+
+    from datadog import ThreadStats
+
+    thread_stats = ThreadStats()
+    thread_stats.start()
+
+    return thread_stats
+
+
+def _dogstatsd():
+    # Needs no keys, only the package and a local agent to listen
+    if not datadog_installed():
+        return NullStats()
+
+    from datadog import statsd
+
+    return statsd
+
+
+def _sendgrid_transport():
+    from outbox import SendGridTransport
+
+    return SendGridTransport(os.environ["SENDGRID_API_KEY"])
+
+
+s3 = Lazy(_s3_resource)
+s3_client = Lazy(_s3_client)
+
+# Datadog metrics sent over HTTP from a background thread. A NullStats
+# when Datadog isn't configured, so pages never need it.
+stats = Lazy(_thread_stats)
+# Datadog metrics sent over UDP to the local agent, or a NullStats
+statsd = Lazy(_dogstatsd)
+
+sendgrid_transport = Lazy(_sendgrid_transport)
@@ -0,0 +1,197 @@
+"""BayArt - Bay Area Art Connection Project: distance searches by zipcode
+
+Gigs and artists are placed by zipcode, and each Zipcode row stores its
+center (see zipcodes.py). Distances are measured between those centers.
+
+The centers are kept in memory in a ZipcodeGrid: buckets of CELL_DEGREES
+square, so a search only measures the zipcodes in the buckets near it.
+The grid is built from the reference data cache (refdata.py) and rebuilt
+whenever that reloads.
+
+A search turns into a short list of zipcodes, and then into
+Post.zipcode IN (...) or User.zipcode IN (...). Those use ix_posts_zipcode
+and ix_users_zipcode, so no search reads every post or artist:
+
+    gigs_within(94608, 10)            active gigs within 10 miles
+    nearest_gigs(94608, 5)            the 5 nearest active gigs within
+                                      NEARBY_MILES, with miles, in one query
+    artists_within, nearest_artists   the same for verified artists
+
+A radius is capped at MAX_MILES, so one search can't sweep the whole grid.
+"""
+
+import math
+import threading
+
+from refdata import get_reference_data
+from search import gig_search_query, artist_search_query
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE = 69.0
+
+# About 7 miles north to south, 5.5 east to west here
+CELL_DEGREES = 0.1
+
+# The widest radius a search can ask for
+MAX_MILES = 100
+
+# How far nearest_gigs and nearest_artists look
+NEARBY_MILES = 25
+
+
+def haversine_miles(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle distance between two points, in miles."""
+
+    phi1 = math.radians(latitude1)
+    phi2 = math.radians(latitude2)
+    half_dphi = (phi2 - phi1) / 2
+    half_dlambda = math.radians(longitude2 - longitude1) / 2
+
+    a = (
+        math.sin(half_dphi) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(half_dlambda) ** 2
+    )
+
+    return 2 * EARTH_RADIUS_MILES * math.asin(min(1.0, math.sqrt(a)))
+
+
+class ZipcodeGrid(object):
+    """Zipcode centers bucketed by latitude and longitude."""
+
+    def __init__(self, centroids, cell_degrees=CELL_DEGREES):
+        self.centroids = dict(centroids)
+        self.cell_degrees = cell_degrees
+        self.cells = {}
+
+        for zipcode, (latitude, longitude) in self.centroids.items():
+            self.cells.setdefault(self._cell(latitude, longitude), []).append(zipcode)
+
+    def _cell(self, latitude, longitude):
+        return (
+            int(math.floor(latitude / self.cell_degrees)),
+            int(math.floor(longitude / self.cell_degrees)),
+        )
+
+    def within(self, latitude, longitude, miles):
+        """Returns {zipcode: distance in miles} for every zipcode whose center
+        is within miles of the point."""
+
+        latitude_span = miles / MILES_PER_DEGREE
+        longitude_span = miles / (
+            MILES_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01)
+        )
+
+        low_row, low_column = self._cell(
+            latitude - latitude_span, longitude - longitude_span
+        )
+        high_row, high_column = self._cell(
+            latitude + latitude_span, longitude + longitude_span
+        )
+
+        box_cells = (high_row - low_row + 1) * (high_column - low_column + 1)
+        if box_cells > len(self.cells):
+            # A wide box is mostly empty; look at the cells that aren't
+            cells = [
+                cell
+                for cell in self.cells
+                if low_row <= cell[0] <= high_row and low_column <= cell[1] <= high_column
+            ]
+        else:
+            cells = [
+                (row, column)
+                for row in range(low_row, high_row + 1)
+                for column in range(low_column, high_column + 1)
+            ]
+
+        found = {}
+        for cell in cells:
+            for zipcode in self.cells.get(cell, ()):
+                distance = haversine_miles(latitude, longitude, *self.centroids[zipcode])
+                if distance <= miles:
+                    found[zipcode] = distance
+
+        return found
+
+
+_grid = {"reference_data": None, "grid": None}
+_grid_lock = threading.Lock()
+
+
+def get_zipcode_grid():
+    """Returns the ZipcodeGrid for the current reference data."""
+
+    reference_data = get_reference_data()
+
+    with _grid_lock:
+        if _grid["reference_data"] is not reference_data:
+            _grid["grid"] = ZipcodeGrid(reference_data.centroids)
+            _grid["reference_data"] = reference_data
+
+        return _grid["grid"]
+
+
+def zipcodes_within(zipcode, miles):
+    """Returns {zipcode: distance in miles} for the zipcodes within miles
+    (at most MAX_MILES) of zipcode's center, or None when that center isn't
+    known."""
+
+    grid = get_zipcode_grid()
+    center = grid.centroids.get(int(zipcode))
+    if center is None:
+        return None
+
+    return grid.within(center[0], center[1], min(miles, MAX_MILES))
+
+
+def gigs_within(zipcode, miles, nearest_first=False, **search):
+    """Returns gig_search_query(**search) narrowed to gigs within miles of
+    zipcode, or to none if zipcode's center isn't known. They stay newest
+    first unless nearest_first."""
+
+    return gig_search_query(
+        zipcodes=zipcodes_within(zipcode, miles) or {},
+        nearest_first=nearest_first,
+        **search
+    )
+
+
+def artists_within(zipcode, miles, nearest_first=False, **search):
+    """Returns artist_search_query(**search) narrowed to artists based
+    within miles of zipcode."""
+
+    return artist_search_query(
+        zipcodes=zipcodes_within(zipcode, miles) or {},
+        nearest_first=nearest_first,
+        **search
+    )
+
+
+def _nearest(search_query, zipcode, limit, miles, **search):
+    """Runs search_query over the zipcodes within miles of zipcode, nearest
+    first, in one query. Returns up to limit (row, miles) pairs."""
+
+    zipcodes = zipcodes_within(zipcode, miles)
+    if not zipcodes:
+        return []
+
+    rows = (
+        search_query(zipcodes=zipcodes, nearest_first=True, **search)
+        .limit(limit)
+        .all()
+    )
+
+    return [(row, zipcodes[row.zipcode]) for row in rows]
+
+
+def nearest_gigs(zipcode, limit, miles=NEARBY_MILES, **search):
+    """Returns up to limit (post, miles) pairs from gig_search_query(**search)
+    within miles of zipcode, nearest first."""
+
+    return _nearest(gig_search_query, zipcode, limit, miles, **search)
+
+
+def nearest_artists(zipcode, limit, miles=NEARBY_MILES, **search):
+    """Returns up to limit (user, miles) pairs from
+    artist_search_query(**search) within miles of zipcode, nearest first."""
+
+    return _nearest(artist_search_query, zipcode, limit, miles, **search)
@@ -0,0 +1,1688 @@
+"""BayArt - Bay Area Art Connection Project: behavior tests
+
+Runs the app against an in-memory SQLite database, so no PostgreSQL or
+outside services are needed:
+
+    python3 -m unittest tests
+"""
+
+import io
+import os
+import random
+import shutil
+import socket
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+from flask import Flask
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from werkzeug.security import generate_password_hash
+
+import facets
+import fulltext
+import refdata
+import server
+import zipcodes
+from availability import IntervalTree, available_artists_query, day_range
+from dbstats import QueryBudgetExceeded, init_query_budget
+from expiry import expire_gigs
+from fulltext import InvertedIndex, search_posts, tokenize
+from imagepipeline import (
+    VARIANT_SIZES,
+    ImagePipeline,
+    LocalStore,
+    image_keys,
+    image_variants,
+    variant_key,
+)
+from matching import (
+    MATCHES_PER_POST,
+    ArtistProfile,
+    GigProfile,
+    MatchRefresher,
+    _best,
+    gig_days_mask,
+    load_artists,
+    load_gigs,
+    match_score,
+    refresh_all_matches,
+    refresh_artist_matches,
+    refresh_post_matches,
+)
+from metrics import MAX_DATAGRAM, MetricsBuffer, StatsdSink
+from model import (
+    db,
+    ArtistMatch,
+    connect_to_db,
+    User,
+    Post,
+    SearchFacet,
+    Tag,
+    Unavailability,
+    Zipcode,
+    OutboxEmail,
+)
+from outbox import (
+    BASE_BACKOFF,
+    MAX_ATTEMPTS,
+    MAX_BACKOFF,
+    MemoryTransport,
+    backoff,
+    dispatch_pending,
+    queue_email,
+)
+from pagination import decode_cursor, encode_cursor, keyset_page
+from presign import PresignedUrlCache
+from spatial import (
+    MAX_MILES,
+    ZipcodeGrid,
+    haversine_miles,
+    nearest_gigs,
+    zipcodes_within,
+)
+from search import artist_search_query, gig_search_query
+from weekdays import (
+    ALL_DAYS,
+    daysweek_to_mask,
+    is_daysweek,
+    mask_to_daysweek,
+    masks_with_all,
+    masks_with_any,
+    parse_weekday,
+)
+
+class FakeS3Client(object):
+    """Signs URLs without credentials, counting each signature."""
+
+    def __init__(self):
+        self.signed = []
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        self.signed.append((Params["Bucket"], Params["Key"]))
+        return f"https://{Params['Bucket']}.example.com/{Params['Key']}?n={len(self.signed)}"
+
+
+app = server.app
+app.config["TESTING"] = True
+app.secret_key = "tests"
+connect_to_db(app, "sqlite://")
+
+# Tests send emails and refresh suggested artists themselves. Background
+# threads would share SQLite's one in-memory connection with them.
+server.email_dispatcher.stop()
+server.match_refresher.stop()
+
+server.presigned_urls.s3_client = FakeS3Client()
+
+
+def make_user(user_name="Bode", password="x", **columns):
+    user = User(
+        user_name=user_name,
+        email=f"{user_name.lower()}@example.com",
+        display_email=f"{user_name}@example.com",
+        password=password,
+        veri_code=f"V-{user_name}",
+        last_active=datetime.now(),
+        **columns,
+    )
+    db.session.add(user)
+    return user
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Each test gets empty tables inside an app context."""
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+
+class FailingTransport(object):
+    def send(self, email):
+        raise IOError("SendGrid is down")
+
+
+class OutboxTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        # Queued emails are due from the moment they are queued
+        self.now = datetime.now() + timedelta(seconds=1)
+
+    def test_rolled_back_email_is_never_sent(self):
+        queue_email("a@example.com", "Hi", "Hello")
+        db.session.rollback()
+
+        transport = MemoryTransport()
+        self.assertEqual(dispatch_pending(transport, now=self.now), 0)
+        self.assertEqual(transport.sent, [])
+
+    def test_committed_email_is_sent_once(self):
+        queue_email("a@example.com", "Hi", "Hello")
+        db.session.commit()
+
+        transport = MemoryTransport()
+        self.assertEqual(dispatch_pending(transport, now=self.now), 1)
+        self.assertEqual(dispatch_pending(transport, now=self.now), 0)
+
+        self.assertEqual(len(transport.sent), 1)
+        self.assertEqual(transport.sent[0]["to_email"], "a@example.com")
+        self.assertEqual(transport.sent[0]["subject"], "Hi")
+
+        email = OutboxEmail.query.one()
+        self.assertEqual(email.sent_at, self.now)
+        self.assertEqual(email.attempts, 1)
+        self.assertIsNone(email.last_error)
+
+    def test_failed_send_waits_out_its_backoff(self):
+        queue_email("a@example.com", "Hi", "Hello")
+        db.session.commit()
+
+        self.assertEqual(dispatch_pending(FailingTransport(), now=self.now), 0)
+
+        email = OutboxEmail.query.one()
+        self.assertIsNone(email.sent_at)
+        self.assertEqual(email.attempts, 1)
+        self.assertEqual(email.send_after, self.now + timedelta(seconds=30))
+        self.assertIn("SendGrid is down", email.last_error)
+
+        transport = MemoryTransport()
+        early = self.now + timedelta(seconds=29)
+        self.assertEqual(dispatch_pending(transport, now=early), 0)
+        self.assertEqual(transport.sent, [])
+
+        due = self.now + timedelta(seconds=30)
+        self.assertEqual(dispatch_pending(transport, now=due), 1)
+
+        email = OutboxEmail.query.one()
+        self.assertEqual(email.sent_at, due)
+        self.assertEqual(email.attempts, 2)
+
+    def test_gives_up_after_max_attempts(self):
+        queue_email("a@example.com", "Hi", "Hello")
+        db.session.commit()
+
+        now = self.now
+        for _ in range(MAX_ATTEMPTS):
+            dispatch_pending(FailingTransport(), now=now)
+            now += MAX_BACKOFF
+
+        transport = MemoryTransport()
+        self.assertEqual(dispatch_pending(transport, now=now), 0)
+        self.assertEqual(OutboxEmail.query.one().attempts, MAX_ATTEMPTS)
+
+    def test_registering_queues_the_verification_email(self):
+        response = app.test_client().post(
+            "/register",
+            data={"user_name": "Alice", "password": "pw", "email": "Alice@example.com"},
+        )
+        self.assertEqual(response.status_code, 302)
+
+        user = User.query.filter_by(user_name="Alice").one()
+        email = OutboxEmail.query.one()
+        self.assertEqual(email.to_email, "Alice@example.com")
+        self.assertIn(user.veri_code, email.body)
+        self.assertIsNone(email.sent_at)
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        self.assertEqual(backoff(1), BASE_BACKOFF)
+        self.assertEqual(backoff(2), BASE_BACKOFF * 2)
+        self.assertEqual(backoff(3), BASE_BACKOFF * 4)
+        self.assertEqual(backoff(20), MAX_BACKOFF)
+
+
+class InvertedIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add(1, "Jazz trio for a wedding")
+        self.index.add(2, "Wedding photographer wanted")
+        self.index.add(3, "Jazz jazz jazz all night")
+
+    def test_tokenize_drops_case_and_stop_words(self):
+        self.assertEqual(tokenize("The Jazz and the Blues"), ["jazz", "blues"])
+        self.assertEqual(tokenize(None), [])
+
+    def test_matches_rows_with_every_word(self):
+        self.assertEqual(set(self.index.search("wedding")), {1, 2})
+        self.assertEqual(set(self.index.search("jazz wedding")), {1})
+        self.assertEqual(self.index.search("polka"), {})
+        self.assertEqual(self.index.search("the"), {})
+
+    def test_more_occurrences_score_higher(self):
+        scores = self.index.search("jazz")
+        self.assertGreater(scores[3], scores[1])
+
+    def test_add_replaces_and_remove_forgets(self):
+        self.index.add(1, "Cello recital")
+        self.assertEqual(set(self.index.search("jazz")), {3})
+        self.assertEqual(set(self.index.search("cello")), {1})
+
+        self.index.remove(3)
+        self.assertEqual(self.index.search("jazz"), {})
+        self.assertNotIn("jazz", self.index.postings)
+
+
+class InMemorySearchTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        # The index outlives each test's tables
+        fulltext._in_memory_search.indexes.clear()
+
+        db.session.add(
+            Zipcode(valid_zipcode=94608, location_name="Emeryville", region="East Bay")
+        )
+        self.user = make_user()
+        db.session.commit()
+
+    def add_post(self, title):
+        post = Post(
+            user_id=self.user.id, post_title=title, description="", zipcode=94608
+        )
+        db.session.add(post)
+        return post
+
+    def matching_titles(self, text):
+        query, relevance = search_posts(Post.query, text)
+        return [post.post_title for post in query.order_by(relevance)]
+
+    def test_committed_changes_are_searchable(self):
+        self.add_post("Jazz trio")
+        db.session.commit()
+        self.assertEqual(self.matching_titles("jazz"), ["Jazz trio"])
+
+        post = Post.query.one()
+        post.post_title = "Cello recital"
+        db.session.commit()
+        self.assertEqual(self.matching_titles("jazz"), [])
+        self.assertEqual(self.matching_titles("cello"), ["Cello recital"])
+
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(self.matching_titles("cello"), [])
+
+    def test_rolled_back_changes_are_not(self):
+        self.add_post("Jazz trio")
+        db.session.commit()
+        self.assertEqual(self.matching_titles("jazz"), ["Jazz trio"])
+
+        self.add_post("Jazz quartet")
+        db.session.flush()
+        db.session.rollback()
+
+        post = Post.query.one()
+        post.post_title = "Cello recital"
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual(self.matching_titles("jazz"), ["Jazz trio"])
+        self.assertEqual(self.matching_titles("cello"), [])
+
+    def test_gig_search_puts_the_best_match_first(self):
+        self.add_post("Jazz trio")
+        self.add_post("Jazz jazz jazz night")
+        self.add_post("Cello recital")
+        db.session.commit()
+
+        titles = [post.post_title for post in gig_search_query(search="jazz")]
+        self.assertEqual(titles, ["Jazz jazz jazz night", "Jazz trio"])
+
+
+budget_app = Flask("budget")
+budget_app.config["TESTING"] = True
+init_query_budget(budget_app)
+budget_engine = create_engine("sqlite://")
+
+
+@budget_app.route("/statements/<int:count>")
+def run_statements(count):
+    with budget_engine.connect() as connection:
+        for _ in range(count):
+            connection.execute("SELECT 1")
+    return "ok"
+
+
+class QueryBudgetTests(unittest.TestCase):
+    def setUp(self):
+        self.client = budget_app.test_client()
+
+    def tearDown(self):
+        budget_app.config["QUERY_BUDGET"] = None
+
+    def test_no_budget_allows_anything(self):
+        self.assertEqual(self.client.get("/statements/10").status_code, 200)
+
+    def test_within_budget(self):
+        budget_app.config["QUERY_BUDGET"] = 3
+        self.assertEqual(self.client.get("/statements/3").status_code, 200)
+        # Counted afresh each request
+        self.assertEqual(self.client.get("/statements/3").status_code, 200)
+
+    def test_over_budget_fails(self):
+        budget_app.config["QUERY_BUDGET"] = 3
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get("/statements/4")
+
+
+class ListingQueryTests(DatabaseTestCase):
+    """Listing pages run the same statements however many rows they show."""
+
+    URLS = ("/gigs", "/gigs.json", "/artists", "/artists.json")
+    BUDGET = 15
+
+    def setUp(self):
+        super().setUp()
+
+        tags = [Tag(tag_name=name) for name in ("Music", "Dance", "Photography")]
+        db.session.add_all(tags)
+        db.session.add(
+            Zipcode(valid_zipcode=94608, location_name="Emeryville", region="East Bay")
+        )
+        make_user(
+            "Viewer", password=generate_password_hash("pw"), is_artist=True, verified=True
+        )
+        db.session.commit()
+
+        self.tags = tags
+        self.client = app.test_client()
+        self.client.post(
+            "/login", data={"email": "viewer@example.com", "password": "pw"}
+        )
+
+    def tearDown(self):
+        app.config["QUERY_BUDGET"] = None
+        super().tearDown()
+
+    def add_listings(self, count):
+        now = datetime.now()
+        start = User.query.count()
+
+        for i in range(start, start + count):
+            artist = make_user(
+                f"Artist{i}", is_artist=True, verified=True, zipcode=94608
+            )
+            artist.tags = self.tags[: i % 3 + 1]
+            post = Post(
+                users=artist,
+                post_title=f"Gig {i}",
+                description="",
+                zipcode=94608,
+                creation_date=now - timedelta(minutes=i),
+                unpaid=False,
+                pay=100,
+            )
+            post.tags = self.tags[: i % 3 + 1]
+            db.session.add(post)
+
+        db.session.commit()
+
+    def statements_for(self, url):
+        counted = []
+        count = lambda *args: counted.append(1)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            response = self.client.get(url)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertEqual(response.status_code, 200, url)
+        return len(counted)
+
+    def test_listings_stay_within_the_budget(self):
+        self.add_listings(2)
+        few = {url: self.statements_for(url) for url in self.URLS}
+
+        self.add_listings(20)
+        app.config["QUERY_BUDGET"] = self.BUDGET
+        for url in self.URLS:
+            self.assertEqual(self.statements_for(url), few[url], url)
+
+
+def png_bytes(width, height):
+    from PIL import Image
+
+    out = io.BytesIO()
+    Image.new("RGBA", (width, height), (200, 40, 40, 128)).save(out, format="PNG")
+    return out.getvalue()
+
+
+class ImagePipelineTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.pipeline = ImagePipeline(app, LocalStore(self.directory))
+
+        user = make_user()
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        self.pipeline.shutdown()
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def test_process_stores_variants_and_records_them(self):
+        key = self.pipeline.process(self.user_id, png_bytes(1200, 600), "bode_1")
+        self.assertEqual(key, "bode_1")
+
+        user = User.query.get(self.user_id)
+        self.assertEqual(user.img_route, "bode_1")
+        recorded = user.img_variants["img_route"]
+        self.assertEqual(recorded["sizes"], sorted(VARIANT_SIZES))
+
+        for size in recorded["sizes"]:
+            for extension in recorded["formats"]:
+                path = os.path.join(self.directory, variant_key(key, size, extension))
+                self.assertTrue(os.path.exists(path), path)
+
+    def test_submit_runs_in_the_background(self):
+        future = self.pipeline.submit(
+            self.user_id, png_bytes(300, 300), "bode_2", slot="img_port_one"
+        )
+        self.assertEqual(future.result(timeout=30), "bode_2")
+
+        user = User.query.get(self.user_id)
+        self.assertEqual(user.img_port_one, "bode_2")
+        self.assertIn("img_port_one", user.img_variants)
+
+    def test_two_slots_keep_their_own_variants(self):
+        self.pipeline.process(self.user_id, png_bytes(300, 300), "bode_1")
+        self.pipeline.process(
+            self.user_id, png_bytes(300, 300), "bode_2", slot="img_port_two"
+        )
+
+        user = User.query.get(self.user_id)
+        self.assertEqual(sorted(user.img_variants), ["img_port_two", "img_route"])
+
+    def test_a_broken_upload_changes_nothing(self):
+        with self.assertLogs("imagepipeline", "ERROR"), self.assertRaises(OSError):
+            self.pipeline.process(self.user_id, b"not an image", "bode_3")
+
+        user = User.query.get(self.user_id)
+        self.assertNotEqual(user.img_route, "bode_3")
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_unknown_slot_is_refused(self):
+        with self.assertRaises(ValueError):
+            self.pipeline.submit(self.user_id, png_bytes(10, 10), "x", slot="bio")
+
+
+class ImageVariantTests(unittest.TestCase):
+    def test_every_size_is_shrunk_to_fit(self):
+        from PIL import Image
+
+        variants = list(image_variants(png_bytes(1200, 600)))
+        self.assertEqual(
+            sorted(set(size for size, _, _, _ in variants)), sorted(VARIANT_SIZES)
+        )
+
+        for size, extension, content_type, body in variants:
+            image = Image.open(io.BytesIO(body))
+            self.assertEqual(image.size, (size, size // 2))
+            self.assertEqual(image.format.lower(), extension)
+            self.assertEqual(content_type, "image/" + extension)
+
+    def test_small_images_are_not_enlarged(self):
+        from PIL import Image
+
+        for size, _, _, body in image_variants(png_bytes(100, 50)):
+            expected = (100, 50) if size >= 100 else (size, size // 2)
+            self.assertEqual(Image.open(io.BytesIO(body)).size, expected)
+
+
+
+
+class ImageKeyTests(unittest.TestCase):
+    def user(self, formats):
+        return User(
+            img_route="bode_1",
+            img_variants={"img_route": {"sizes": [64, 240, 800], "formats": formats}},
+        )
+
+    def test_picks_the_smallest_variant_wide_enough(self):
+        user = self.user(["jpeg", "webp"])
+
+        self.assertEqual(
+            image_keys(user, "img_route", 48),
+            {"webp": "bode_1_64.webp", "jpeg": "bode_1_64.jpeg"},
+        )
+        self.assertEqual(image_keys(user, "img_route", 230)["jpeg"], "bode_1_240.jpeg")
+        # Nothing is wide enough, so the largest there is
+        self.assertEqual(image_keys(user, "img_route", 2000)["jpeg"], "bode_1_800.jpeg")
+
+    def test_jpeg_only_variants(self):
+        keys = image_keys(self.user(["jpeg"]), "img_route", 48)
+        self.assertEqual(keys, {"webp": None, "jpeg": "bode_1_64.jpeg"})
+
+    def test_images_from_before_variants(self):
+        user = User(img_route="old_upload", img_variants=None)
+        self.assertEqual(
+            image_keys(user, "img_route", 48), {"webp": None, "jpeg": "old_upload"}
+        )
+
+
+class KeysetPaginationTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(
+            Zipcode(valid_zipcode=94608, location_name="Emeryville", region="East Bay")
+        )
+        author = make_user()
+
+        noon = datetime(2026, 10, 17, 12, 0)
+        # Ties on creation_date, and posts with none, which sort last
+        for created in [noon, noon, noon - timedelta(hours=1), None, noon, None, None]:
+            db.session.add(
+                Post(users=author, post_title="Gig", zipcode=94608, creation_date=created)
+            )
+        db.session.commit()
+
+    def walk(self, page_size):
+        pages = []
+        cursor = None
+        while True:
+            posts, cursor = keyset_page(
+                Post.query, Post.creation_date, Post.post_id, cursor, page_size
+            )
+            pages.append([post.post_id for post in posts])
+            if cursor is None:
+                return pages
+
+    def test_pages_cover_every_row_once_in_order(self):
+        expected = [
+            post.post_id
+            for post in sorted(
+                Post.query,
+                key=lambda post: (
+                    post.creation_date is not None,
+                    post.creation_date or datetime.min,
+                    post.post_id,
+                ),
+                reverse=True,
+            )
+        ]
+
+        for page_size in (1, 2, 3, 7, 10):
+            pages = self.walk(page_size)
+            self.assertEqual(sum(pages, []), expected, page_size)
+            self.assertTrue(all(len(page) == page_size for page in pages[:-1]))
+
+    def test_cursors_round_trip(self):
+        moment = datetime(2026, 10, 17, 12, 30, 15, 250)
+        self.assertEqual(decode_cursor(encode_cursor(moment, 42)), (moment, 42))
+        self.assertEqual(decode_cursor(encode_cursor(None, 7)), (None, 7))
+
+    def test_malformed_cursors_start_over(self):
+        for cursor in ("junk", "2026-10-17,x", "1,2,3", ""):
+            self.assertIsNone(decode_cursor(cursor), cursor)
+
+        posts, _ = keyset_page(Post.query, Post.creation_date, Post.post_id, "junk", 3)
+        self.assertEqual([post.post_id for post in posts], self.walk(3)[0])
+
+    def test_artists_json_follows_next(self):
+        for name in ("Alice", "Carol", "Dave"):
+            make_user(name, is_artist=True, verified=True)
+        db.session.commit()
+
+        page_size = app.config["LISTING_PAGE_SIZE"]
+        app.config["LISTING_PAGE_SIZE"] = 2
+        try:
+            client = app.test_client()
+            seen = []
+            url = "/artists.json"
+            while url:
+                page = client.get(url).get_json()
+                seen.extend(artist["user_name"] for artist in page["artists"])
+                url = page["next"] and f"/artists.json?after={page['next']}"
+        finally:
+            app.config["LISTING_PAGE_SIZE"] = page_size
+
+        self.assertEqual(sorted(seen), ["Alice", "Carol", "Dave"])
+        self.assertEqual(len(seen), len(set(seen)))
+
+
+class ReferenceDataTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(Tag(tag_name="Painting"))
+        db.session.commit()
+
+    def tag_names(self):
+        return [tag.tag_name for tag in refdata.get_reference_data().tags]
+
+    def test_reused_until_a_commit_changes_it(self):
+        data = refdata.get_reference_data()
+        self.assertIs(refdata.get_reference_data(), data)
+
+        db.session.add(Tag(tag_name="Murals"))
+        db.session.commit()
+        self.assertEqual(self.tag_names(), ["Murals", "Painting"])
+
+        db.session.add(
+            Zipcode(valid_zipcode=94608, location_name="Emeryville", region="East Bay")
+        )
+        db.session.commit()
+        data = refdata.get_reference_data()
+        self.assertEqual(data.zipcodes, [94608])
+        self.assertEqual(data.location_zipcodes, {"Emeryville": 94608})
+
+    def test_rollback_keeps_the_cache(self):
+        data = refdata.get_reference_data()
+
+        db.session.add(Tag(tag_name="Murals"))
+        db.session.flush()
+        db.session.rollback()
+        self.assertIs(refdata.get_reference_data(), data)
+
+        # A commit after the rollback is not mistaken for a change
+        db.session.add(make_user())
+        db.session.commit()
+        self.assertIs(refdata.get_reference_data(), data)
+
+    def test_bulk_changes_need_invalidate(self):
+        data = refdata.get_reference_data()
+
+        Tag.query.delete()
+        db.session.commit()
+        self.assertIs(refdata.get_reference_data(), data)
+
+        refdata.invalidate_reference_data()
+        self.assertEqual(self.tag_names(), [])
+
+    def test_reloads_after_max_age(self):
+        data = refdata.get_reference_data()
+        loaded_at = refdata._cache["loaded_at"]
+
+        with mock.patch("refdata.time.time", return_value=loaded_at + refdata.MAX_AGE + 1):
+            self.assertIsNot(refdata.get_reference_data(), data)
+
+
+class PresignedUrlCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.s3_client = FakeS3Client()
+        self.cache = PresignedUrlCache(
+            self.s3_client, expires_in=100, refresh_margin=10, max_size=2
+        )
+        self.now = 1000.0
+        patcher = mock.patch("presign.time.time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reused_until_within_refresh_margin(self):
+        url = self.cache.get("bucket", "a.png")
+
+        self.now += 89
+        self.assertEqual(self.cache.get("bucket", "a.png"), url)
+        self.assertEqual(len(self.s3_client.signed), 1)
+
+        self.now += 1
+        self.assertNotEqual(self.cache.get("bucket", "a.png"), url)
+        self.assertEqual(len(self.s3_client.signed), 2)
+
+    def test_get_many_signs_only_missing_keys_once(self):
+        self.cache.get("bucket", "a.png")
+        urls = self.cache.get_many("bucket", ["a.png", "b.png", "b.png"])
+
+        self.assertEqual(set(urls), {"a.png", "b.png"})
+        self.assertEqual(self.s3_client.signed, [("bucket", "a.png"), ("bucket", "b.png")])
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.get("bucket", "a.png")
+        self.cache.get("bucket", "b.png")
+        # Touching a.png leaves b.png as the oldest
+        self.cache.get("bucket", "a.png")
+        self.cache.get("bucket", "c.png")
+
+        self.assertEqual(
+            list(self.cache.urls), [("bucket", "a.png"), ("bucket", "c.png")]
+        )
+
+        self.cache.get("bucket", "b.png")
+        self.assertEqual(self.s3_client.signed.count(("bucket", "b.png")), 2)
+
+    def test_buckets_are_separate(self):
+        self.cache.get("one", "a.png")
+        self.cache.get("two", "a.png")
+
+        self.assertEqual(self.s3_client.signed, [("one", "a.png"), ("two", "a.png")])
+
+
+class RecordingSink(object):
+    """Keeps every batch a MetricsBuffer flushes."""
+
+    def __init__(self):
+        self.batches = []
+
+    def send(self, timestamp, counters, events, checks):
+        self.batches.append((counters, events, checks))
+
+
+class MetricsBufferTests(unittest.TestCase):
+    def setUp(self):
+        self.sink = RecordingSink()
+        # Flushed by hand; the thread never gets to it
+        self.metrics = MetricsBuffer(self.sink, flush_interval=3600, max_keys=2)
+        self.addCleanup(self.metrics.stop)
+
+    def test_repeats_are_aggregated(self):
+        self.metrics.increment("page.not_found", tags=["b", "a"])
+        self.metrics.increment("page.not_found", 2, tags=["a", "b"])
+        self.metrics.event("404", "/missing")
+        self.metrics.event("404", "/missing")
+        self.metrics.service_check("app.ok", 2, host="web")
+        self.metrics.service_check("app.ok", 0, host="web", message="fine")
+        self.metrics.flush()
+
+        self.assertEqual(
+            self.sink.batches,
+            [
+                (
+                    {("page.not_found", ("a", "b")): 3},
+                    {("404", "/missing", ()): 2},
+                    {("app.ok", "web", ()): (0, "fine")},
+                )
+            ],
+        )
+
+    def test_new_names_past_max_keys_are_dropped_and_counted(self):
+        for name in ("one", "two", "three", "four"):
+            self.metrics.increment(name)
+        # Names already buffered still add up
+        self.metrics.increment("one")
+        self.metrics.flush()
+
+        counters = self.sink.batches[0][0]
+        self.assertEqual(
+            counters, {("one", ()): 2, ("two", ()): 1, ("metrics.dropped", ()): 2}
+        )
+
+    def test_flush_starts_empty_and_skips_empty_batches(self):
+        self.metrics.increment("one")
+        self.metrics.flush()
+        self.metrics.flush()
+
+        self.assertEqual(len(self.sink.batches), 1)
+
+    def test_stop_flushes_what_is_left(self):
+        self.metrics.event("404", "/missing")
+        self.metrics.stop()
+
+        self.assertEqual(self.sink.batches[0][1], {("404", "/missing", ()): 1})
+        self.assertFalse(self.metrics.thread.is_alive())
+
+
+class StatsdSinkTests(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.settimeout(5)
+        self.addCleanup(self.listener.close)
+
+        self.sink = StatsdSink(*self.listener.getsockname())
+        self.addCleanup(self.sink.socket.close)
+
+    def receive(self):
+        return self.listener.recv(65535)
+
+    def test_batch_lines(self):
+        self.sink.send(
+            0,
+            {("page.not_found", ("path:/x",)): 3},
+            {("Café", "naïve", ()): 2},
+            {("app.ok", "web", ()): (0, "fine")},
+        )
+
+        self.assertEqual(
+            self.receive().decode("utf-8").split("\n"),
+            [
+                "page.not_found:3|c|#path:/x",
+                # Lengths are in UTF-8 bytes
+                "_e{5,16}:Café|naïve (2 times)",
+                "_sc|app.ok|0|h:web|m:fine",
+            ],
+        )
+
+    def test_datagrams_stay_under_max_bytes(self):
+        counters = {(f"é.{n:03}", ()): n for n in range(300)}
+        self.sink.send(0, counters, {}, {})
+
+        lines = []
+        while len(lines) < len(counters):
+            datagram = self.receive()
+            self.assertLessEqual(len(datagram), MAX_DATAGRAM)
+            lines.extend(datagram.decode("utf-8").split("\n"))
+
+        self.assertEqual(lines, [f"é.{n:03}:{n}|c" for n in range(300)])
+
+
+class ZipcodeRowsTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as file:
+            file.write(text)
+        return path
+
+    def test_scan_zipcodes_across_chunks(self):
+        page = "<td>94608</td><td>94110 x</td><td>9411</td><td>94608</td><b>94501"
+        for chunk_size in (1, 3, 7, len(page)):
+            self.assertEqual(
+                list(zipcodes.scan_zipcodes(io.StringIO(page), chunk_size)),
+                ["94608", "94110", "94501"],
+                chunk_size,
+            )
+
+    def test_last_line_names_a_zipcode(self):
+        raw_path = self.write("raw.txt", "<td>94608</td><td>94110</td><td>94501</td>")
+        placenames_path = self.write(
+            "placenames.csv",
+            'zip,type,decommissioned,primary_city\n'
+            '"94608","STANDARD","0","Oakland"\n'
+            '"94110","STANDARD","0","San Francisco"\n'
+            '"94608","STANDARD","0","Emeryville"\n'
+            '"94501","STANDARD","0","Alameda, Island City"\n'
+            '"10001","STANDARD","0","New York"\n',
+        )
+
+        rows = list(
+            zipcodes.zipcode_rows(
+                raw_path, placenames_path, {"94110": (37.7498701, -122.4158302)}
+            )
+        )
+
+        self.assertEqual(
+            [(row["valid_zipcode"], row["location_name"], row["region"]) for row in rows],
+            [
+                (94608, "Emeryville", "East Bay"),
+                (94110, "San Francisco", "San Francisco"),
+                (94501, "Alameda, Island City", "Remote"),
+                (0, "Remote", "Remote"),
+            ],
+        )
+        self.assertEqual((rows[1]["latitude"], rows[1]["longitude"]), (37.74987, -122.41583))
+        self.assertEqual((rows[0]["latitude"], rows[0]["longitude"]), (None, None))
+
+    def test_fill_place_centroids(self):
+        rows = zipcodes.fill_place_centroids(
+            [
+                {"location_name": "Oakland", "latitude": 37.8, "longitude": -122.2},
+                {"location_name": "Oakland", "latitude": 37.7, "longitude": -122.3},
+                {"location_name": "Oakland", "latitude": None, "longitude": None},
+                {"location_name": "Remote", "latitude": None, "longitude": None},
+            ]
+        )
+
+        self.assertEqual((rows[2]["latitude"], rows[2]["longitude"]), (37.75, -122.25))
+        self.assertEqual((rows[3]["latitude"], rows[3]["longitude"]), (None, None))
+
+
+class UpsertZipcodesTests(DatabaseTestCase):
+    def rows(self, emeryville_region="East Bay"):
+        return [
+            {
+                "valid_zipcode": 94608,
+                "location_name": "Emeryville",
+                "region": emeryville_region,
+                "latitude": 37.83,
+                "longitude": -122.28,
+            },
+            {
+                "valid_zipcode": 94110,
+                "location_name": "San Francisco",
+                "region": "San Francisco",
+                "latitude": None,
+                "longitude": None,
+            },
+        ]
+
+    def test_inserts_updates_and_skips_unchanged(self):
+        self.assertEqual(zipcodes.upsert_zipcodes(self.rows()), (2, 0, 0))
+        self.assertEqual(zipcodes.upsert_zipcodes(self.rows()), (0, 0, 2))
+
+        self.assertEqual(zipcodes.upsert_zipcodes(self.rows("Remote")), (0, 1, 1))
+        self.assertEqual(Zipcode.query.get(94608).region, "Remote")
+        self.assertEqual(Zipcode.query.get(94608).latitude, 37.83)
+
+    def test_leaves_missing_zipcodes_alone(self):
+        db.session.add(Zipcode(valid_zipcode=94501, location_name="Alameda", region="East Bay"))
+        db.session.commit()
+
+        zipcodes.upsert_zipcodes(self.rows())
+        self.assertEqual(Zipcode.query.count(), 3)
+
+    def test_duplicate_rows_insert_once(self):
+        self.assertEqual(zipcodes.upsert_zipcodes(self.rows() + self.rows()[:1]), (2, 0, 1))
+        self.assertEqual(Zipcode.query.count(), 2)
+
+
+class IntervalTreeTests(unittest.TestCase):
+    def test_day_range(self):
+        noon = datetime(2026, 10, 17, 12, 30)
+        self.assertEqual(
+            day_range(noon, datetime(2026, 10, 19, 8)),
+            (datetime(2026, 10, 17), datetime(2026, 10, 19)),
+        )
+        self.assertEqual(
+            day_range(noon.date()), (datetime(2026, 10, 17), datetime(2026, 10, 17))
+        )
+        self.assertIsNone(day_range(None, noon))
+
+    def test_overlapping_matches_brute_force(self):
+        intervals = [
+            (start, start + length, f"{start}+{length}")
+            for start in range(0, 40, 3)
+            for length in (0, 1, 4, 11)
+        ]
+        tree = IntervalTree(intervals)
+
+        for start in range(-2, 45):
+            for end in range(start, start + 6):
+                self.assertEqual(
+                    tree.overlapping(start, end),
+                    {
+                        value
+                        for low, high, value in intervals
+                        if low <= end and start <= high
+                    },
+                    (start, end),
+                )
+
+    def test_empty_tree(self):
+        self.assertEqual(IntervalTree([]).overlapping(0, 10), set())
+
+
+class AvailabilityTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.busy = make_user("Busy", is_artist=True, verified=True)
+        self.free = make_user("Free", is_artist=True, verified=True)
+        self.open_ended = make_user("Open", is_artist=True, verified=True)
+        self.no_start = make_user("NoStart", is_artist=True, verified=True)
+        db.session.flush()
+
+        db.session.add_all(
+            [
+                # Saved with a time of day; still blocks the whole of both days
+                Unavailability(
+                    user_id=self.busy.id,
+                    start_range_date=datetime(2026, 10, 17, 15),
+                    end_range_date=datetime(2026, 10, 18, 9),
+                ),
+                Unavailability(
+                    user_id=self.free.id,
+                    start_range_date=datetime(2026, 11, 1),
+                    end_range_date=datetime(2026, 11, 2),
+                ),
+                # The single day of its start
+                Unavailability(
+                    user_id=self.open_ended.id, start_range_date=datetime(2026, 10, 18)
+                ),
+                # Blocks nothing
+                Unavailability(
+                    user_id=self.no_start.id, end_range_date=datetime(2026, 10, 18)
+                ),
+            ]
+        )
+        db.session.commit()
+
+    def available(self, start, end=None):
+        return sorted(user.user_name for user in available_artists_query(start, end))
+
+    def test_ranges_block_every_day_they_touch(self):
+        self.assertEqual(
+            self.available(datetime(2026, 10, 16, 23)), ["Busy", "Free", "NoStart", "Open"]
+        )
+        self.assertEqual(
+            self.available(datetime(2026, 10, 18, 20)), ["Free", "NoStart"]
+        )
+        self.assertEqual(
+            self.available(datetime(2026, 10, 19), datetime(2026, 11, 1)),
+            ["Busy", "NoStart", "Open"],
+        )
+
+    def test_changes_rebuild_the_tree(self):
+        self.available(datetime(2026, 12, 1))
+
+        db.session.add(
+            Unavailability(user_id=self.free.id, start_range_date=datetime(2026, 12, 1))
+        )
+        db.session.commit()
+        self.assertEqual(self.available(datetime(2026, 12, 1)), ["Busy", "NoStart", "Open"])
+
+        db.session.delete(Unavailability.query.filter_by(user_id=self.busy.id).one())
+        db.session.commit()
+        self.assertEqual(
+            self.available(datetime(2026, 10, 17)), ["Busy", "Free", "NoStart", "Open"]
+        )
+
+
+class AdvancedArtistSearchTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        make_user("Weekends", is_artist=True, verified=True, daysweek="tffffft")
+        make_user(
+            "Viewer", password=generate_password_hash("pw"), is_artist=True, verified=True
+        )
+        db.session.commit()
+
+        self.client = app.test_client()
+        self.client.post(
+            "/login", data={"email": "viewer@example.com", "password": "pw"}
+        )
+
+    def names(self, availability):
+        response = self.client.get(
+            "/searchartistsadvance", query_string={"availability": availability}
+        )
+        self.assertEqual(response.status_code, 200, availability)
+        page = response.get_data(as_text=True)
+        return [name for name in ("Weekends", "Viewer") if name in page]
+
+    def test_weekday_filters(self):
+        self.assertEqual(self.names("alldays"), ["Weekends", "Viewer"])
+        self.assertEqual(self.names("0"), ["Weekends", "Viewer"])
+        self.assertEqual(self.names("3"), ["Viewer"])
+
+    def test_anything_else_is_all_days(self):
+        for availability in ("7", "12", "-1", "x", ""):
+            self.assertEqual(self.names(availability), ["Weekends", "Viewer"])
+
+
+class WeekdayMaskTests(unittest.TestCase):
+    def test_daysweek_round_trip(self):
+        self.assertEqual(daysweek_to_mask("tffffft"), 65)
+        self.assertEqual(daysweek_to_mask("ttttttt"), ALL_DAYS)
+        for mask in range(ALL_DAYS + 1):
+            self.assertEqual(daysweek_to_mask(mask_to_daysweek(mask)), mask)
+
+    def test_is_daysweek(self):
+        self.assertTrue(is_daysweek("tfttttt"))
+        for value in (None, "", "tttttt", "tttttttt", "tttxttt"):
+            self.assertFalse(is_daysweek(value), value)
+
+    def test_parse_weekday(self):
+        self.assertEqual([parse_weekday(str(day)) for day in range(7)], list(range(7)))
+        for value in (None, "", "7", "-1", "x", "1.5", "alldays"):
+            self.assertIsNone(parse_weekday(value), value)
+
+    def test_mask_lists_match_brute_force(self):
+        for days in ([], [0], [1, 3], [0, 6], list(range(7))):
+            self.assertEqual(
+                masks_with_any(days),
+                [mask for mask in range(128) if any(mask >> day & 1 for day in days)],
+            )
+            self.assertEqual(
+                masks_with_all(days),
+                [mask for mask in range(128) if all(mask >> day & 1 for day in days)],
+            )
+
+
+class WeekdaySearchTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        make_user("Weekends", is_artist=True, verified=True, daysweek="tffffft")
+        make_user("Weekdays", is_artist=True, verified=True, daysweek="ftttttf")
+        make_user("Unset", is_artist=True, verified=True, daysweek=None)
+        db.session.commit()
+
+    def names(self, **search):
+        return sorted(user.user_name for user in artist_search_query(**search))
+
+    def test_days_mask_follows_daysweek(self):
+        user = User.query.filter_by(user_name="Weekends").one()
+        self.assertEqual(user.days_mask, 65)
+
+        user.daysweek = "ffffftf"
+        db.session.commit()
+        self.assertEqual(self.names(weekday=6), ["Unset"])
+        self.assertEqual(self.names(weekday=5), ["Unset", "Weekdays", "Weekends"])
+        self.assertEqual(User.query.filter_by(user_name="Unset").one().days_mask, ALL_DAYS)
+
+    def test_weekday_filters(self):
+        self.assertEqual(self.names(weekday=0), ["Unset", "Weekends"])
+        self.assertEqual(self.names(days_any=[0, 1]), ["Unset", "Weekdays", "Weekends"])
+        self.assertEqual(self.names(days_all=[0, 6]), ["Unset", "Weekends"])
+        self.assertEqual(self.names(days_all=[1, 6]), ["Unset"])
+        self.assertEqual(self.names(days_any=[]), ["Unset", "Weekdays", "Weekends"])
+
+
+class FacetCountTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add_all(
+            [
+                Zipcode(valid_zipcode=94608, location_name="Emeryville", region="East Bay"),
+                Zipcode(
+                    valid_zipcode=94110, location_name="San Francisco", region="San Francisco"
+                ),
+            ]
+        )
+        self.music = Tag(tag_name="Music")
+        self.dance = Tag(tag_name="Dance")
+        self.author = make_user("Author")
+        db.session.commit()
+
+    def stored(self):
+        return {
+            (facet.kind, facet.facet, facet.value): facet.count
+            for facet in SearchFacet.query
+            if facet.count
+        }
+
+    def assertCountsMatchRebuild(self):
+        counted = self.stored()
+        facets.rebuild_facet_counts()
+        self.assertEqual(counted, self.stored())
+        return counted
+
+    def add_post(self, **columns):
+        post = Post(users=self.author, post_title="Gig", zipcode=94608, **columns)
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def test_post_changes_move_counts(self):
+        post = self.add_post(tags=[self.music], unpaid=False)
+        self.add_post(tags=[self.music, self.dance])
+        self.assertEqual(
+            self.assertCountsMatchRebuild(),
+            {
+                ("gigs", "tag", str(self.music.tag_id)): 2,
+                ("gigs", "tag", str(self.dance.tag_id)): 1,
+                ("gigs", "region", "East Bay"): 2,
+                ("gigs", "pay", "paid"): 1,
+                ("gigs", "pay", "unpaid"): 1,
+            },
+        )
+
+        post.zipcode = 94110
+        post.unpaid = True
+        post.tags = [self.dance]
+        db.session.commit()
+        self.assertCountsMatchRebuild()
+
+        # Expire everything, so the changes below are to unloaded attributes
+        db.session.expire_all()
+        post = Post.query.get(post.post_id)
+        post.active = False
+        db.session.commit()
+        self.assertCountsMatchRebuild()
+
+        db.session.delete(Post.query.filter(Post.active == True).one())
+        db.session.commit()
+        self.assertEqual(self.assertCountsMatchRebuild(), {})
+
+    def test_rollback_undoes_the_counts(self):
+        self.add_post(tags=[self.music])
+        counted = self.stored()
+
+        self.add_post(tags=[self.dance])
+        db.session.add(Post(users=self.author, post_title="Gig", zipcode=94110))
+        db.session.flush()
+        db.session.rollback()
+        db.session.delete(Post.query.filter(Post.tags.any(tag_name="Dance")).one())
+        db.session.commit()
+
+        self.assertEqual(self.stored(), counted)
+
+    def test_artists_are_counted_by_tag_only(self):
+        artist = make_user("Ann", is_artist=True, verified=True, zipcode=94608)
+        artist.tags = [self.music]
+        make_user("Unverified", is_artist=True, zipcode=94608).tags = [self.music]
+        db.session.commit()
+        self.assertEqual(
+            self.assertCountsMatchRebuild(), {("artists", "tag", str(self.music.tag_id)): 1}
+        )
+
+        artist.zipcode = 94110
+        artist.verified = False
+        db.session.commit()
+        self.assertEqual(self.assertCountsMatchRebuild(), {})
+
+    def test_expiry_takes_gigs_out(self):
+        now = datetime(2026, 10, 17)
+        self.add_post(tags=[self.music], gig_date_start=now - timedelta(days=5))
+        self.add_post(
+            tags=[self.music],
+            gig_date_start=now - timedelta(days=5),
+            gig_date_end=now + timedelta(days=1),
+        )
+
+        self.assertEqual(expire_gigs(now), 1)
+        self.assertEqual(expire_gigs(now), 0)
+        self.assertEqual(
+            self.assertCountsMatchRebuild(),
+            {
+                ("gigs", "tag", str(self.music.tag_id)): 1,
+                ("gigs", "region", "East Bay"): 1,
+                ("gigs", "pay", "unpaid"): 1,
+            },
+        )
+
+    def test_add_facet_counts(self):
+        connection = db.session.connection()
+        facets.add_facet_counts(connection, {("gigs", "pay", "paid"): 2})
+        facets.add_facet_counts(
+            connection, {("gigs", "pay", "paid"): -1, ("gigs", "pay", "unpaid"): 0}
+        )
+        db.session.commit()
+
+        self.assertEqual(self.stored(), {("gigs", "pay", "paid"): 1})
+        self.assertEqual(facets.get_facet_counts("gigs"), {"pay": {"paid": 1}})
+
+
+class LoadZipcodesTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.raw_path = os.path.join(self.directory, "raw.txt")
+        with open(self.raw_path, "w") as raw_file:
+            raw_file.write("<td>94608</td>")
+        self.placenames_path = os.path.join(self.directory, "placenames.csv")
+        with open(self.placenames_path, "w") as placenames_file:
+            placenames_file.write('"94608","STANDARD","0","Emeryville"\n')
+
+        patcher = mock.patch("geodata.zipcode_centroids", return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_new_zipcodes_are_counted(self):
+        # A gig whose zipcode isn't loaded yet has no region
+        db.session.add(Post(users=make_user(), post_title="Gig", zipcode=94608))
+        db.session.commit()
+
+        self.assertEqual(
+            zipcodes.load_zipcodes(self.raw_path, self.placenames_path), (2, 0, 0)
+        )
+        self.assertEqual(
+            facets.get_facet_counts("gigs")["region"], {"East Bay": 1}
+        )
+
+    def test_matches_are_rebuilt(self):
+        make_user("Ann", is_artist=True, verified=True, zipcode=94608)
+        db.session.add(Post(users=make_user(), post_title="Gig", zipcode=94608))
+        db.session.commit()
+        refresh_all_matches()
+        before = ArtistMatch.query.one().score
+
+        zipcodes.load_zipcodes(self.raw_path, self.placenames_path)
+        # Now in the same place
+        self.assertAlmostEqual(ArtistMatch.query.one().score, before + 0.25)
+
+
+class ZipcodeGridTests(unittest.TestCase):
+    # A mix of Bay Area centers, a few sharing a cell, and far away ones
+    CENTROIDS = {
+        94608: (37.8366, -122.2837),
+        94607: (37.8047, -122.2911),
+        94110: (37.7487, -122.4158),
+        94301: (37.4443, -122.1502),
+        95112: (37.3442, -121.8830),
+        95616: (38.5382, -121.7617),
+        10001: (40.7506, -73.9971),
+        96801: (21.3069, -157.8583),
+    }
+
+    def brute_force(self, latitude, longitude, miles):
+        return {
+            zipcode: haversine_miles(latitude, longitude, *center)
+            for zipcode, center in self.CENTROIDS.items()
+            if haversine_miles(latitude, longitude, *center) <= miles
+        }
+
+    def test_haversine_miles(self):
+        self.assertEqual(haversine_miles(37.8, -122.3, 37.8, -122.3), 0)
+        # San Francisco to New York is about 2,570 miles
+        self.assertAlmostEqual(
+            haversine_miles(*self.CENTROIDS[94110], *self.CENTROIDS[10001]), 2570, delta=10
+        )
+
+    def test_within_matches_brute_force(self):
+        grid = ZipcodeGrid(self.CENTROIDS)
+
+        for zipcode in (94608, 94301, 10001, 96801):
+            latitude, longitude = self.CENTROIDS[zipcode]
+            # Small boxes scan every cell in them, and wide ones only the
+            # cells with zipcodes; both must find the same
+            for miles in (0, 3, 12, 50, 150, 3000, 30000):
+                self.assertEqual(
+                    grid.within(latitude, longitude, miles),
+                    self.brute_force(latitude, longitude, miles),
+                    (zipcode, miles),
+                )
+
+
+class NearbySearchTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        for zipcode, (latitude, longitude) in ZipcodeGridTests.CENTROIDS.items():
+            db.session.add(
+                Zipcode(
+                    valid_zipcode=zipcode,
+                    location_name=str(zipcode),
+                    region="Bay",
+                    latitude=latitude,
+                    longitude=longitude,
+                )
+            )
+        db.session.add(Zipcode(valid_zipcode=0, location_name="Remote", region="Remote"))
+        author = make_user()
+        for zipcode in (94608, 94110, 95112, 10001, 0):
+            db.session.add(
+                Post(users=author, post_title=f"Gig in {zipcode}", zipcode=zipcode)
+            )
+        db.session.commit()
+
+    def test_zipcodes_within_caps_miles(self):
+        self.assertEqual(
+            zipcodes_within(94608, 30000), zipcodes_within(94608, MAX_MILES)
+        )
+        self.assertNotIn(10001, zipcodes_within(94608, 30000))
+        self.assertIsNone(zipcodes_within(0, 10))
+        self.assertIsNone(zipcodes_within(12345, 10))
+
+    def test_nearest_gigs(self):
+        nearest = nearest_gigs(94608, 2)
+        self.assertEqual([post.zipcode for post, miles in nearest], [94608, 94110])
+        self.assertEqual(nearest[0][1], 0)
+        self.assertAlmostEqual(nearest[1][1], 9.4, delta=0.1)
+
+        # Only within NEARBY_MILES
+        self.assertEqual(len(nearest_gigs(94608, 10)), 2)
+        self.assertEqual(nearest_gigs(0, 10), [])
+
+
+class MatchScoreTests(unittest.TestCase):
+    def gig(self, **fields):
+        values = dict(
+            post_id=1,
+            user_id=1,
+            tag_ids=frozenset([1, 2]),
+            zipcode=94608,
+            location_name="Emeryville",
+            region="East Bay",
+            days_mask=None,
+            pay=None,
+            ishourly=False,
+            unpaid=True,
+        )
+        values.update(fields)
+        return GigProfile(**values)
+
+    def artist(self, **fields):
+        values = dict(
+            user_id=2,
+            tag_ids=frozenset([1]),
+            zipcode=94608,
+            location_name="Emeryville",
+            region="East Bay",
+            days_mask=ALL_DAYS,
+            hourly_rate=None,
+            show_unpaid=True,
+        )
+        values.update(fields)
+        return ArtistProfile(**values)
+
+    def test_gig_days_mask(self):
+        saturday = datetime(2026, 10, 17, 20)
+        self.assertIsNone(gig_days_mask(None))
+        self.assertEqual(gig_days_mask(saturday), 1 << 6)
+        self.assertEqual(gig_days_mask(saturday, saturday + timedelta(hours=8)), 65)
+        self.assertEqual(gig_days_mask(saturday, saturday - timedelta(days=2)), 1 << 6)
+        self.assertEqual(gig_days_mask(saturday, saturday + timedelta(days=6)), ALL_DAYS)
+        self.assertEqual(gig_days_mask(saturday, saturday + timedelta(days=30)), ALL_DAYS)
+
+    def test_match_score_parts(self):
+        self.assertIsNone(match_score(self.gig(), self.artist(user_id=1)))
+        # Half the tags, same place, every day, unpaid and fine with it
+        self.assertAlmostEqual(match_score(self.gig(), self.artist()), 0.8)
+        self.assertAlmostEqual(
+            match_score(self.gig(), self.artist(location_name="Oakland")),
+            0.2 + 0.25 * 0.6 + 0.2 + 0.15,
+        )
+        self.assertAlmostEqual(
+            match_score(
+                self.gig(days_mask=65), self.artist(days_mask=1, show_unpaid=False)
+            ),
+            0.2 + 0.25 + 0.1,
+        )
+        self.assertAlmostEqual(
+            match_score(
+                self.gig(unpaid=False, pay=100, ishourly=False),
+                self.artist(hourly_rate=50),
+            ),
+            0.2 + 0.25 + 0.2 + 0.15 * 0.5,
+        )
+
+    def test_unknown_places_match_nothing(self):
+        gig = self.gig(zipcode=11111, location_name=None, region=None)
+        artist = self.artist(zipcode=22222, location_name=None, region=None)
+        self.assertAlmostEqual(match_score(gig, artist), 0.2 + 0.2 + 0.15)
+
+        remote = self.gig(zipcode=0, location_name="Remote", region="Remote")
+        self.assertAlmostEqual(match_score(remote, artist), 0.2 + 0.25 + 0.2 + 0.15)
+
+    def test_best_breaks_ties_by_user_id(self):
+        scores = [(0.5, user_id) for user_id in range(20, 0, -1)] + [(0.9, 30)]
+        best = _best(scores)
+
+        self.assertEqual(len(best), MATCHES_PER_POST)
+        self.assertEqual(best[0], (0.9, 30))
+        self.assertEqual([user_id for _, user_id in best[1:]], list(range(1, 12)))
+
+
+class MatchRefreshTests(DatabaseTestCase):
+    ZIPCODES = [
+        (94608, "Emeryville", "East Bay"),
+        (94607, "Oakland", "East Bay"),
+        (94110, "San Francisco", "San Francisco"),
+        (0, "Remote", "Remote"),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.random = random.Random(23)
+
+        for zipcode, location_name, region in self.ZIPCODES:
+            db.session.add(
+                Zipcode(valid_zipcode=zipcode, location_name=location_name, region=region)
+            )
+        self.tags = [Tag(tag_name=f"Tag {n}") for n in range(4)]
+        db.session.add_all(self.tags)
+
+        # More artists than a list holds, so lists fill up and merging has
+        # to fall back to rescoring
+        self.artists = [
+            make_user(f"Artist{n}", is_artist=True, verified=True) for n in range(16)
+        ]
+        for artist in self.artists:
+            self.shuffle_artist(artist)
+
+        author = make_user("Author")
+        self.posts = [
+            Post(users=author, post_title=f"Gig {n}", active=True) for n in range(8)
+        ]
+        for post in self.posts:
+            self.shuffle_post(post)
+        db.session.add_all(self.posts)
+        db.session.commit()
+
+        refresh_all_matches()
+
+    def shuffle_artist(self, artist):
+        artist.tags = self.random.sample(self.tags, self.random.randint(0, 2))
+        # 12345 isn't in zipcodes
+        artist.zipcode = self.random.choice([94608, 94607, 94110, 12345, None])
+        artist.daysweek = "".join(self.random.choice("tf") for _ in range(7))
+        artist.hourly_rate = self.random.choice([None, 20, 50, 100])
+        artist.show_unpaid = self.random.random() < 0.5
+
+    def shuffle_post(self, post):
+        post.tags = self.random.sample(self.tags, self.random.randint(0, 3))
+        post.zipcode = self.random.choice([94608, 94607, 94110, 0, 12345])
+        post.gig_date_start = datetime(2026, 10, 17) + timedelta(
+            days=self.random.randint(0, 6)
+        )
+        post.gig_date_end = post.gig_date_start + timedelta(
+            days=self.random.randint(0, 2)
+        )
+        post.unpaid = self.random.random() < 0.3
+        post.pay = self.random.choice([None, 40, 150, 400])
+        post.ishourly = self.random.random() < 0.5
+
+    def stored(self):
+        return sorted(
+            (match.post_id, match.user_id, round(match.score, 9))
+            for match in ArtistMatch.query
+        )
+
+    def assertMatchesFullRebuild(self):
+        incremental = self.stored()
+        refresh_all_matches()
+        self.assertEqual(incremental, self.stored())
+
+    def test_incremental_refresh_matches_full_rebuild(self):
+        for step in range(40):
+            if step % 4 == 3:
+                post = self.random.choice(self.posts)
+                self.shuffle_post(post)
+                db.session.commit()
+                refresh_post_matches([post.post_id])
+            else:
+                artists = self.random.sample(self.artists, self.random.randint(1, 3))
+                for artist in artists:
+                    self.shuffle_artist(artist)
+                    artist.verified = self.random.random() < 0.9
+                db.session.commit()
+                refresh_artist_matches([artist.id for artist in artists])
+
+            self.assertMatchesFullRebuild()
+
+    def test_lists_hold_the_best(self):
+        for post in self.posts:
+            stored = [
+                (match.score, match.user_id)
+                for match in ArtistMatch.query.filter_by(post_id=post.post_id)
+            ]
+            gig = load_gigs([post.post_id])[0]
+            scores = [
+                (match_score(gig, artist), artist.user_id) for artist in load_artists()
+            ]
+            self.assertEqual(
+                sorted(stored), sorted(_best([scored for scored in scores if scored[0]]))
+            )
+
+    def test_deleted_and_expired_posts_lose_their_lists(self):
+        post = self.posts[0]
+        post.gig_date_start = datetime(2026, 1, 1)
+        post.gig_date_end = None
+        db.session.commit()
+        refresh_post_matches([post.post_id])
+        self.assertTrue(ArtistMatch.query.filter_by(post_id=post.post_id).count())
+
+        expire_gigs(datetime(2026, 10, 17))
+        self.assertEqual(ArtistMatch.query.filter_by(post_id=post.post_id).count(), 0)
+
+        deleted = self.posts[1].post_id
+        db.session.delete(self.posts[1])
+        db.session.commit()
+        refresh_post_matches([deleted])
+        self.assertEqual(ArtistMatch.query.filter_by(post_id=deleted).count(), 0)
+
+    def test_unverified_artists_drop_out(self):
+        artist = ArtistMatch.query.first().users
+        artist.verified = False
+        db.session.commit()
+        refresh_artist_matches([artist.id])
+
+        self.assertEqual(ArtistMatch.query.filter_by(user_id=artist.id).count(), 0)
+        self.assertMatchesFullRebuild()
+
+
+class MatchRefresherTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        delay = app.config["MATCH_REFRESH_DELAY"]
+        app.config["MATCH_REFRESH_DELAY"] = 0.05
+        self.addCleanup(app.config.__setitem__, "MATCH_REFRESH_DELAY", delay)
+
+        self.calls = []
+        for name in ("refresh_post_matches", "refresh_artist_matches"):
+            patcher = mock.patch(
+                f"matching.{name}",
+                lambda ids, name=name: self.calls.append((name, set(ids))),
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # The app's own refresher would take the commits' changes first
+        event.remove(Session, "after_commit", server.match_refresher._after_commit)
+        self.addCleanup(
+            event.listen, Session, "after_commit", server.match_refresher._after_commit
+        )
+
+        self.refresher = MatchRefresher(app)
+        self.addCleanup(
+            event.remove, Session, "after_commit", self.refresher._after_commit
+        )
+        self.addCleanup(self.refresher.stop)
+
+    def test_submissions_in_a_burst_are_one_batch(self):
+        self.refresher.submit(post_ids=[1])
+        self.refresher.submit(post_ids=[2], user_ids=[7])
+        self.refresher.submit(user_ids=[8])
+        self.assertTrue(self.refresher.wait(5))
+
+        self.assertEqual(
+            self.calls,
+            [("refresh_post_matches", {1, 2}), ("refresh_artist_matches", {7, 8})],
+        )
+
+    def test_commits_submit_what_changed(self):
+        artist = make_user("Ann", is_artist=True, verified=True)
+        viewer = make_user("Viewer")
+        db.session.commit()
+        self.refresher.wait(5)
+        del self.calls[:]
+
+        post = Post(users=viewer, post_title="Gig", zipcode=0)
+        artist.hourly_rate = 40
+        # Not a field matches depend on
+        viewer.bio = "Hi"
+        db.session.add(post)
+        db.session.commit()
+        self.assertTrue(self.refresher.wait(5))
+
+        self.assertEqual(
+            self.calls,
+            [
+                ("refresh_post_matches", {post.post_id}),
+                ("refresh_artist_matches", {artist.id}),
+            ],
+        )
+
+    def test_rolled_back_changes_are_not_submitted(self):
+        db.session.add(make_user("Ann", is_artist=True, verified=True))
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+
+        self.assertTrue(self.refresher.wait(5))
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
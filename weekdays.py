@@ -0,0 +1,65 @@
+"""BayArt - Bay Area Art Connection Project: weekly availability bitmasks
+
+An artist's recurring weekly availability is stored twice on User: as the
+daysweek string the availability pages use ("tfttttt", Sunday first), and as
+days_mask, a 7-bit integer with bit 0 for Sunday through bit 6 for Saturday.
+
+There are only 128 possible masks, so "free on any/all of these days" is
+answered by listing every mask that qualifies and filtering
+days_mask IN (...), which an ordinary btree index serves.
+"""
+
+DAYS = 7
+ALL_DAYS = (1 << DAYS) - 1
+
+
+def daysweek_to_mask(daysweek):
+    """Returns the mask for a daysweek string, e.g. "tffffft" -> 65."""
+
+    mask = 0
+    for day, available in enumerate(daysweek[:DAYS]):
+        if available == "t":
+            mask |= 1 << day
+    return mask
+
+
+def mask_to_daysweek(mask):
+    return "".join("t" if mask & (1 << day) else "f" for day in range(DAYS))
+
+
+def is_daysweek(value):
+    """Checks a form value is a full daysweek string."""
+
+    return value != None and len(value) == DAYS and set(value) <= {"t", "f"}
+
+
+def parse_weekday(value):
+    """Returns a form value as a weekday, 0 (Sunday) to 6 (Saturday), or
+    None if it isn't one."""
+
+    if value == None or not value.isdigit() or int(value) >= DAYS:
+        return None
+    return int(value)
+
+
+def days_to_mask(days):
+    """Returns the mask with a bit set for each day, 0 (Sunday) to 6 (Saturday)."""
+
+    mask = 0
+    for day in days:
+        mask |= 1 << int(day)
+    return mask
+
+
+def masks_with_any(days):
+    """Every mask available on at least one of days."""
+
+    wanted = days_to_mask(days)
+    return [mask for mask in range(ALL_DAYS + 1) if mask & wanted]
+
+
+def masks_with_all(days):
+    """Every mask available on all of days."""
+
+    wanted = days_to_mask(days)
+    return [mask for mask in range(ALL_DAYS + 1) if mask & wanted == wanted]
@@ -0,0 +1,10 @@
+"""BayArt - Bay Area Art Connection Project: WSGI entry point
+
+Production serves the app with gunicorn, configured by gunicorn.conf.py:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+from server import create_app
+
+app = create_app()
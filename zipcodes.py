@@ -0,0 +1,459 @@
+"""BayArt - Bay Area Art Connection Project: zipcode and region ingestion
+
+Loads the zipcodes table from two source files in one pass:
+
+    non_server_files/raw_zipcodes.txt                 a saved web page listing
+                                                      the Bay Area zipcodes
+    non_server_files/zip_code_database_placenames.csv zipcode,...,...,place name
+
+The page is scanned in chunks for zipcodes, then the place name file is read
+line by line. As in the old seed script, the last line for a zipcode names
+it; the file is parsed as CSV, so a quoted name containing a comma is kept
+whole where the old split(",") cut it short. Each zipcode gets its region
+(from REGIONS) and its center from the map polygons in static/.
+Zipcodes with no polygon borrow the center of their place's other zipcodes.
+The result is written in one transaction, inserting
+new zipcodes and updating changed ones in bulk. Running it again only
+writes what changed:
+
+    FLASK_APP=server.py flask load-zipcodes
+"""
+
+import csv
+
+from model import db, Zipcode
+
+RAW_ZIPCODES_PATH = "non_server_files/raw_zipcodes.txt"
+PLACENAMES_PATH = "non_server_files/zip_code_database_placenames.csv"
+
+CHUNK_SIZE = 64 * 1024
+
+# Compared to tell whether a stored zipcode needs updating
+ZIPCODE_FIELDS = ("location_name", "region", "latitude", "longitude")
+
+REMOTE_ZIPCODE = 0
+REMOTE = "Remote"
+
+# Place names by region. Places not listed here are in REMOTE.
+REGIONS = {
+    "San Francisco": frozenset(["San Francisco"]),
+    "Peninsula": frozenset(
+        [
+            "Belmont",
+            "Brisbane",
+            "Burlingame",
+            "El Granada",
+            "Half Moon Bay",
+            "La Honda",
+            "Loma Mar",
+            "Los Altos",
+            "Daly City",
+            "Menlo Park",
+            "Atherton",
+            "Portola Valley",
+            "Millbrae",
+            "Montara",
+            "Moss Beach",
+            "Mountain View",
+            "Pacifica",
+            "Pescadero",
+            "Redwood City",
+            "San Bruno",
+            "San Carlos",
+            "San Gregorio",
+            "South San Francisco",
+            "Sunnyvale",
+            "Palo Alto",
+            "Stanford",
+            "San Mateo",
+        ]
+    ),
+    "North Bay and Northland": frozenset(
+        [
+            "American Canyon",
+            "Angwin",
+            "Calistoga",
+            "Fairfield",
+            "Napa",
+            "Oakville",
+            "Pope Valley",
+            "Deer Park",
+            "Rio Vista",
+            "Rutherford",
+            "Saint Helena",
+            "Suisun City",
+            "Vallejo",
+            "Yountville",
+            "San Rafael",
+            "Greenbrae",
+            "Belvedere Tiburon",
+            "Bodega",
+            "Bodega Bay",
+            "Bolinas",
+            "Corte Madera",
+            "Rohnert Park",
+            "Dillon Beach",
+            "Fairfax",
+            "Cotati",
+            "Forest Knolls",
+            "Inverness",
+            "Lagunitas",
+            "Larkspur",
+            "Marshall",
+            "Mill Valley",
+            "Novato",
+            "Nicasio",
+            "Olema",
+            "Penngrove",
+            "Petaluma",
+            "Point Reyes Station",
+            "Ross",
+            "San Anselmo",
+            "San Geronimo",
+            "San Quentin",
+            "Sausalito",
+            "Stinson Beach",
+            "Tomales",
+            "Valley Ford",
+            "Woodacre",
+            "Jenner",
+            "The Sea Ranch",
+            "Windsor",
+            "Villa Grande",
+            "Stewarts Point",
+            "Sonoma",
+            "Sebastopol",
+            "Rio Nido",
+            "Occidental",
+            "Monte Rio",
+            "Middletown",
+            "Kenwood",
+            "Healdsburg",
+            "Guerneville",
+            "Gualala",
+            "Graton",
+            "Glen Ellen",
+            "Geyserville",
+            "Fulton",
+            "Forestville",
+            "El Verano",
+            "Duncans Mills",
+            "Cloverdale",
+            "Clearlake",
+            "Cazadero",
+            "Camp Meeker",
+            "Boyes Hot Springs",
+            "Annapolis",
+            "Santa Rosa",
+        ]
+    ),
+    "East Bay": frozenset(
+        [
+            "Alameda",
+            "Discovery Bay",
+            "Danville",
+            "Alamo",
+            "Antioch",
+            "Benicia",
+            "Bethel Island",
+            "Birds Landing",
+            "Brentwood",
+            "Byron",
+            "Canyon",
+            "Concord",
+            "Pleasant Hill",
+            "Crockett",
+            "Diablo",
+            "El Cerrito",
+            "Fremont",
+            "Hayward",
+            "Castro Valley",
+            "Hercules",
+            "Knightsen",
+            "Lafayette",
+            "Livermore",
+            "Martinez",
+            "Moraga",
+            "Newark",
+            "Oakley",
+            "Orinda",
+            "Pinole",
+            "Pittsburg",
+            "Pleasanton",
+            "Dublin",
+            "Port Costa",
+            "Rodeo",
+            "San Leandro",
+            "San Ramon",
+            "San Lorenzo",
+            "Sunol",
+            "Union City",
+            "Oakland",
+            "Emeryville",
+            "Berkeley",
+            "Albany",
+            "Richmond",
+            "El Sobrante",
+            "San Pablo",
+            "Clayton",
+            "Walnut Creek",
+        ]
+    ),
+    "South Bay": frozenset(
+        [
+            "Alviso",
+            "Aptos",
+            "Ben Lomond",
+            "Boulder Creek",
+            "Brookdale",
+            "Campbell",
+            "Capitola",
+            "Castroville",
+            "Coyote",
+            "Cupertino",
+            "Davenport",
+            "Felton",
+            "Freedom",
+            "Gilroy",
+            "Hollister",
+            "Los Gatos",
+            "Milpitas",
+            "Morgan Hill",
+            "Mount Hermon",
+            "Paicines",
+            "San Juan Bautista",
+            "San Martin",
+            "Santa Clara",
+            "Santa Cruz",
+            "Scotts Valley",
+            "Saratoga",
+            "Soquel",
+            "Tres Pinos",
+            "Watsonville",
+            "San Jose",
+            "Mount Hamilton",
+            "Aromas",
+        ]
+    ),
+    "Sacramento and Stockton": frozenset(
+        [
+            "Stockton",
+            "Acampo",
+            "Travis Afb",
+            "Clements",
+            "Farmington",
+            "French Camp",
+            "Holt",
+            "Linden",
+            "Lockeford",
+            "Lodi",
+            "Valley Springs",
+            "Victor",
+            "Wallace",
+            "Woodbridge",
+            "Tracy",
+            "Escalon",
+            "Lathrop",
+            "Manteca",
+            "Modesto",
+            "Oakdale",
+            "Ripon",
+            "Sacramento",
+            "Winters",
+            "Walnut Grove",
+            "Thornton",
+            "Pioneer",
+            "Loomis",
+            "Lincoln",
+            "Galt",
+            "Fair Oaks",
+            "Elmira",
+            "Dixon",
+            "Davis",
+            "Auburn",
+            "Vernalis",
+            "Riverbank",
+            "Vacaville",
+        ]
+    ),
+}
+
+REGION_BY_PLACE = {
+    place: region for region, places in REGIONS.items() for place in places
+}
+
+
+def region_for(location_name):
+    return REGION_BY_PLACE.get(location_name, REMOTE)
+
+
+def scan_zipcodes(raw_file, chunk_size=CHUNK_SIZE):
+    """Yields each distinct five digit zipcode that starts an HTML text node
+    (follows a ">") in raw_file, reading it a chunk at a time."""
+
+    seen = set()
+    tail = ""
+
+    while True:
+        chunk = raw_file.read(chunk_size)
+        text = tail + chunk
+        pieces = text.split(">")
+
+        # The last piece may continue in the next chunk
+        if chunk:
+            tail = pieces.pop()
+
+        for piece in pieces:
+            code = piece[:5]
+            if len(code) == 5 and code.isdigit() and code not in seen:
+                seen.add(code)
+                yield code
+
+        if not chunk:
+            return
+
+
+def zipcode_rows(
+    raw_path=RAW_ZIPCODES_PATH, placenames_path=PLACENAMES_PATH, centroids=None
+):
+    """Yields a {valid_zipcode, location_name, region, latitude, longitude}
+    dict for every zipcode on the page that has a place name, then one for
+    REMOTE_ZIPCODE. centroids maps zipcode strings to (latitude, longitude);
+    zipcodes missing from it get None for both."""
+
+    if centroids is None:
+        centroids = {}
+
+    with open(raw_path) as raw_file:
+        wanted = set(scan_zipcodes(raw_file))
+
+    placenames = {}
+    with open(placenames_path, newline="") as placenames_file:
+        for row in csv.reader(placenames_file):
+            if len(row) > 3 and row[0] in wanted:
+                # The last line for a zipcode wins, as in the old seed script
+                placenames[row[0]] = row[3].strip()
+
+    for code, location_name in placenames.items():
+        latitude, longitude = centroids.get(code, (None, None))
+        yield {
+            "valid_zipcode": int(code),
+            "location_name": location_name,
+            "region": region_for(location_name),
+            "latitude": _round_degrees(latitude),
+            "longitude": _round_degrees(longitude),
+        }
+
+    yield {
+        "valid_zipcode": REMOTE_ZIPCODE,
+        "location_name": REMOTE,
+        "region": REMOTE,
+        "latitude": None,
+        "longitude": None,
+    }
+
+
+def _round_degrees(degrees):
+    # Six places is about 10cm, and keeps reloads from seeing float noise as changes
+    if degrees == None:
+        return None
+    return round(degrees, 6)
+
+
+def fill_place_centroids(rows):
+    """Gives rows without a centroid the average centroid of the other
+    zipcodes in the same place, where there are any. Returns rows as a list."""
+
+    rows = list(rows)
+
+    places = {}
+    for row in rows:
+        if row["latitude"] != None:
+            places.setdefault(row["location_name"], []).append(
+                (row["latitude"], row["longitude"])
+            )
+
+    for row in rows:
+        centers = places.get(row["location_name"])
+        if row["latitude"] == None and centers and row["location_name"] != REMOTE:
+            row["latitude"] = _round_degrees(
+                sum(center[0] for center in centers) / len(centers)
+            )
+            row["longitude"] = _round_degrees(
+                sum(center[1] for center in centers) / len(centers)
+            )
+
+    return rows
+
+
+def upsert_zipcodes(rows):
+    """Brings the zipcodes table in line with rows, in one transaction: new
+    zipcodes are inserted and changed ones updated, each in one bulk
+    statement. Zipcodes missing from rows are left alone.
+    Returns (inserted, updated, unchanged) counts."""
+
+    existing = {
+        zip_row.valid_zipcode: tuple(zip_row[1:])
+        for zip_row in db.session.query(
+            Zipcode.valid_zipcode,
+            Zipcode.location_name,
+            Zipcode.region,
+            Zipcode.latitude,
+            Zipcode.longitude,
+        )
+    }
+
+    inserts = []
+    updates = []
+    unchanged = 0
+
+    for row in rows:
+        current = existing.get(row["valid_zipcode"])
+        wanted = tuple(row.get(field) for field in ZIPCODE_FIELDS)
+        if current is None:
+            inserts.append(row)
+            existing[row["valid_zipcode"]] = wanted
+        elif current != wanted:
+            updates.append(row)
+        else:
+            unchanged += 1
+
+    try:
+        db.session.bulk_insert_mappings(Zipcode, inserts)
+        db.session.bulk_update_mappings(Zipcode, updates)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return len(inserts), len(updates), unchanged
+
+
+def load_zipcodes(raw_path=RAW_ZIPCODES_PATH, placenames_path=PLACENAMES_PATH):
+    """Parses the source files, adds each zipcode's center from the map
+    polygons (see geodata.py) and upserts the result. If that added or
+    changed anything, the search facets are recounted and the suggested
+    artist lists rebuilt. Returns (inserted, updated, unchanged) counts."""
+
+    # Bulk writes skip the mapper events that usually expire these caches
+    from facets import rebuild_facet_counts
+    from geodata import reset_area_collections, zipcode_centroids
+    from matching import refresh_all_matches
+    from refdata import invalidate_reference_data
+
+    inserted, updated, unchanged = upsert_zipcodes(
+        fill_place_centroids(
+            zipcode_rows(raw_path, placenames_path, zipcode_centroids())
+        )
+    )
+
+    invalidate_reference_data()
+    reset_area_collections()
+    if inserted or updated:
+        # Gigs in a new zipcode have no region counted yet, and gigs in one
+        # that moved region are counted in the old one
+        rebuild_facet_counts()
+        # Likewise for the place and region parts of match scores
+        refresh_all_matches()
+
+    return inserted, updated, unchanged